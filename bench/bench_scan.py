@@ -0,0 +1,148 @@
+"""Benchmark de ``_ejecutar_scan`` contra el servidor IMAP/SMTP local.
+
+Levanta ``kyber.servidor_local`` en otro proceso (así la memoria medida es
+solo la del escaneo), carga un buzón sintético por cada tamaño y mide un
+escaneo en frío y uno repetido: tiempo, round trips, bytes y pico de
+memoria. La IA es el proveedor ``stub`` de ``kyber.ai`` (clasificación
+determinista, sin red) para no depender de Gemini.
+
+    python bench/bench_scan.py --tamanos 10,100,1000,10000,100000 --max 100
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+
+def _servidor(conexion, latencia: float, multiappend: bool) -> None:
+    from kyber.servidor_local import ServidorImapLocal, ServidorSmtpLocal, generar_buzon
+
+    imap = ServidorImapLocal(multiappend=multiappend, latencia=latencia).iniciar()
+    smtp = ServidorSmtpLocal(imap.cuentas, latencia=latencia).iniciar()
+    conexion.send((imap.puerto, smtp.puerto))
+    while True:
+        orden, *args = conexion.recv()
+        if orden == "buzon":
+            usuario, cantidad, semilla = args
+            generar_buzon(imap.crear_cuenta(usuario, "clave"), cantidad, semilla=semilla)
+            conexion.send(cantidad)
+        elif orden == "reiniciar":
+            imap.metricas.reiniciar()
+            smtp.metricas.reiniciar()
+            conexion.send(None)
+        elif orden == "metricas":
+            conexion.send({"imap": imap.metricas.resumen(), "smtp": smtp.metricas.resumen()})
+        else:
+            break
+    smtp.detener()
+    imap.detener()
+
+
+def _medir(web, metricas_imap, user_info: dict, servidor, con_memoria: bool) -> dict:
+    servidor.send(("reiniciar",))
+    servidor.recv()
+    if con_memoria:
+        tracemalloc.start()
+    inicio, cpu = time.perf_counter(), time.process_time()
+    with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo), metricas_imap.medir_escaneo(user_info["gmail_user"]):
+        procesados = web._ejecutar_scan(user_info)
+    segundos, cpu = time.perf_counter() - inicio, time.process_time() - cpu
+    pico = None
+    if con_memoria:
+        pico = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    servidor.send(("metricas",))
+    metricas = servidor.recv()
+    return {
+        "segundos": round(segundos, 3),
+        # Solo este proceso: el tiempo restante es red y servidor local
+        "cpu_cliente": round(cpu, 3),
+        "procesados": procesados,
+        "round_trips": metricas["imap"]["round_trips"] + metricas["smtp"]["round_trips"],
+        "conexiones": metricas["imap"]["conexiones"] + metricas["smtp"]["conexiones"],
+        "bytes_recibidos": metricas["imap"]["bytes_salida"] + metricas["smtp"]["bytes_salida"],
+        "bytes_enviados": metricas["imap"]["bytes_entrada"] + metricas["smtp"]["bytes_entrada"],
+        "pico_memoria": pico,
+        "comandos": metricas["imap"]["comandos"],
+        # Vista del cliente (latencias por comando) según kyber.metricas_imap
+        "imap_cliente": metricas_imap.exportar(user_info["gmail_user"])["ultimo_escaneo"]["comandos"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tamanos", default="10,100,1000,10000,100000", help="mensajes en INBOX, separados por comas")
+    parser.add_argument("--max", type=int, default=100, help="scan_max del usuario")
+    parser.add_argument("--batch", type=int, default=10, help="scan_batch del usuario")
+    parser.add_argument("--workers", type=int, default=1, help="scan_workers del usuario")
+    parser.add_argument("--latencia", type=float, default=0.0, help="segundos de espera por comando en el servidor")
+    parser.add_argument("--multiappend", action="store_true")
+    parser.add_argument("--sin-memoria", action="store_true", help="no usar tracemalloc (tiempos sin su sobrecosto)")
+    parser.add_argument("--json", help="guardar los resultados en este archivo")
+    args = parser.parse_args()
+
+    contexto = multiprocessing.get_context("spawn")
+    servidor, extremo = contexto.Pipe()
+    proceso = contexto.Process(target=_servidor, args=(extremo, args.latencia, args.multiappend), daemon=True)
+    proceso.start()
+    puerto_imap, puerto_smtp = servidor.recv()
+
+    temporal = tempfile.mkdtemp(prefix="kyber-bench-")
+    os.environ.update({
+        "KYBER_IMAP_HOST": "127.0.0.1", "KYBER_IMAP_PORT": str(puerto_imap), "KYBER_IMAP_SSL": "0",
+        "KYBER_SMTP_HOST": "127.0.0.1", "KYBER_SMTP_PORT": str(puerto_smtp), "KYBER_SMTP_SSL": "0",
+        "KYBER_AGENTE_SERVIDOR": "0", "KYBER_IA_PROVEEDOR": "stub", "KYBER_IA_RPM": "0", "KYBER_IA_TPM": "0",
+    })
+    # web.py monta static/ y templates/ relativos al directorio de trabajo
+    os.chdir(RAIZ)
+    with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+        from kyber import almacen, db, metricas_imap, web
+
+    resultados = []
+    for cantidad in [int(x) for x in args.tamanos.split(",") if x.strip()]:
+        carpeta = os.path.join(temporal, str(cantidad))
+        os.makedirs(carpeta)
+        os.chdir(carpeta)
+        almacen.ALMACEN_DIR = os.path.join(carpeta, "cache_mensajes")
+        usuario = f"bench{cantidad}@local"
+        t = time.perf_counter()
+        servidor.send(("buzon", usuario, cantidad, cantidad))
+        servidor.recv()
+        carga = time.perf_counter() - t
+        with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+            db.crear_base_de_datos()
+            usuario_id = db.crear_usuario(usuario, "-", datetime.utcnow().isoformat())
+        user_info = {
+            "id": usuario_id, "email": usuario, "gemini_api_key": "bench", "gmail_user": usuario, "gmail_password": "clave",
+            "scan_batch": args.batch, "scan_max": args.max, "scan_workers": args.workers, "agente_activo": False,
+            "contexto_negocio": "", "filtro_fecha_especifica": 0, "fecha_filtro": "",
+        }
+        for corrida in ("frio", "repetido"):
+            fila = {"mensajes": cantidad, "corrida": corrida, **_medir(web, metricas_imap, user_info, servidor, not args.sin_memoria)}
+            resultados.append(fila)
+            memoria = f"{fila['pico_memoria'] / 2**20:7.1f} MB" if fila["pico_memoria"] is not None else "      -   "
+            print(
+                f"{cantidad:>7} {corrida:<8} {fila['segundos']:8.3f} s ({fila['cpu_cliente']:6.3f} cpu)  {fila['procesados']:>4} proc  "
+                f"{fila['round_trips']:>5} rt  {fila['bytes_recibidos'] / 1024:9.1f} KB rx  {memoria}"
+                + (f"  (buzón cargado en {carga:.1f} s)" if corrida == "frio" else "")
+            )
+
+    servidor.send(("fin",))
+    proceso.join(timeout=10)
+    os.chdir(RAIZ)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as archivo:
+            json.dump(resultados, archivo, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+import imaplib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+from .db import obtener_usuarios_agente_activo
+from .gmail_client import abrir_conexion_idle, esperar_correo_nuevo
+
+
+# Segundos que se mantiene cada IDLE antes de renovarlo (Gmail lo corta a los ~29 min).
+IDLE_SEGUNDOS = int(os.environ.get("KYBER_IDLE_SEGUNDOS", "600"))
+# Intervalos del sondeo adaptativo cuando el servidor no ofrece IDLE.
+SONDEO_MIN_SEGUNDOS = int(os.environ.get("KYBER_SONDEO_MIN", "60"))
+SONDEO_MAX_SEGUNDOS = int(os.environ.get("KYBER_SONDEO_MAX", "600"))
+# Espera antes de reintentar tras perder la conexión IDLE.
+REINTENTO_SEGUNDOS = 30
+
+
+_BLOQUEOS_SCAN: Dict[int, threading.Lock] = {}
+_BLOQUEOS_LOCK = threading.Lock()
+
+
+@contextmanager
+def bloqueo_scan(usuario_id: int) -> Iterator[None]:
+    """Evita que dos escaneos del mismo usuario corran a la vez (agente y botón)."""
+    with _BLOQUEOS_LOCK:
+        bloqueo = _BLOQUEOS_SCAN.setdefault(usuario_id, threading.Lock())
+    with bloqueo:
+        yield
+
+
+class _Vigilante(threading.Thread):
+    """Hilo que despierta el escaneo de un usuario cuando llega correo nuevo."""
+
+    def __init__(self, usuario_id: int, gmail_user: str, gmail_pwd: str, ejecutar: Callable[[int], int]) -> None:
+        super().__init__(name=f"kyber-agente-{usuario_id}", daemon=True)
+        self.usuario_id = usuario_id
+        self.gmail_user = gmail_user
+        self.gmail_pwd = gmail_pwd
+        self.ejecutar = ejecutar
+        self.detener = threading.Event()
+        self.modo = "iniciando"
+        self.ultimo_escaneo: str | None = None
+        self.procesados = 0
+
+    def _escanear(self) -> int:
+        try:
+            procesados = self.ejecutar(self.usuario_id) or 0
+        except Exception as e:
+            print(f"⚠️  [AGENTE] Error en escaneo de usuario {self.usuario_id}: {e}")
+            return 0
+        self.ultimo_escaneo = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.procesados += procesados
+        return procesados
+
+    def run(self) -> None:
+        sin_idle = False
+        intervalo = SONDEO_MIN_SEGUNDOS
+        while not self.detener.is_set():
+            conexion = None
+            if not sin_idle:
+                try:
+                    conexion = abrir_conexion_idle(self.gmail_user, self.gmail_pwd)
+                    sin_idle = conexion is None
+                except (imaplib.IMAP4.error, OSError) as e:
+                    print(f"⚠️  [AGENTE] No se pudo abrir IDLE para {self.gmail_user}: {e}")
+
+            if conexion is not None:
+                self.modo = "idle"
+                print(f"📡 [AGENTE] IDLE activo para {self.gmail_user}")
+                # Recuperar lo que llegó mientras no había conexión
+                self._escanear()
+                try:
+                    while not self.detener.is_set():
+                        if esperar_correo_nuevo(conexion, IDLE_SEGUNDOS, self.detener):
+                            self._escanear()
+                except (imaplib.IMAP4.error, OSError) as e:
+                    print(f"⚠️  [AGENTE] IDLE interrumpido para {self.gmail_user}: {e}")
+                finally:
+                    try:
+                        conexion.logout()
+                    except Exception:
+                        pass
+                self.detener.wait(REINTENTO_SEGUNDOS)
+                continue
+
+            # Sondeo adaptativo: se duplica la espera mientras no llegue nada
+            self.modo = "sondeo"
+            procesados = self._escanear()
+            intervalo = SONDEO_MIN_SEGUNDOS if procesados else min(intervalo * 2, SONDEO_MAX_SEGUNDOS)
+            self.detener.wait(intervalo)
+        self.modo = "detenido"
+
+
+_VIGILANTES: Dict[int, _Vigilante] = {}
+_VIGILANTES_LOCK = threading.Lock()
+_EJECUTAR: Callable[[int], int] | None = None
+
+
+def iniciar_agente(ejecutar: Callable[[int], int]) -> None:
+    """Registra la función de escaneo y arranca un vigilante por usuario activo."""
+    global _EJECUTAR
+    _EJECUTAR = ejecutar
+    sincronizar_vigilantes()
+
+
+def sincronizar_vigilantes() -> None:
+    """Arranca o detiene vigilantes según ``obtener_usuarios_agente_activo``."""
+    if _EJECUTAR is None:
+        return
+    deseados: Dict[int, Tuple[str, str]] = {}
+    for fila in obtener_usuarios_agente_activo():
+        usuario_id, gmail_user, gmail_pwd = fila[0], fila[5], fila[6]
+        if gmail_user and gmail_pwd:
+            deseados[usuario_id] = (gmail_user, gmail_pwd)
+    with _VIGILANTES_LOCK:
+        for usuario_id, vigilante in list(_VIGILANTES.items()):
+            if deseados.get(usuario_id) != (vigilante.gmail_user, vigilante.gmail_pwd):
+                vigilante.detener.set()
+                del _VIGILANTES[usuario_id]
+        for usuario_id, (gmail_user, gmail_pwd) in deseados.items():
+            if usuario_id not in _VIGILANTES:
+                vigilante = _Vigilante(usuario_id, gmail_user, gmail_pwd, _EJECUTAR)
+                _VIGILANTES[usuario_id] = vigilante
+                vigilante.start()
+
+
+def detener_agente() -> None:
+    with _VIGILANTES_LOCK:
+        vigilantes = list(_VIGILANTES.values())
+        _VIGILANTES.clear()
+    for vigilante in vigilantes:
+        vigilante.detener.set()
+    for vigilante in vigilantes:
+        vigilante.join(timeout=5)
+
+
+def estado_agente(usuario_id: int) -> Dict[str, Any]:
+    """Estado del vigilante del usuario, para que la interfaz sepa cuándo refrescar."""
+    with _VIGILANTES_LOCK:
+        vigilante = _VIGILANTES.get(usuario_id)
+    if vigilante is None:
+        return {"vigilado": False, "modo": None, "ultimo_escaneo": None, "procesados": 0}
+    return {
+        "vigilado": True,
+        "modo": vigilante.modo,
+        "ultimo_escaneo": vigilante.ultimo_escaneo,
+        "procesados": vigilante.procesados,
+    }
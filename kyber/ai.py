@@ -1,23 +1,66 @@
+import hashlib
+import json
 import os
+import random
 import re
-from typing import Dict, List, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from typing import Dict, Iterator, List, Any
 
 import google.generativeai as genai
+from google.generativeai import caching, protos
+from google.generativeai.client import _ClientManager
+from google.protobuf import field_mask_pb2
 
 from .db import obtener_reglas, obtener_respuestas
 
 
-def _configurar_modelo(api_key: str | None = None) -> genai.GenerativeModel:
+# Proveedor de IA: "gemini" o "stub" (respuestas deterministas sin red, para pruebas).
+IA_PROVEEDOR = os.environ.get("KYBER_IA_PROVEEDOR", "gemini").strip().lower()
+IA_MODELO = os.environ.get("KYBER_IA_MODELO", "gemini-2.5-flash")
+
+
+_LOCK_CLIENTES = threading.Lock()
+# {sha256 de la API key: clientes de Gemini de esa key}
+_CLIENTES: Dict[str, _ClientManager] = {}
+
+
+def _clientes(api_key: str | None) -> _ClientManager:
+    """Clientes de Gemini propios de la key.
+
+    ``genai.configure`` cambia la key de todo el proceso, y las clasificaciones
+    de varios usuarios corren en hilos a la vez: cada llamada debe salir con la
+    key de su usuario, no con la del último que configuró.
+    """
     key = api_key or os.environ.get("GEMINI_API_KEY")
     if not key:
         raise RuntimeError("GEMINI_API_KEY no configurada")
-    genai.configure(api_key=key)
-    return genai.GenerativeModel("gemini-2.5-flash")
+    clave = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    with _LOCK_CLIENTES:
+        clientes = _CLIENTES.get(clave)
+        if clientes is None:
+            clientes = _CLIENTES[clave] = _ClientManager()
+            clientes.configure(api_key=key)
+            # Se crean aquí, bajo el lock, para no duplicarlos entre hilos
+            clientes.get_default_client("generative")
+        return clientes
 
 
-def _reglas_como_texto() -> str:
-    reglas = obtener_reglas()
-    items: List[tuple[int, str, str, str]] = []
+def _con_cliente(modelo: Any, api_key: str | None) -> Any:
+    modelo._client = _clientes(api_key).get_default_client("generative")
+    return modelo
+
+
+def _configurar_modelo(api_key: str | None = None) -> Any:
+    if IA_PROVEEDOR == "stub":
+        return ModeloStub()
+    return _con_cliente(genai.GenerativeModel(IA_MODELO), api_key)
+
+
+def _reglas_como_texto(reglas: List[tuple]) -> str:
+    items: List[tuple[int, str, str]] = []
     for _, clave, instruccion, prioridad, tipo, etiquetas, es_principal, auto_enviar in reglas:
         tipo_norm = (tipo or "negocio").lower()
         # Solo incluir reglas de tipo 'negocio' aquí
@@ -40,12 +83,11 @@ def _reglas_como_texto() -> str:
     return texto if texto else "Sin reglas de negocio específicas."
 
 
-def _tareas_politicas_como_texto() -> tuple[str, str]:
-    reglas = obtener_reglas()
+def _tareas_politicas_como_texto(reglas: List[tuple]) -> tuple[str, str]:
     tareas_items: List[tuple[int, str]] = []
     politicas_items: List[tuple[int, str]] = []
     
-    for _, clave, instruccion, prioridad, tipo, etiquetas, _ in reglas:
+    for _, clave, instruccion, prioridad, tipo, etiquetas, _, _ in reglas:
         tipo_norm = (tipo or "").lower()
         try:
             prio_val = int(prioridad)
@@ -72,8 +114,7 @@ def _tareas_politicas_como_texto() -> tuple[str, str]:
     )
 
 
-def _plantillas_como_texto() -> str:
-    plantillas = obtener_respuestas()
+def _plantillas_como_texto(plantillas: List[tuple]) -> str:
     partes: List[str] = []
     for pid, titulo, contenido in plantillas:
         partes.append(f"ID {pid} | TITULO: {titulo}\nTEXTO_COMPLETO:\n{contenido}\n---")
@@ -82,6 +123,408 @@ def _plantillas_como_texto() -> str:
     return "\n".join(partes)
 
 
+# ============================================
+# CONTEXTO DE PROMPT COMPILADO
+# ============================================
+# Reglas, políticas, tareas y plantillas ya formateadas. Como antes, el prompt
+# usa todas las reglas y plantillas de la base (sin filtrar por usuario), así
+# que hay un solo contexto: se compila una vez (dos consultas a la BD) y se
+# reutiliza en cada correo hasta que /learn, /respuestas o un borrado lo
+# invalida, sea cual sea el dueño de la fila.
+
+_LOCK_CONTEXTO = threading.Lock()
+_CONTEXTO: Dict[str, str] | None = None
+# Sube en cada invalidación: un contexto leído antes de ella no se guarda
+_GENERACION_CONTEXTO = 0
+
+
+def compilar_contexto() -> Dict[str, str]:
+    """Textos de reglas, políticas, tareas y plantillas, desde la caché si están."""
+    global _CONTEXTO
+    with _LOCK_CONTEXTO:
+        if _CONTEXTO is not None:
+            return _CONTEXTO
+        generacion = _GENERACION_CONTEXTO
+
+    reglas = obtener_reglas()
+    plantillas = obtener_respuestas()
+    tareas_texto, politicas_texto = _tareas_politicas_como_texto(reglas)
+    contexto = {
+        "reglas": _reglas_como_texto(reglas),
+        "politicas": politicas_texto,
+        "tareas": tareas_texto,
+        "plantillas": _plantillas_como_texto(plantillas),
+    }
+    print(f"🧠 [IA] Contexto compilado: {len(reglas)} reglas, {len(plantillas)} plantillas")
+
+    with _LOCK_CONTEXTO:
+        if generacion == _GENERACION_CONTEXTO:
+            _CONTEXTO = contexto
+    return contexto
+
+
+def invalidar_contexto() -> None:
+    """Descarta el contexto compilado; la próxima clasificación lo vuelve a leer."""
+    global _CONTEXTO, _GENERACION_CONTEXTO
+    with _LOCK_CONTEXTO:
+        _CONTEXTO = None
+        _GENERACION_CONTEXTO += 1
+
+
+# ============================================
+# CACHÉ DE CONTEXTO DE GEMINI
+# ============================================
+# El prefijo estático del prompt (rol, reglas, plantillas, instrucciones) se
+# sube una vez como CachedContent y cada correo envía solo su sufijo. La
+# clave es el hash del prefijo, así que cambiar una regla crea otra caché.
+
+# KYBER_IA_CACHE_PROMPT=0 desactiva la caché y envía siempre el prompt completo.
+CACHE_PROMPT_ACTIVO = os.environ.get("KYBER_IA_CACHE_PROMPT", "1") == "1"
+# Vida (segundos) de cada caché en Gemini; se renueva cuando le queda menos de un cuarto.
+CACHE_PROMPT_TTL = int(os.environ.get("KYBER_IA_CACHE_TTL", "3600"))
+# Gemini exige un mínimo de tokens para cachear; con prefijos más cortos no se intenta.
+CACHE_PROMPT_MIN_CARACTERES = int(os.environ.get("KYBER_IA_CACHE_MIN_CARACTERES", "4000"))
+
+# Protege los diccionarios; la creación y renovación usan el lock de su clave
+_LOCK_CACHE_PROMPT = threading.Lock()
+_LOCKS_CACHE_PROMPT: Dict[str, threading.Lock] = {}
+# {clave: (CachedContent | None, expira)}; None recuerda que no se pudo crear
+_CACHES_PROMPT: Dict[str, tuple[Any, float]] = {}
+_CONTADORES_CACHE = {"creadas": 0, "renovadas": 0, "aciertos": 0, "fallos": 0}
+
+
+# ============================================
+# LÍMITE DE CUOTA POR API KEY
+# ============================================
+# Cubeta de tokens por API key para peticiones y tokens por minuto, de modo
+# que los hilos de clasificación no se adelanten a la cuota de Gemini.
+
+# Peticiones y tokens (estimados) por minuto permitidos por API key; 0 = sin límite,
+# que es lo predeterminado: el tope depende del plan de cada cuenta de Gemini.
+IA_RPM = int(os.environ.get("KYBER_IA_RPM", "0"))
+IA_TPM = int(os.environ.get("KYBER_IA_TPM", "0"))
+
+
+class LimitadorCuota:
+    """Dos cubetas (peticiones y tokens) que se recargan de forma continua."""
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self._peticiones = float(rpm)
+        self._tokens = float(tpm)
+        self._ultimo = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._lock = threading.Lock()
+
+    def _recargar(self, ahora: float) -> None:
+        transcurrido = ahora - self._ultimo
+        self._ultimo = ahora
+        if self.rpm:
+            self._peticiones = min(self.rpm, self._peticiones + transcurrido * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + transcurrido * self.tpm / 60)
+
+    def adquirir(self, tokens: int) -> float:
+        """Bloquea hasta que haya cupo para una petición de ``tokens``; devuelve los segundos esperados."""
+        # Una petición mayor que la cubeta entera solo puede esperar a que se llene
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        esperado = 0.0
+        while True:
+            with self._lock:
+                self._recargar(time.monotonic())
+                falta_peticion = (1 - self._peticiones) * 60 / self.rpm if self.rpm and self._peticiones < 1 else 0.0
+                falta_tokens = (tokens - self._tokens) * 60 / self.tpm if self.tpm and self._tokens < tokens else 0.0
+                espera = max(falta_peticion, falta_tokens, self._pausa_hasta - time.monotonic())
+                if espera <= 0:
+                    if self.rpm:
+                        self._peticiones -= 1
+                    self._tokens -= tokens
+                    return esperado
+            time.sleep(min(espera, 1.0))
+            esperado += min(espera, 1.0)
+
+    def pausar(self, segundos: float) -> None:
+        """Detiene todas las peticiones de la key (p. ej. tras un 429 con retry-after)."""
+        with self._lock:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+
+
+_LOCK_LIMITADORES = threading.Lock()
+_LIMITADORES: Dict[str, LimitadorCuota] = {}
+
+
+def _limitador(api_key: str | None) -> LimitadorCuota:
+    clave = hashlib.sha256((api_key or os.environ.get("GEMINI_API_KEY") or "").encode("utf-8")).hexdigest()
+    with _LOCK_LIMITADORES:
+        limitador = _LIMITADORES.get(clave)
+        if limitador is None:
+            limitador = _LIMITADORES[clave] = LimitadorCuota(IA_RPM, IA_TPM)
+        return limitador
+
+
+def _es_error_cuota(e: Exception) -> bool:
+    texto = str(e).lower()
+    return "429" in texto or "quota" in texto or "exhausted" in texto
+
+
+# ============================================
+# REINTENTOS ANTE 429
+# ============================================
+
+# Reintentos de una llamada que recibe 429 antes de darla por agotada.
+IA_REINTENTOS = int(os.environ.get("KYBER_IA_REINTENTOS", "3"))
+# Espera base (segundos) del backoff exponencial cuando Gemini no sugiere una.
+IA_REINTENTO_BASE = float(os.environ.get("KYBER_IA_REINTENTO_BASE", "2"))
+# Si la espera sugerida supera esto, no se espera: el escaneo difiere los correos.
+IA_REINTENTO_MAX_ESPERA = float(os.environ.get("KYBER_IA_REINTENTO_MAX_ESPERA", "60"))
+
+
+class CuotaAgotada(RuntimeError):
+    """429 que persiste tras los reintentos; ``reintentar_en`` (segundos) es cuándo volver a probar."""
+
+    def __init__(self, error: Exception, reintentar_en: float) -> None:
+        super().__init__(f"429 cuota de IA agotada (reintentar en {reintentar_en:.0f} s): {error}")
+        self.reintentar_en = reintentar_en
+
+
+def segundos_reintento(e: Exception) -> float | None:
+    """Espera que sugiere el error de Gemini ("retry in 37s", retry_delay, Retry-After), si la trae."""
+    texto = str(e)
+    patrones = (
+        r"retry in ([\d.]+)\s*s",
+        r"retry_delay\s*\{\s*seconds:\s*(\d+)",
+        r'"retryDelay":\s*"([\d.]+)s"',
+        r"retry-after:?\s*([\d.]+)",
+    )
+    for patron in patrones:
+        m = re.search(patron, texto, re.IGNORECASE)
+        if m:
+            return float(m.group(1))
+    return None
+
+
+def _llamar_con_cuota(api_key: str | None, tokens: int, llamada: Any) -> Any:
+    """Ejecuta ``llamada`` dentro de la cuota local de la key, reintentando los 429 con backoff y jitter."""
+    limitador = _limitador(api_key)
+    intento = 0
+    while True:
+        esperado = limitador.adquirir(tokens)
+        if esperado >= 1:
+            print(f"⏳ [IA] Límite de cuota local: {esperado:.1f} s de espera")
+        try:
+            return llamada()
+        except Exception as e:
+            if not _es_error_cuota(e) or isinstance(e, CuotaAgotada):
+                raise
+            pista = segundos_reintento(e)
+            espera = (pista if pista is not None else IA_REINTENTO_BASE * 2 ** intento) * random.uniform(1.0, 1.25)
+            # La cuota diaria no se recupera en segundos: sin pista, se vuelve a probar en una hora
+            diaria = "perday" in str(e).lower().replace("_", "")
+            if diaria and pista is None:
+                espera = 3600.0
+            if diaria or intento >= IA_REINTENTOS or espera > IA_REINTENTO_MAX_ESPERA:
+                raise CuotaAgotada(e, espera) from e
+            intento += 1
+            print(f"⏳ [IA] Cuota alcanzada (429), reintento {intento}/{IA_REINTENTOS} en {espera:.1f} s")
+            # La pausa frena también a los demás hilos que usan la misma key
+            limitador.pausar(espera)
+
+
+def _clave_cache_prompt(prefijo: str, api_key: str | None) -> str:
+    # Las cachés pertenecen al proyecto de la API key, así que entra en la clave
+    return hashlib.sha256(f"{IA_PROVEEDOR}\0{IA_MODELO}\0{api_key or ''}\0{prefijo}".encode("utf-8")).hexdigest()
+
+
+def _crear_cache_prompt(prefijo: str, clave: str, api_key: str | None = None) -> Any:
+    if IA_PROVEEDOR == "stub":
+        return CacheStub(prefijo, clave)
+    # Como ``CachedContent.create``, pero con el cliente de la key y no el global
+    peticion = caching.CachedContent._prepare_create_request(
+        model=IA_MODELO,
+        display_name=f"kyber-{clave[:16]}",
+        contents=[prefijo],
+        ttl=timedelta(seconds=CACHE_PROMPT_TTL),
+    )
+    respuesta = _clientes(api_key).get_default_client("cache").create_cached_content(peticion)
+    return caching.CachedContent._from_obj(respuesta)
+
+
+def _renovar_cache_prompt(cache: Any, api_key: str | None = None) -> None:
+    ttl = timedelta(seconds=CACHE_PROMPT_TTL)
+    if IA_PROVEEDOR == "stub":
+        cache.update(ttl=ttl)
+        return
+    # Como ``CachedContent.update``, con el cliente de la key
+    peticion = protos.UpdateCachedContentRequest(
+        cached_content=protos.CachedContent(name=cache.name, ttl=ttl),
+        update_mask=field_mask_pb2.FieldMask(paths=["ttl"]),
+    )
+    cache._update(_clientes(api_key).get_default_client("cache").update_cached_content(peticion))
+
+
+def _modelo_desde_cache(cache: Any, api_key: str | None = None) -> Any:
+    if IA_PROVEEDOR == "stub":
+        return ModeloStub(prefijo=cache.prefijo)
+    return _con_cliente(genai.GenerativeModel.from_cached_content(cached_content=cache), api_key)
+
+
+def _lock_cache_prompt(clave: str) -> threading.Lock:
+    with _LOCK_CACHE_PROMPT:
+        return _LOCKS_CACHE_PROMPT.setdefault(clave, threading.Lock())
+
+
+def _cache_para_prefijo(prefijo: str, api_key: str | None) -> Any | None:
+    """CachedContent vigente del prefijo, creándolo o renovándolo; None si hay que enviar el prompt completo."""
+    if not CACHE_PROMPT_ACTIVO or len(prefijo) < CACHE_PROMPT_MIN_CARACTERES:
+        return None
+    clave = _clave_cache_prompt(prefijo, api_key)
+    # Crear o renovar es una llamada de red: solo espera quien pide el mismo prefijo
+    with _lock_cache_prompt(clave):
+        ahora = time.time()
+        with _LOCK_CACHE_PROMPT:
+            cache, expira = _CACHES_PROMPT.get(clave, (None, 0.0))
+            if expira > ahora:
+                if cache is None:
+                    # Falló hace poco: no se reintenta hasta que venza
+                    return None
+                if expira - ahora > CACHE_PROMPT_TTL / 4:
+                    _CONTADORES_CACHE["aciertos"] += 1
+                    return cache
+            else:
+                cache = None
+            for vencida in [k for k, (_, exp) in _CACHES_PROMPT.items() if exp <= ahora]:
+                del _CACHES_PROMPT[vencida]
+                if vencida != clave:
+                    _LOCKS_CACHE_PROMPT.pop(vencida, None)
+
+        if cache is not None:
+            try:
+                _renovar_cache_prompt(cache, api_key)
+            except Exception as e:
+                print(f"⚠️  [IA] No se pudo renovar la caché de contexto, se crea otra: {e}")
+            else:
+                with _LOCK_CACHE_PROMPT:
+                    _CACHES_PROMPT[clave] = (cache, ahora + CACHE_PROMPT_TTL)
+                    _CONTADORES_CACHE["renovadas"] += 1
+                return cache
+
+        try:
+            cache = _crear_cache_prompt(prefijo, clave, api_key)
+        except Exception as e:
+            print(f"⚠️  [IA] Caché de contexto no disponible, se envía el prompt completo: {e}")
+            with _LOCK_CACHE_PROMPT:
+                _CONTADORES_CACHE["fallos"] += 1
+                if not _es_error_cuota(e):
+                    _CACHES_PROMPT[clave] = (None, ahora + CACHE_PROMPT_TTL)
+            return None
+        with _LOCK_CACHE_PROMPT:
+            _CACHES_PROMPT[clave] = (cache, ahora + CACHE_PROMPT_TTL)
+            _CONTADORES_CACHE["creadas"] += 1
+    print(f"🧠 [IA] Caché de contexto creada ({len(prefijo)} caracteres, TTL {CACHE_PROMPT_TTL} s)")
+    return cache
+
+
+def _descartar_cache_prompt(prefijo: str, api_key: str | None) -> None:
+    with _LOCK_CACHE_PROMPT:
+        _CACHES_PROMPT.pop(_clave_cache_prompt(prefijo, api_key), None)
+
+
+def _generar_con_prefijo(
+    prefijo: str,
+    sufijo: str,
+    api_key: str | None = None,
+    imagen_mime: str | None = None,
+    imagen_datos: bytes | None = None,
+) -> Any:
+    """generate_content con solo el sufijo si el prefijo está en caché; si no, con el prompt completo."""
+    modelo = _configurar_modelo(api_key)
+    imagen = [{"mime_type": imagen_mime, "data": imagen_datos}] if imagen_mime and imagen_datos else []
+    # Los tokens en caché también cuentan para la cuota, así que se estima el prompt entero
+    tokens = _estimar_tokens(prefijo + sufijo)
+    cache = _cache_para_prefijo(prefijo, api_key)
+    if cache is not None:
+        modelo_cache = _modelo_desde_cache(cache, api_key)
+        try:
+            return _llamar_con_cuota(api_key, tokens, lambda: modelo_cache.generate_content([sufijo, *imagen] if imagen else sufijo))
+        except Exception as e:
+            if _es_error_cuota(e):
+                raise
+            # La caché pudo vencer o borrarse en el servidor: se descarta y se envía completo
+            print(f"⚠️  [IA] Falló la llamada con caché de contexto, se reintenta sin ella: {e}")
+            _descartar_cache_prompt(prefijo, api_key)
+    prompt = prefijo + sufijo
+    return _llamar_con_cuota(api_key, tokens, lambda: modelo.generate_content([prompt, *imagen] if imagen else prompt))
+
+
+def estadisticas_cache_prompt() -> Dict[str, Any]:
+    """Contadores de la caché de contexto, para /metrics."""
+    with _LOCK_CACHE_PROMPT:
+        datos: Dict[str, Any] = dict(_CONTADORES_CACHE)
+        datos["vigentes"] = sum(1 for cache, _ in _CACHES_PROMPT.values() if cache is not None)
+    datos["activa"] = CACHE_PROMPT_ACTIVO
+    datos["proveedor"] = IA_PROVEEDOR
+    return datos
+
+
+# ============================================
+# PROVEEDOR STUB (SIN RED)
+# ============================================
+
+class _RespuestaStub:
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class CacheStub:
+    """Imita un CachedContent guardando el prefijo en memoria."""
+
+    def __init__(self, prefijo: str, clave: str) -> None:
+        self.prefijo = prefijo
+        self.name = f"cachedContents/stub-{clave[:16]}"
+
+    def update(self, *, ttl: Any = None, expire_time: Any = None) -> None:
+        pass
+
+
+def _clasificacion_stub(texto: str) -> Dict[str, Any]:
+    # Determinista por asunto, con la misma forma que devuelve Gemini
+    m = re.search(r"- Asunto: (.*)", texto)
+    n = int(hashlib.sha1((m.group(1) if m else "").encode("utf-8")).hexdigest(), 16) % 10
+    if n < 3:
+        return {"accion": "NADA", "idioma": "es", "borrador": "", "resumen_es": "Publicidad", "plantilla_id": 0, "categoria": "ANUNCIO", "auto_enviar": False}
+    if n < 6:
+        return {"accion": "BORRADOR", "idioma": "es", "borrador": "Gracias por escribir, lo revisamos.", "resumen_es": "Consulta", "plantilla_id": 0, "categoria": "CONSULTA", "auto_enviar": False}
+    return {"accion": "NADA", "idioma": "es", "borrador": "", "resumen_es": "Informativo", "plantilla_id": 0, "categoria": "GENERAL", "auto_enviar": False}
+
+
+class ModeloStub:
+    """Modelo sin red para KYBER_IA_PROVEEDOR=stub.
+
+    Clasifica por hash del asunto y anota en ``enviados`` el texto que recibe
+    cada llamada de esta instancia, para comprobar qué parte del prompt viaja
+    realmente.
+    """
+
+    def __init__(self, prefijo: str = "") -> None:
+        self.prefijo = prefijo
+        self.enviados: List[str] = []
+
+    def generate_content(self, contenido: Any) -> _RespuestaStub:
+        partes = contenido if isinstance(contenido, list) else [contenido]
+        texto = "".join(p for p in partes if isinstance(p, str))
+        self.enviados.append(texto)
+        if "=== CORREO " in texto:
+            bloques = re.split(r"=== CORREO \d+ ===", texto)[1:]
+            lote = [{"indice": n, **_clasificacion_stub(b)} for n, b in enumerate(bloques, start=1)]
+            return _RespuestaStub(json.dumps(lote, ensure_ascii=False))
+        if "FORMATO JSON DE SALIDA" not in self.prefijo + texto:
+            # Traducciones y sugerencias: devuelve la última línea tal cual
+            lineas = texto.strip().splitlines()
+            return _RespuestaStub(lineas[-1] if lineas else "")
+        return _RespuestaStub(json.dumps(_clasificacion_stub(texto), ensure_ascii=False))
+
+
 def traducir_texto(texto: str, direccion: str, api_key: str | None = None) -> str:
     modelo = _configurar_modelo(api_key)
     dir_norm = (direccion or "").lower()
@@ -95,8 +538,6 @@ def traducir_texto(texto: str, direccion: str, api_key: str | None = None) -> st
 
 
 def _parse_json(texto: str) -> Dict[str, str]:
-    import json
-
     try:
         return json.loads(texto)
     except Exception:
@@ -122,32 +563,9 @@ def _parse_json(texto: str) -> Dict[str, str]:
         }
 
 
-def procesar_correo_con_ia(
-    remitente: str,
-    asunto: str,
-    cuerpo: str,
-    imagen_mime: str | None = None,
-    imagen_datos: bytes | None = None,
-    historial_texto: str | None = None,
-    api_key: str | None = None,
-    contexto_negocio: str | None = None,
-) -> Dict[str, str]:
-    """Procesa un correo electrónico utilizando IA para clasificarlo y generar borradores."""
-    modelo = _configurar_modelo(api_key)
-    reglas_negocio_texto = _reglas_como_texto()
-    plantillas_texto = _plantillas_como_texto()
-    tareas_texto, politicas_texto = _tareas_politicas_como_texto()
-
-    # Definir el contexto del negocio (Rol del Agente)
-    rol_agente = contexto_negocio if contexto_negocio and contexto_negocio.strip() else "Eres un asistente virtual experto en gestión de correos."
-
-    cuerpo = re.sub(r'<[^>]+>', '', cuerpo)
-    cuerpo = re.sub(r'https?://\S+', '', cuerpo)
-    cuerpo = re.sub(r'\s+', ' ', cuerpo).strip()
-    cuerpo = cuerpo[:3000] # Limitar a 3000 caracteres para tener más contexto
-
-    # Prompt GENÉRICO y ORDENADO
-    prompt = f"""
+def _prefijo_estatico(rol_agente: str, contexto: Dict[str, str]) -> str:
+    """Parte del prompt que no cambia entre correos del mismo usuario."""
+    return f"""
     ROL Y CONTEXTO DEL NEGOCIO:
     {rol_agente}
 
@@ -156,27 +574,18 @@ def procesar_correo_con_ia(
 
     --- SECCIÓN 1: REGLAS DE NEGOCIO (Ejecutar en orden de prioridad ascendente: 1, 2, 3...) ---
     Estas reglas definen QUÉ hacer con el correo.
-    {reglas_negocio_texto}
+    {contexto["reglas"]}
 
     --- SECCIÓN 2: POLÍTICAS (Ejecutar en orden de prioridad ascendente: 1, 2, 3...) ---
     Estas son normas obligatorias que limitan o guían tu comportamiento.
-    {politicas_texto}
+    {contexto["politicas"]}
 
     --- SECCIÓN 3: TAREAS (Ejecutar en orden de prioridad ascendente: 1, 2, 3...) ---
     Acciones específicas que debes realizar durante el análisis.
-    {tareas_texto}
+    {contexto["tareas"]}
 
     --- SECCIÓN 4: PLANTILLAS DISPONIBLES ---
-    {plantillas_texto}
-
-    --- CORREO RECIBIDO ---
-    - Remitente: {remitente}
-    - Asunto: {asunto}
-    - Cuerpo:
-    {cuerpo}
-
-    HISTORIAL:
-    {historial_texto if historial_texto else "Sin historial disponible"}
+    {contexto["plantillas"]}
 
     INSTRUCCIONES DE PROCESAMIENTO:
     1. ANALIZA si el correo es "ANUNCIO" (Spam, Marketing, Newsletter).
@@ -211,22 +620,73 @@ def procesar_correo_con_ia(
     - Solo usa "GENERAL" si realmente no puedes identificar un tema específico
     - Ejemplos de categorías que podrías crear: PRECIO, DISPONIBILIDAD, GARANTIA, ENVIO, DEVOLUCION, INSTALACION, CAPACITACION, MANTENIMIENTO, URGENTE, etc.
     """
-    
-    if imagen_mime and imagen_datos:
-        respuesta = modelo.generate_content(
-            [
-                prompt,
-                {
-                    "mime_type": imagen_mime,
-                    "data": imagen_datos,
-                },
-            ]
-        )
-    else:
-        respuesta = modelo.generate_content(prompt)
+
+
+def _limpiar_cuerpo(cuerpo: str) -> str:
+    cuerpo = re.sub(r'<[^>]+>', '', cuerpo or "")
+    cuerpo = re.sub(r'https?://\S+', '', cuerpo)
+    cuerpo = re.sub(r'\s+', ' ', cuerpo).strip()
+    return cuerpo[:3000] # Limitar a 3000 caracteres para tener más contexto
+
+
+def _bloque_correo(remitente: str, asunto: str, cuerpo: str, historial_texto: str | None) -> str:
+    return f"""
+    - Remitente: {remitente}
+    - Asunto: {asunto}
+    - Cuerpo:
+    {_limpiar_cuerpo(cuerpo)}
+
+    HISTORIAL:
+    {historial_texto if historial_texto else "Sin historial disponible"}
+    """
+
+
+def _sufijo_correo(remitente: str, asunto: str, cuerpo: str, historial_texto: str | None) -> str:
+    """Parte del prompt propia de cada correo."""
+    return f"""
+    --- CORREO RECIBIDO ---{_bloque_correo(remitente, asunto, cuerpo, historial_texto)}
+    Procesa este correo según las instrucciones anteriores y responde SOLO con el JSON de salida.
+    """
+
+
+def _sufijo_lote(bloques: List[str]) -> str:
+    """Varios correos numerados en una sola llamada; se pide un array JSON."""
+    correos = "".join(f"\n    === CORREO {n} ==={bloque}" for n, bloque in enumerate(bloques, start=1))
+    return f"""
+    --- CORREOS RECIBIDOS (LOTE DE {len(bloques)}) ---{correos}
+    Procesa CADA correo por separado según las instrucciones anteriores, como si fuera el único.
+    Responde SOLO con un array JSON de {len(bloques)} objetos, uno por correo y en el mismo orden.
+    Cada objeto lleva "indice" (el número del CORREO) y los campos del FORMATO JSON DE SALIDA.
+    """
+
+
+def procesar_correo_con_ia(
+    remitente: str,
+    asunto: str,
+    cuerpo: str,
+    imagen_mime: str | None = None,
+    imagen_datos: bytes | None = None,
+    historial_texto: str | None = None,
+    api_key: str | None = None,
+    contexto_negocio: str | None = None,
+) -> Dict[str, str]:
+    """Procesa un correo electrónico utilizando IA para clasificarlo y generar borradores."""
+    contexto = compilar_contexto()
+
+    # Definir el contexto del negocio (Rol del Agente)
+    rol_agente = contexto_negocio if contexto_negocio and contexto_negocio.strip() else "Eres un asistente virtual experto en gestión de correos."
+
+    # El prefijo (rol, reglas, plantillas, instrucciones) va en caché de contexto
+    # cuando se puede; por correo solo se envía el sufijo.
+    prefijo = _prefijo_estatico(rol_agente, contexto)
+    sufijo = _sufijo_correo(remitente, asunto, cuerpo, historial_texto)
+    respuesta = _generar_con_prefijo(prefijo, sufijo, api_key, imagen_mime, imagen_datos)
     texto = respuesta.text or ""
-    datos = _parse_json(texto)
+    return _normalizar_resultado(_parse_json(texto))
 
+
+def _normalizar_resultado(datos: Dict[str, Any]) -> Dict[str, Any]:
+    """Valida y normaliza el JSON de la IA para un correo."""
     accion = str(datos.get("accion", "NADA")).upper()
     if accion not in {"BORRADOR", "NADA"}:
         accion = "NADA"
@@ -264,6 +724,155 @@ def procesar_correo_con_ia(
     return resultado
 
 
+# ============================================
+# CLASIFICACIÓN EN LOTE
+# ============================================
+# Varios correos comparten el prefijo y una sola llamada; los elementos que
+# no llegan bien en el array se reintentan con procesar_correo_con_ia.
+
+# Máximo de correos por llamada; 1 desactiva el modo lote.
+IA_LOTE_MAX = int(os.environ.get("KYBER_IA_LOTE", "8"))
+# Tokens estimados de los correos de un lote (sin contar el prefijo).
+IA_LOTE_TOKENS = int(os.environ.get("KYBER_IA_LOTE_TOKENS", "12000"))
+# Llamadas simultáneas a la IA dentro de un chunk del escaneo.
+IA_CONCURRENCIA = int(os.environ.get("KYBER_IA_CONCURRENCIA", "4"))
+
+
+def _estimar_tokens(texto: str) -> int:
+    # Aproximación de ~4 caracteres por token, suficiente para acotar el lote
+    return len(texto) // 4 + 1
+
+
+def _armar_lotes(bloques: List[str], max_lote: int, max_tokens: int) -> List[List[int]]:
+    lotes: List[List[int]] = []
+    actual: List[int] = []
+    tokens = 0
+    for i, bloque in enumerate(bloques):
+        costo = _estimar_tokens(bloque)
+        if actual and (len(actual) >= max_lote or tokens + costo > max_tokens):
+            lotes.append(actual)
+            actual, tokens = [], 0
+        actual.append(i)
+        tokens += costo
+    if actual:
+        lotes.append(actual)
+    return lotes
+
+
+def _parse_json_lista(texto: str) -> List[Any] | None:
+    try:
+        datos = json.loads(texto)
+    except Exception:
+        m = re.search(r"\[[\s\S]*\]", texto or "")
+        if not m:
+            return None
+        try:
+            datos = json.loads(m.group(0))
+        except Exception:
+            return None
+    if isinstance(datos, dict):
+        # Algunos modelos envuelven el array: {"resultados": [...]}
+        datos = next((v for v in datos.values() if isinstance(v, list)), None)
+    return datos if isinstance(datos, list) else None
+
+
+def _resultados_de_lote(texto: str, cantidad: int) -> Dict[int, Dict[str, Any]]:
+    """{posición en el lote: resultado} con los elementos válidos del array."""
+    elementos = _parse_json_lista(texto) or []
+    resultados: Dict[int, Dict[str, Any]] = {}
+    for posicion, elemento in enumerate(elementos):
+        if not isinstance(elemento, dict) or "accion" not in elemento:
+            continue
+        try:
+            indice = int(elemento.get("indice", posicion + 1)) - 1
+        except Exception:
+            continue
+        if 0 <= indice < cantidad and indice not in resultados:
+            resultados[indice] = _normalizar_resultado(elemento)
+    return resultados
+
+
+def clasificar_correos_con_ia(
+    correos: List[Dict[str, Any]],
+    api_key: str | None = None,
+    contexto_negocio: str | None = None,
+    max_lote: int | None = None,
+    concurrencia: int | None = None,
+) -> Iterator[tuple[int, Dict[str, Any]]]:
+    """Clasifica varios correos en lotes y produce ``(índice, resultado)`` a medida que llegan.
+
+    Cada correo es un dict con remitente, asunto, cuerpo y opcionalmente
+    imagen_mime, imagen_datos e historial_texto. Los lotes (y los correos que
+    van solos: con imagen o mal interpretados en su lote) se reparten entre
+    hasta ``concurrencia`` hilos, así que el orden de llegada no es el de
+    entrada. Un error de cuota se propaga tal cual; lo ya producido sigue
+    siendo válido.
+    """
+    max_lote = max_lote or IA_LOTE_MAX
+    concurrencia = max(1, concurrencia or IA_CONCURRENCIA)
+    con_imagen = {i for i, c in enumerate(correos) if c.get("imagen_mime") and c.get("imagen_datos")}
+    en_lote = [i for i in range(len(correos)) if i not in con_imagen]
+    if max_lote <= 1 or len(en_lote) <= 1:
+        en_lote = []
+
+    def _individual(i: int) -> Dict[str, Any]:
+        c = correos[i]
+        return procesar_correo_con_ia(
+            remitente=c["remitente"],
+            asunto=c["asunto"],
+            cuerpo=c["cuerpo"],
+            imagen_mime=c.get("imagen_mime"),
+            imagen_datos=c.get("imagen_datos"),
+            historial_texto=c.get("historial_texto"),
+            api_key=api_key,
+            contexto_negocio=contexto_negocio,
+        )
+
+    # Cada tarea es una llamada: un lote de varios correos o uno solo
+    tareas: List[List[int]] = []
+    prefijo = ""
+    bloques: Dict[int, str] = {}
+    if en_lote:
+        contexto = compilar_contexto()
+        rol_agente = contexto_negocio if contexto_negocio and contexto_negocio.strip() else "Eres un asistente virtual experto en gestión de correos."
+        prefijo = _prefijo_estatico(rol_agente, contexto)
+        bloques = {
+            i: _bloque_correo(correos[i]["remitente"], correos[i]["asunto"], correos[i]["cuerpo"], correos[i].get("historial_texto"))
+            for i in en_lote
+        }
+        tareas = [[en_lote[j] for j in lote] for lote in _armar_lotes([bloques[i] for i in en_lote], max_lote, IA_LOTE_TOKENS)]
+    pendientes = set(en_lote)
+    tareas += [[i] for i in range(len(correos)) if i not in pendientes]
+
+    def _ejecutar(indices: List[int]) -> List[tuple[int, Dict[str, Any]]]:
+        if len(indices) == 1:
+            return [(indices[0], _individual(indices[0]))]
+        try:
+            respuesta = _generar_con_prefijo(prefijo, _sufijo_lote([bloques[i] for i in indices]), api_key)
+            resultados = _resultados_de_lote(respuesta.text or "", len(indices))
+        except Exception as e:
+            if _es_error_cuota(e):
+                raise
+            print(f"⚠️  [IA] Falló el lote de {len(indices)} correos, se procesan uno a uno: {e}")
+            resultados = {}
+        if len(resultados) < len(indices):
+            print(f"⚠️  [IA] Lote: {len(indices) - len(resultados)} de {len(indices)} respuestas no válidas, se reintentan una a una")
+        return [(i, resultados[posicion] if posicion in resultados else _individual(i)) for posicion, i in enumerate(indices)]
+
+    if concurrencia == 1 or len(tareas) <= 1:
+        for tarea in tareas:
+            yield from _ejecutar(tarea)
+        return
+
+    ejecutor = ThreadPoolExecutor(max_workers=min(concurrencia, len(tareas)), thread_name_prefix="kyber-ia")
+    try:
+        for futuro in as_completed([ejecutor.submit(_ejecutar, tarea) for tarea in tareas]):
+            yield from futuro.result()
+    finally:
+        # Ante un error (p. ej. cuota) no se lanzan las tareas que faltan
+        ejecutor.shutdown(wait=False, cancel_futures=True)
+
+
 def sugerir_clave_prioridad(instruccion: str, api_key: str | None = None) -> Dict[str, str]:
     modelo = _configurar_modelo(api_key)
     guia = """
@@ -0,0 +1,138 @@
+"""Almacén local de mensajes RFC822 direccionado por contenido.
+
+Cada mensaje se guarda en disco una sola vez, en la subcarpeta de su
+cuenta y con nombre derivado de su X-GM-MSGID, así el escaneo, el historial
+de hilos y la limpieza no vuelven a descargar los mismos bytes. Sin
+X-GM-MSGID no se guarda nada: el Message-ID lo elige el remitente. Se
+desaloja por antigüedad (último acceso) y por tamaño total.
+"""
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+
+# Carpeta del almacén; KYBER_ALMACEN=0 lo desactiva.
+ALMACEN_DIR = os.environ.get("KYBER_ALMACEN_DIR", "cache_mensajes")
+ALMACEN_ACTIVO = os.environ.get("KYBER_ALMACEN", "1") == "1" and bool(ALMACEN_DIR)
+# Tamaño máximo del almacén en disco.
+ALMACEN_MAX_BYTES = int(os.environ.get("KYBER_ALMACEN_MAX_BYTES", str(500 * 1024 * 1024)))
+# Días sin acceso tras los que un mensaje se desaloja.
+ALMACEN_MAX_DIAS = int(os.environ.get("KYBER_ALMACEN_MAX_DIAS", "30"))
+
+
+_LOCK = threading.Lock()
+_CONTADORES = {"aciertos": 0, "fallos": 0, "escrituras": 0, "desalojados": 0}
+# Tamaño estimado en disco; None hasta el primer recorrido de la carpeta.
+_bytes_estimados: int | None = None
+
+
+def clave_mensaje(gm_msgid: str = "") -> str:
+    """Clave estable ``g<X-GM-MSGID>``; "" si Gmail no lo informó."""
+    return f"g{gm_msgid}" if gm_msgid else ""
+
+
+def _ruta(cuenta: str, clave: str) -> str:
+    # Una carpeta por cuenta (un X-GM-MSGID solo es único dentro de ella) y
+    # un nivel de subcarpetas para no acumular miles de archivos juntos
+    carpeta = hashlib.sha256(cuenta.strip().lower().encode()).hexdigest()[:16]
+    sufijo = hashlib.sha1(clave.encode()).hexdigest()[:2]
+    return os.path.join(ALMACEN_DIR, carpeta, sufijo, f"{clave}.eml")
+
+
+def leer(cuenta: str, clave: str) -> bytes | None:
+    """Bytes del mensaje de ``cuenta`` si está en el almacén, o None."""
+    if not ALMACEN_ACTIVO or not cuenta or not clave:
+        return None
+    ruta = _ruta(cuenta, clave)
+    try:
+        with open(ruta, "rb") as archivo:
+            datos = archivo.read()
+        if not datos:
+            raise FileNotFoundError(ruta)
+        # El mtime marca el último acceso, que decide el desalojo
+        os.utime(ruta, None)
+    except (FileNotFoundError, ValueError, OSError):
+        with _LOCK:
+            _CONTADORES["fallos"] += 1
+        return None
+    with _LOCK:
+        _CONTADORES["aciertos"] += 1
+    return datos
+
+
+def guardar(cuenta: str, clave: str, datos: bytes) -> None:
+    """Guarda el mensaje de ``cuenta`` (escritura atómica); si ya estaba no hace nada."""
+    global _bytes_estimados
+    if not ALMACEN_ACTIVO or not cuenta or not clave or not datos:
+        return
+    ruta = _ruta(cuenta, clave)
+    if os.path.exists(ruta):
+        return
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporal, "wb") as archivo:
+            archivo.write(datos)
+        os.replace(temporal, ruta)
+    except OSError as e:
+        print(f"⚠️  [ALMACEN] No se pudo guardar {clave}: {e}")
+        return
+    with _LOCK:
+        _CONTADORES["escrituras"] += 1
+        if _bytes_estimados is not None:
+            _bytes_estimados += len(datos)
+        excedido = _bytes_estimados is None or _bytes_estimados > ALMACEN_MAX_BYTES
+    if excedido:
+        desalojar()
+
+
+def _archivos() -> List[Tuple[float, int, str]]:
+    archivos: List[Tuple[float, int, str]] = []
+    for raiz, _, nombres in os.walk(ALMACEN_DIR):
+        for nombre in nombres:
+            ruta = os.path.join(raiz, nombre)
+            try:
+                info = os.stat(ruta)
+            except OSError:
+                continue
+            archivos.append((info.st_mtime, info.st_size, ruta))
+    return archivos
+
+
+def desalojar() -> int:
+    """Borra lo no usado en ALMACEN_MAX_DIAS y, si aún sobra, lo menos usado hasta quedar bajo el tope."""
+    global _bytes_estimados
+    if not ALMACEN_ACTIVO or not os.path.isdir(ALMACEN_DIR):
+        return 0
+    limite_edad = time.time() - ALMACEN_MAX_DIAS * 86400
+    archivos = sorted(_archivos())
+    total = sum(tamano for _, tamano, _ in archivos)
+    borrados = 0
+    for mtime, tamano, ruta in archivos:
+        if mtime >= limite_edad and total <= ALMACEN_MAX_BYTES:
+            break
+        try:
+            os.remove(ruta)
+        except OSError:
+            continue
+        total -= tamano
+        borrados += 1
+    with _LOCK:
+        _bytes_estimados = total
+        _CONTADORES["desalojados"] += borrados
+    if borrados:
+        print(f"🧹 [ALMACEN] {borrados} mensajes desalojados ({total // 1024} KB en disco)")
+    return borrados
+
+
+def estadisticas() -> Dict[str, Any]:
+    """Contadores de aciertos/fallos del almacén, para /metrics."""
+    with _LOCK:
+        datos: Dict[str, Any] = dict(_CONTADORES)
+        datos["bytes"] = _bytes_estimados
+    consultas = datos["aciertos"] + datos["fallos"]
+    datos["tasa_aciertos"] = round(datos["aciertos"] / consultas, 3) if consultas else None
+    datos["activo"] = ALMACEN_ACTIVO
+    return datos
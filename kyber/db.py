@@ -1,8 +1,9 @@
 import sqlite3
 import os
+import json
 import psycopg2
 from typing import Any, Dict, List, Tuple
-from datetime import datetime
+from datetime import datetime, timedelta
 
 def _get_connection():
     """Obtiene una conexión a la base de datos (PostgreSQL o SQLite)."""
@@ -42,7 +43,8 @@ def crear_base_de_datos(nombre_bd: str = "kyber.db") -> None:
             agente_activo INTEGER DEFAULT 0,
             contexto_negocio TEXT,
             filtro_fecha_especifica INTEGER DEFAULT 0,
-            fecha_filtro TEXT
+            fecha_filtro TEXT,
+            scan_workers INTEGER DEFAULT 1
         )
     """)
     
@@ -57,6 +59,12 @@ def crear_base_de_datos(nombre_bd: str = "kyber.db") -> None:
     except Exception:
         pass  # Ya existe o error ignorado
 
+    # Migración: Agregar columna de conexiones paralelas de descarga si no existe
+    try:
+        cursor.execute("ALTER TABLE usuarios ADD COLUMN scan_workers INTEGER DEFAULT 1")
+    except Exception:
+        pass  # Ya existe o error ignorado
+
     print("DEBUG: [DB] Tabla usuarios verificada/creada.")
 
     # 2. Crear tabla reglas
@@ -198,6 +206,74 @@ def crear_base_de_datos(nombre_bd: str = "kyber.db") -> None:
     """)
     print("DEBUG: [DB] Tabla categorias_limpieza verificada/creada.")
 
+    # 11. Crear tabla sincronizacion_imap (checkpoint por usuario y buzón)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sincronizacion_imap (
+            id SERIAL PRIMARY KEY,
+            usuario_id INTEGER NOT NULL,
+            buzon TEXT NOT NULL,
+            uidvalidity BIGINT NOT NULL,
+            ultimo_uid BIGINT DEFAULT 0,
+            highestmodseq BIGINT DEFAULT 0,
+            actualizado_en TEXT NOT NULL,
+            UNIQUE(usuario_id, buzon)
+        )
+    """)
+
+    # Migración: Agregar columna highestmodseq (CONDSTORE) si no existe
+    try:
+        cursor.execute("ALTER TABLE sincronizacion_imap ADD COLUMN highestmodseq BIGINT DEFAULT 0")
+    except Exception:
+        pass
+    print("DEBUG: [DB] Tabla sincronizacion_imap verificada/creada.")
+
+    # 12. Crear tabla mensajes_procesados (decisión tomada por cada correo)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mensajes_procesados (
+            id SERIAL PRIMARY KEY,
+            usuario_id INTEGER NOT NULL,
+            clave TEXT NOT NULL,
+            accion TEXT,
+            categoria TEXT,
+            procesado_en TEXT NOT NULL,
+            UNIQUE(usuario_id, clave)
+        )
+    """)
+    print("DEBUG: [DB] Tabla mensajes_procesados verificada/creada.")
+
+    # 13. Crear tabla historial_hilos (caché del historial por X-GM-THRID)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS historial_hilos (
+            id SERIAL PRIMARY KEY,
+            cuenta TEXT NOT NULL,
+            thread_id TEXT NOT NULL,
+            buzon TEXT NOT NULL,
+            ultimo_uid BIGINT DEFAULT 0,
+            mensajes TEXT NOT NULL,
+            tamano INTEGER DEFAULT 0,
+            accedido_en TEXT NOT NULL,
+            UNIQUE(cuenta, thread_id)
+        )
+    """)
+    print("DEBUG: [DB] Tabla historial_hilos verificada/creada.")
+
+    # 14. Crear tabla correos_diferidos (pendientes de IA por cuota agotada)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS correos_diferidos (
+            id SERIAL PRIMARY KEY,
+            usuario_id INTEGER NOT NULL,
+            uidvalidity BIGINT NOT NULL,
+            uid TEXT NOT NULL,
+            clave TEXT,
+            motivo TEXT,
+            intentos INTEGER DEFAULT 1,
+            diferido_en TEXT NOT NULL,
+            reintentar_desde TEXT NOT NULL,
+            UNIQUE(usuario_id, uidvalidity, uid)
+        )
+    """)
+    print("DEBUG: [DB] Tabla correos_diferidos verificada/creada.")
+
     conn.close()
     print("DEBUG: [DB] Proceso de inicialización finalizado.")
 
@@ -447,7 +523,7 @@ def obtener_usuario_por_email(
     cursor = conn.cursor()
     p = _get_placeholder()
     cursor.execute(
-        f"SELECT id, email, password_hash, creado_en, gemini_api_key, gmail_user, gmail_password, scan_batch, scan_max, agente_activo, contexto_negocio, filtro_fecha_especifica, fecha_filtro FROM usuarios WHERE email = {p}",
+        f"SELECT id, email, password_hash, creado_en, gemini_api_key, gmail_user, gmail_password, scan_batch, scan_max, agente_activo, contexto_negocio, filtro_fecha_especifica, fecha_filtro, scan_workers FROM usuarios WHERE email = {p}",
         (email,),
     )
     fila = cursor.fetchone()
@@ -462,7 +538,7 @@ def obtener_usuario_por_id(
     cursor = conn.cursor()
     p = _get_placeholder()
     cursor.execute(
-        f"SELECT id, email, password_hash, creado_en, gemini_api_key, gmail_user, gmail_password, scan_batch, scan_max, agente_activo, contexto_negocio, filtro_fecha_especifica, fecha_filtro FROM usuarios WHERE id = {p}",
+        f"SELECT id, email, password_hash, creado_en, gemini_api_key, gmail_user, gmail_password, scan_batch, scan_max, agente_activo, contexto_negocio, filtro_fecha_especifica, fecha_filtro, scan_workers FROM usuarios WHERE id = {p}",
         (usuario_id,),
     )
     fila = cursor.fetchone()
@@ -474,7 +550,7 @@ def obtener_usuarios_agente_activo(nombre_bd: str = "kyber.db") -> List[Tuple[An
     conn = _get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        "SELECT id, email, password_hash, creado_en, gemini_api_key, gmail_user, gmail_password, scan_batch, scan_max, agente_activo, contexto_negocio, filtro_fecha_especifica, fecha_filtro FROM usuarios WHERE agente_activo = 1"
+        "SELECT id, email, password_hash, creado_en, gemini_api_key, gmail_user, gmail_password, scan_batch, scan_max, agente_activo, contexto_negocio, filtro_fecha_especifica, fecha_filtro, scan_workers FROM usuarios WHERE agente_activo = 1"
     )
     filas = cursor.fetchall()
     conn.close()
@@ -492,6 +568,7 @@ def actualizar_configuracion_usuario(
     contexto_negocio: str | None = None,
     filtro_fecha_especifica: int | None = None,
     fecha_filtro: str | None = None,
+    scan_workers: int | None = None,
     nombre_bd: str = "kyber.db",
 ) -> None:
     conn = _get_connection()
@@ -519,6 +596,9 @@ def actualizar_configuracion_usuario(
     if fecha_filtro is not None:
         updates.append(f"fecha_filtro = {p}")
         params.append(fecha_filtro)
+    if scan_workers is not None:
+        updates.append(f"scan_workers = {p}")
+        params.append(scan_workers)
         
     if not updates:
         print("DEBUG: [DB] No hay actualizaciones")
@@ -1231,3 +1311,274 @@ def eliminar_regla_organizacion(regla_id: int) -> None:
     conn.commit()
     print(f"DEBUG: [DB] Regla {regla_id} eliminada")
     conn.close()
+
+
+# ============================================
+# FUNCIONES PARA SINCRONIZACIÓN IMAP
+# ============================================
+
+def obtener_checkpoint_sync(usuario_id: int, buzon: str = "INBOX") -> Tuple[int, int, int] | None:
+    """Devuelve (uidvalidity, ultimo_uid, highestmodseq) del buzón, si existe."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    cursor.execute(
+        f"SELECT uidvalidity, ultimo_uid, highestmodseq FROM sincronizacion_imap WHERE usuario_id = {p} AND buzon = {p}",
+        (usuario_id, buzon)
+    )
+    fila = cursor.fetchone()
+    conn.close()
+    return (int(fila[0]), int(fila[1] or 0), int(fila[2] or 0)) if fila else None
+
+
+def guardar_checkpoint_sync(usuario_id: int, buzon: str, uidvalidity: int, ultimo_uid: int) -> None:
+    """Guarda el UIDVALIDITY y el UID más alto procesado del buzón.
+
+    Con el mismo UIDVALIDITY el checkpoint nunca retrocede (los correos
+    diferidos tienen UIDs por debajo); solo un UIDVALIDITY nuevo lo reinicia.
+    """
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    ahora = datetime.utcnow().isoformat()
+    cursor.execute(
+        f"""
+        INSERT INTO sincronizacion_imap (usuario_id, buzon, uidvalidity, ultimo_uid, actualizado_en)
+        VALUES ({p}, {p}, {p}, {p}, {p})
+        ON CONFLICT (usuario_id, buzon) DO UPDATE SET
+            ultimo_uid = CASE
+                WHEN sincronizacion_imap.uidvalidity = {p} AND sincronizacion_imap.ultimo_uid > {p} THEN sincronizacion_imap.ultimo_uid
+                ELSE {p}
+            END,
+            uidvalidity = {p},
+            actualizado_en = {p}
+        """,
+        (usuario_id, buzon, uidvalidity, ultimo_uid, ahora, uidvalidity, ultimo_uid, ultimo_uid, uidvalidity, ahora)
+    )
+    conn.commit()
+    conn.close()
+
+
+# ============================================
+# FUNCIONES PARA MENSAJES PROCESADOS
+# ============================================
+
+def obtener_mensajes_procesados(usuario_id: int, claves: List[str]) -> set[str]:
+    """Devuelve cuáles de las claves (X-GM-MSGID) ya tienen decisión."""
+    if not claves:
+        return set()
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    encontradas: set[str] = set()
+    # Por tramos, para no pasar el límite de parámetros de SQLite
+    for i in range(0, len(claves), 500):
+        tramo = claves[i : i + 500]
+        marcadores = ", ".join([p] * len(tramo))
+        cursor.execute(
+            f"SELECT clave FROM mensajes_procesados WHERE usuario_id = {p} AND clave IN ({marcadores})",
+            (usuario_id, *tramo)
+        )
+        encontradas.update(fila[0] for fila in cursor.fetchall())
+    conn.close()
+    return encontradas
+
+
+def registrar_mensaje_procesado(usuario_id: int, clave: str, accion: str, categoria: str = "") -> None:
+    """Guarda (o actualiza) la decisión tomada para un correo."""
+    if not clave:
+        return
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    ahora = datetime.utcnow().isoformat()
+    cursor.execute(
+        f"""
+        INSERT INTO mensajes_procesados (usuario_id, clave, accion, categoria, procesado_en)
+        VALUES ({p}, {p}, {p}, {p}, {p})
+        ON CONFLICT (usuario_id, clave) DO UPDATE SET accion = {p}, categoria = {p}, procesado_en = {p}
+        """,
+        (usuario_id, clave, accion, categoria, ahora, accion, categoria, ahora)
+    )
+    conn.commit()
+    conn.close()
+
+
+def purgar_mensajes_procesados(usuario_id: int, dias: int) -> int:
+    """Borra las decisiones de hace más de ``dias`` días; devuelve cuántas."""
+    if dias <= 0:
+        return 0
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    limite = (datetime.utcnow() - timedelta(days=dias)).isoformat()
+    cursor.execute(
+        f"DELETE FROM mensajes_procesados WHERE usuario_id = {p} AND procesado_en < {p}",
+        (usuario_id, limite)
+    )
+    eliminados = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return eliminados
+
+
+def guardar_modseq_sync(usuario_id: int, buzon: str, uidvalidity: int, highestmodseq: int) -> None:
+    """Guarda el MODSEQ más alto visto; si el UIDVALIDITY guardado es otro, no toca nada."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    ahora = datetime.utcnow().isoformat()
+    cursor.execute(
+        f"""
+        INSERT INTO sincronizacion_imap (usuario_id, buzon, uidvalidity, ultimo_uid, highestmodseq, actualizado_en)
+        VALUES ({p}, {p}, {p}, 0, {p}, {p})
+        ON CONFLICT (usuario_id, buzon) DO UPDATE SET highestmodseq = {p}, actualizado_en = {p}
+        WHERE sincronizacion_imap.uidvalidity = {p}
+        """,
+        (usuario_id, buzon, uidvalidity, highestmodseq, ahora, highestmodseq, ahora, uidvalidity)
+    )
+    conn.commit()
+    conn.close()
+
+
+# ============================================
+# FUNCIONES PARA CACHÉ DE HISTORIAL DE HILOS
+# ============================================
+
+def obtener_historial_hilo(cuenta: str, thread_id: str) -> Tuple[str, int, List[Dict[str, Any]]] | None:
+    """Devuelve (buzon, ultimo_uid, mensajes) del hilo en caché y marca el acceso."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    cursor.execute(
+        f"SELECT buzon, ultimo_uid, mensajes FROM historial_hilos WHERE cuenta = {p} AND thread_id = {p}",
+        (cuenta, thread_id)
+    )
+    fila = cursor.fetchone()
+    if fila:
+        cursor.execute(
+            f"UPDATE historial_hilos SET accedido_en = {p} WHERE cuenta = {p} AND thread_id = {p}",
+            (datetime.utcnow().isoformat(), cuenta, thread_id)
+        )
+        conn.commit()
+    conn.close()
+    if not fila:
+        return None
+    try:
+        mensajes = json.loads(fila[2])
+    except ValueError:
+        return None
+    return fila[0], int(fila[1] or 0), mensajes
+
+
+def guardar_historial_hilo(
+    cuenta: str,
+    thread_id: str,
+    buzon: str,
+    ultimo_uid: int,
+    mensajes: List[Dict[str, Any]],
+    max_bytes_total: int,
+) -> None:
+    """Guarda el historial del hilo y, si la caché pasa de ``max_bytes_total``, borra los menos usados."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    ahora = datetime.utcnow().isoformat()
+    contenido = json.dumps(mensajes, ensure_ascii=False)
+    tamano = len(contenido.encode("utf-8"))
+    cursor.execute(
+        f"""
+        INSERT INTO historial_hilos (cuenta, thread_id, buzon, ultimo_uid, mensajes, tamano, accedido_en)
+        VALUES ({p}, {p}, {p}, {p}, {p}, {p}, {p})
+        ON CONFLICT (cuenta, thread_id) DO UPDATE SET buzon = {p}, ultimo_uid = {p}, mensajes = {p}, tamano = {p}, accedido_en = {p}
+        """,
+        (cuenta, thread_id, buzon, ultimo_uid, contenido, tamano, ahora, buzon, ultimo_uid, contenido, tamano, ahora)
+    )
+    cursor.execute("SELECT COALESCE(SUM(tamano), 0) FROM historial_hilos")
+    total = int(cursor.fetchone()[0] or 0)
+    if total > max_bytes_total:
+        cursor.execute("SELECT cuenta, thread_id, tamano FROM historial_hilos ORDER BY accedido_en ASC")
+        a_borrar = []
+        for fila_cuenta, fila_thread, fila_tamano in cursor.fetchall():
+            if total <= max_bytes_total:
+                break
+            a_borrar.append((fila_cuenta, fila_thread))
+            total -= int(fila_tamano or 0)
+        for fila_cuenta, fila_thread in a_borrar:
+            cursor.execute(
+                f"DELETE FROM historial_hilos WHERE cuenta = {p} AND thread_id = {p}",
+                (fila_cuenta, fila_thread)
+            )
+        print(f"DEBUG: [DB] Caché de hilos: {len(a_borrar)} hilos desalojados")
+    conn.commit()
+    conn.close()
+
+
+def diferir_correos(usuario_id: int, uidvalidity: int, correos: List[Tuple[str, str]], motivo: str, reintentar_desde: str) -> None:
+    """Aparca ``(uid, clave)`` que no se pudieron clasificar; si ya estaban, suma un intento."""
+    if not correos:
+        return
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    ahora = datetime.utcnow().isoformat()
+    # Los de un UIDVALIDITY anterior ya no identifican ningún mensaje
+    cursor.execute(
+        f"DELETE FROM correos_diferidos WHERE usuario_id = {p} AND uidvalidity != {p}",
+        (usuario_id, uidvalidity)
+    )
+    for uid, clave in correos:
+        cursor.execute(
+            f"""
+            INSERT INTO correos_diferidos (usuario_id, uidvalidity, uid, clave, motivo, intentos, diferido_en, reintentar_desde)
+            VALUES ({p}, {p}, {p}, {p}, {p}, 1, {p}, {p})
+            ON CONFLICT (usuario_id, uidvalidity, uid) DO UPDATE SET
+                intentos = correos_diferidos.intentos + 1, motivo = {p}, reintentar_desde = {p}
+            """,
+            (usuario_id, uidvalidity, uid, clave, motivo, ahora, reintentar_desde, motivo, reintentar_desde)
+        )
+    conn.commit()
+    conn.close()
+
+
+def obtener_correos_diferidos(usuario_id: int, uidvalidity: int) -> List[str]:
+    """UIDs diferidos que ya pueden reintentarse, del más antiguo al más nuevo.
+
+    Los de otro UIDVALIDITY ya no identifican ningún mensaje y se borran.
+    """
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    cursor.execute(
+        f"DELETE FROM correos_diferidos WHERE usuario_id = {p} AND uidvalidity != {p}",
+        (usuario_id, uidvalidity)
+    )
+    cursor.execute(
+        f"SELECT uid, diferido_en FROM correos_diferidos WHERE usuario_id = {p} AND uidvalidity = {p} AND reintentar_desde <= {p}",
+        (usuario_id, uidvalidity, datetime.utcnow().isoformat())
+    )
+    filas = sorted(cursor.fetchall(), key=lambda f: (f[1], int(f[0]) if str(f[0]).isdigit() else 0))
+    uids = [fila[0] for fila in filas]
+    conn.commit()
+    conn.close()
+    return uids
+
+
+def eliminar_correos_diferidos(usuario_id: int, uidvalidity: int, uids: List[str]) -> None:
+    """Quita los UIDs ya resueltos; de paso, los de un UIDVALIDITY distinto (ya no valen)."""
+    conn = _get_connection()
+    cursor = conn.cursor()
+    p = _get_placeholder()
+    cursor.execute(
+        f"DELETE FROM correos_diferidos WHERE usuario_id = {p} AND uidvalidity != {p}",
+        (usuario_id, uidvalidity)
+    )
+    for i in range(0, len(uids), 500):
+        tramo = uids[i : i + 500]
+        marcadores = ", ".join([p] * len(tramo))
+        cursor.execute(
+            f"DELETE FROM correos_diferidos WHERE usuario_id = {p} AND uidvalidity = {p} AND uid IN ({marcadores})",
+            (usuario_id, uidvalidity, *tramo)
+        )
+    conn.commit()
+    conn.close()
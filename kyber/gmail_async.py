@@ -0,0 +1,877 @@
+"""Variante asyncio de ``gmail_client``: mismas funciones, en versión ``async``.
+
+Habla IMAP y SMTP sobre ``asyncio`` streams, así un solo event loop puede
+llevar las sesiones de todos los usuarios activos sin ocupar un hilo por
+escaneo. Las respuestas del cliente IMAP tienen la misma forma que las de
+imaplib, de modo que el parseo (``_agrupar_fetch``, BODYSTRUCTURE, caché de
+hilos, etc.) es el mismo código de ``gmail_client``.
+
+El pool de sesiones pertenece al event loop que lo creó.
+"""
+import asyncio
+import base64
+import imaplib
+import os
+import re
+import ssl
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from email.message import Message
+from email.utils import getaddresses, parseaddr
+from typing import Any, AsyncIterator, Dict, List, Tuple
+
+from . import almacen, metricas_imap
+from .gmail_client import (
+    ESPERA_CONEXION_SEGUNDOS,
+    FETCH_PARCIAL,
+    HILOS_POR_BUSQUEDA,
+    IMAP_HOST,
+    IMAP_PUERTO,
+    IMAP_SSL,
+    ITEMS_BORRADORES,
+    ITEMS_ESTRUCTURA,
+    ITEMS_TAMANO,
+    KEEPALIVE_SEGUNDOS,
+    MAX_BYTES_POR_FETCH,
+    MAX_CONEXIONES_POR_CUENTA,
+    REINTENTOS_FETCH,
+    SMTP_HOST,
+    SMTP_PUERTO,
+    SMTP_SSL,
+    _INDICES_BORRADORES,
+    _INDICES_LOCK,
+    _CacheHistoriales,
+    _IndiceBorradores,
+    _agrupar_fetch,
+    _armar_correos_por_partes,
+    _atributo_fetch,
+    _cambios_desde_fetch,
+    _checkpoint_vigente,
+    _claves_desde_fetch,
+    _conjunto_imap,
+    _conjuntos_acotados,
+    _correos_completos_desde_fetch,
+    _correos_desde_almacen,
+    _credenciales,
+    _criterio_hilos,
+    _criterio_no_leidos,
+    _fecha_imap,
+    _filtrar_por_fecha,
+    _grupos_por_secciones,
+    _highestmodseq_de_status,
+    _indexar_borradores,
+    _lotes_desde_tamanos,
+    _mensaje_html,
+    _normalizar_message_id,
+    _nombre_buzon,
+    _planes_por_partes,
+    _registrar_borrador,
+    _repartir_por_hilo,
+    _sin_atendidos,
+    _uid_de_append,
+    _uids_posteriores,
+)
+
+
+# Segundos máximos de espera por una línea o un literal del servidor.
+TIMEOUT_SEGUNDOS = int(os.environ.get("KYBER_IMAP_TIMEOUT", "60"))
+
+
+def _citar(valor: str) -> str:
+    return '"' + valor.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class ConexionImapAsync:
+    """Cliente IMAP4rev1 mínimo sobre asyncio streams.
+
+    ``uid``, ``select``, ``status``, ``append``... devuelven ``(estado, datos)``
+    igual que imaplib: las respuestas con literal llegan como tuplas
+    ``(cabecera, literal)`` seguidas del resto de la línea. Un BAD levanta
+    ``imaplib.IMAP4.error`` y una conexión caída ``imaplib.IMAP4.abort``.
+    """
+
+    def __init__(self, lector: asyncio.StreamReader, escritor: asyncio.StreamWriter, usuario: str = "") -> None:
+        self.lector = lector
+        self.escritor = escritor
+        # Para metricas_imap: a quién se atribuyen los comandos y bytes
+        self.usuario_medido = usuario
+        self.bytes_enviados = 0
+        self.bytes_recibidos = 0
+        self.capabilities: Tuple[str, ...] = ()
+        self._contador = 0
+        self._respuestas: Dict[str, List[Any]] = {}
+
+    @classmethod
+    async def abrir(cls, host: str, puerto: int = 993, usar_ssl: bool = True, usuario: str = "") -> "ConexionImapAsync":
+        contexto = ssl.create_default_context() if usar_ssl else None
+        inicio = time.perf_counter()
+        try:
+            lector, escritor = await asyncio.wait_for(
+                asyncio.open_connection(host, puerto, ssl=contexto, limit=1024 * 1024),
+                TIMEOUT_SEGUNDOS,
+            )
+        except asyncio.TimeoutError as e:
+            raise imaplib.IMAP4.abort(f"tiempo agotado conectando a {host}:{puerto}") from e
+        conexion = cls(lector, escritor, usuario)
+        saludo = await conexion._leer_linea()
+        metricas_imap.registrar(usuario, "CONNECT", time.perf_counter() - inicio)
+        if not saludo.startswith((b"* OK", b"* PREAUTH")):
+            conexion.escritor.close()
+            raise imaplib.IMAP4.error(f"saludo inesperado: {saludo.decode(errors='replace')}")
+        await conexion.capability()
+        return conexion
+
+    async def _leer_linea(self) -> bytes:
+        try:
+            linea = await asyncio.wait_for(self.lector.readline(), TIMEOUT_SEGUNDOS)
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError, ConnectionError, ValueError) as e:
+            raise imaplib.IMAP4.abort(f"error leyendo del servidor: {e!r}") from e
+        if not linea:
+            raise imaplib.IMAP4.abort("conexión cerrada por el servidor")
+        self.bytes_recibidos += len(linea)
+        return linea.rstrip(b"\r\n")
+
+    async def _leer_literal(self, largo: int) -> bytes:
+        try:
+            datos = await asyncio.wait_for(self.lector.readexactly(largo), TIMEOUT_SEGUNDOS)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
+            raise imaplib.IMAP4.abort(f"literal incompleto: {e!r}") from e
+        self.bytes_recibidos += len(datos)
+        return datos
+
+    async def _escribir(self, datos: bytes) -> None:
+        self.bytes_enviados += len(datos)
+        try:
+            self.escritor.write(datos)
+            await self.escritor.drain()
+        except ConnectionError as e:
+            raise imaplib.IMAP4.abort(f"error escribiendo al servidor: {e!r}") from e
+
+    def _guardar(self, tipo: str, dato: Any) -> None:
+        self._respuestas.setdefault(tipo.upper(), []).append(dato)
+
+    def _guardar_codigo(self, texto: bytes) -> None:
+        codigo = re.match(rb"\[([A-Za-z-]+)(?: ([^\]]*))?\]", texto)
+        if codigo:
+            self._guardar(codigo.group(1).decode(), codigo.group(2) or b"")
+
+    async def _no_etiquetada(self, linea: bytes) -> None:
+        """Registra una respuesta ``* ...`` (con sus literales) como lo hace imaplib."""
+        texto = linea[2:]
+        numerada = re.match(rb"(\d+) ([A-Za-z-]+)(?: (.*))?$", texto, re.S)
+        if numerada:
+            tipo = numerada.group(2).decode()
+            dato = numerada.group(1) + (b" " + numerada.group(3) if numerada.group(3) is not None else b"")
+        else:
+            estado = re.match(rb"([A-Za-z-]+)(?: (.*))?$", texto, re.S)
+            tipo = estado.group(1).decode() if estado else ""
+            dato = (estado.group(2) if estado else texto) or b""
+            if tipo.upper() in ("OK", "NO", "BAD"):
+                self._guardar_codigo(dato)
+        while True:
+            literal = re.search(rb"\{(\d+)\}$", dato)
+            if not literal:
+                break
+            contenido = await self._leer_literal(int(literal.group(1)))
+            self._guardar(tipo, (dato, contenido))
+            dato = await self._leer_linea()
+        self._guardar(tipo, dato)
+
+    async def comando(self, nombre: str, *args: Any, literal: bytes | None = None) -> Tuple[str, bytes]:
+        """Envía un comando y lee hasta su respuesta etiquetada; devuelve ``(estado, texto)``."""
+        medido = f"{nombre} {str(args[0]).upper()}" if nombre == "UID" and args else nombre
+        enviados, recibidos, inicio = self.bytes_enviados, self.bytes_recibidos, time.perf_counter()
+        try:
+            return await self._comando(nombre, *args, literal=literal)
+        finally:
+            metricas_imap.registrar(self.usuario_medido, medido, time.perf_counter() - inicio, self.bytes_enviados - enviados, self.bytes_recibidos - recibidos)
+
+    async def _comando(self, nombre: str, *args: Any, literal: bytes | None = None) -> Tuple[str, bytes]:
+        self._respuestas = {}
+        self._contador += 1
+        tag = f"K{self._contador:04d}".encode()
+        partes = [tag, nombre.encode()]
+        partes.extend(a if isinstance(a, bytes) else str(a).encode() for a in args if a is not None and a != "")
+        linea = b" ".join(partes)
+        if literal is not None:
+            linea += b" {%d}" % len(literal)
+        await self._escribir(linea + b"\r\n")
+        if literal is not None:
+            while True:
+                respuesta = await self._leer_linea()
+                if respuesta.startswith(b"+"):
+                    break
+                if respuesta.startswith(tag + b" "):
+                    return self._cerrar_comando(tag, respuesta)
+                if respuesta.startswith(b"* "):
+                    await self._no_etiquetada(respuesta)
+            await self._escribir(literal + b"\r\n")
+        while True:
+            respuesta = await self._leer_linea()
+            if respuesta.startswith(b"* "):
+                await self._no_etiquetada(respuesta)
+            elif respuesta.startswith(tag + b" "):
+                return self._cerrar_comando(tag, respuesta)
+
+    def _cerrar_comando(self, tag: bytes, respuesta: bytes) -> Tuple[str, bytes]:
+        estado, _, texto = respuesta[len(tag) + 1:].partition(b" ")
+        estado_txt = estado.decode(errors="replace").upper()
+        self._guardar_codigo(texto)
+        if estado_txt == "BAD":
+            raise imaplib.IMAP4.error(f"comando rechazado: {texto.decode(errors='replace')}")
+        return estado_txt, texto
+
+    def _extraer(self, tipo: str) -> List[Any]:
+        return self._respuestas.pop(tipo.upper(), [None])
+
+    def response(self, codigo: str) -> Tuple[str, List[Any]]:
+        return codigo.upper(), self._extraer(codigo)
+
+    async def capability(self) -> None:
+        await self.comando("CAPABILITY")
+        datos = self._extraer("CAPABILITY")
+        self.capabilities = tuple(datos[-1].decode().upper().split()) if datos[-1] else ()
+
+    async def login(self, usuario: str, clave: str) -> None:
+        estado, texto = await self.comando("LOGIN", _citar(usuario), _citar(clave))
+        if estado != "OK":
+            raise imaplib.IMAP4.error(texto.decode(errors="replace"))
+        # Gmail anuncia más capacidades (CONDSTORE, etc.) ya autenticado
+        await self.capability()
+
+    async def select(self, buzon: str) -> Tuple[str, List[Any]]:
+        estado, _ = await self.comando("SELECT", buzon)
+        return estado, self._extraer("EXISTS")
+
+    async def status(self, buzon: str, items: str) -> Tuple[str, List[Any]]:
+        estado, _ = await self.comando("STATUS", buzon, items)
+        return estado, self._extraer("STATUS")
+
+    async def uid(self, comando: str, *args: Any) -> Tuple[str, List[Any]]:
+        comando = comando.upper()
+        estado, _ = await self.comando("UID", comando, *args)
+        return estado, self._extraer(comando if comando in ("SEARCH", "SORT", "THREAD") else "FETCH")
+
+    async def expunge(self) -> Tuple[str, List[Any]]:
+        estado, _ = await self.comando("EXPUNGE")
+        return estado, self._extraer("EXPUNGE")
+
+    async def append(self, buzon: str, flags: str, fecha: str, mensaje: bytes) -> Tuple[str, List[Any]]:
+        if flags and not flags.startswith("("):
+            flags = f"({flags})"
+        datos = re.sub(rb"\r\n|\r|\n", b"\r\n", mensaje)
+        estado, texto = await self.comando("APPEND", _nombre_buzon(buzon), flags, fecha, literal=datos)
+        return estado, [texto]
+
+    async def noop(self) -> None:
+        await self.comando("NOOP")
+
+    async def logout(self) -> None:
+        try:
+            await self.comando("LOGOUT")
+        except imaplib.IMAP4.abort:
+            pass
+        finally:
+            self.escritor.close()
+
+
+async def _abrir_conexion(usuario: str | None = None, clave_app: str | None = None) -> ConexionImapAsync:
+    user, pwd = _credenciales(usuario, clave_app)
+    conexion = await ConexionImapAsync.abrir(IMAP_HOST, IMAP_PUERTO, usar_ssl=IMAP_SSL, usuario=user)
+    await conexion.login(user, pwd)
+    return conexion
+
+
+class _SesionAsync:
+    """Sesión IMAP autenticada y reutilizable (equivalente a ``_SesionImap``)."""
+
+    def __init__(self, usuario: str, clave_app: str) -> None:
+        self.usuario = usuario
+        self.clave_app = clave_app
+        self.conexion: ConexionImapAsync | None = None
+        self.buzon: str | None = None
+        self.uidvalidity: int | None = None
+        self.ultimo_uso = 0.0
+
+    async def conectar(self) -> None:
+        await self.cerrar()
+        self.conexion = await _abrir_conexion(self.usuario, self.clave_app)
+        self.buzon = None
+        self.uidvalidity = None
+        self.ultimo_uso = time.monotonic()
+
+    async def cerrar(self) -> None:
+        if self.conexion is not None:
+            try:
+                await self.conexion.logout()
+            except Exception:
+                pass
+        self.conexion = None
+        self.buzon = None
+        self.uidvalidity = None
+
+    async def asegurar_viva(self) -> None:
+        if self.conexion is None:
+            await self.conectar()
+            return
+        if time.monotonic() - self.ultimo_uso < KEEPALIVE_SEGUNDOS:
+            return
+        try:
+            await self.conexion.noop()
+            self.ultimo_uso = time.monotonic()
+        except (imaplib.IMAP4.abort, OSError):
+            await self.conectar()
+
+    async def seleccionar(self, *buzones: str) -> str:
+        if self.buzon is not None and self.buzon in buzones:
+            return self.buzon
+        for buzon in buzones:
+            try:
+                estado, _ = await self.conexion.select(_nombre_buzon(buzon))
+            except imaplib.IMAP4.abort:
+                await self.conectar()
+                estado, _ = await self.conexion.select(_nombre_buzon(buzon))
+            except imaplib.IMAP4.error:
+                continue
+            if estado == "OK":
+                self.buzon = buzon
+                _, valores = self.conexion.response("UIDVALIDITY")
+                self.uidvalidity = int(valores[0]) if valores and valores[0] else None
+                return buzon
+        self.buzon = None
+        self.uidvalidity = None
+        raise imaplib.IMAP4.error(f"No se pudo seleccionar ninguno de {buzones}")
+
+
+class _PoolAsync:
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.cupos = asyncio.Semaphore(MAX_CONEXIONES_POR_CUENTA)
+        self.libres: List[_SesionAsync] = []
+
+
+_POOLS: Dict[str, _PoolAsync] = {}
+
+
+def _pool_de(usuario: str) -> _PoolAsync:
+    loop = asyncio.get_running_loop()
+    pool = _POOLS.get(usuario)
+    if pool is None or pool.loop is not loop:
+        pool = _PoolAsync(loop)
+        _POOLS[usuario] = pool
+    return pool
+
+
+@asynccontextmanager
+async def _sesion_imap(usuario: str | None = None, clave_app: str | None = None, *buzones: str) -> AsyncIterator[_SesionAsync]:
+    """Presta una sesión del pool de la cuenta (ver ``gmail_client._sesion_imap``)."""
+    user, pwd = _credenciales(usuario, clave_app)
+    pool = _pool_de(user)
+    try:
+        await asyncio.wait_for(pool.cupos.acquire(), ESPERA_CONEXION_SEGUNDOS)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"No hay conexiones IMAP libres para {user}")
+    sesion: _SesionAsync | None = None
+    try:
+        while pool.libres and sesion is None:
+            candidata = pool.libres.pop()
+            if candidata.clave_app == pwd:
+                sesion = candidata
+            else:
+                await candidata.cerrar()
+        if sesion is None:
+            sesion = _SesionAsync(user, pwd)
+        await sesion.asegurar_viva()
+        if buzones:
+            await sesion.seleccionar(*buzones)
+        yield sesion
+    except (imaplib.IMAP4.abort, OSError):
+        if sesion is not None:
+            await sesion.cerrar()
+            sesion = None
+        raise
+    finally:
+        if sesion is not None and sesion.conexion is not None:
+            sesion.ultimo_uso = time.monotonic()
+            pool.libres.append(sesion)
+        pool.cupos.release()
+
+
+async def cerrar_conexiones_imap(usuario: str | None = None) -> None:
+    """Cierra las sesiones inactivas del pool (de una cuenta o de todas)."""
+    pools = [_POOLS[usuario]] if usuario in _POOLS else ([] if usuario else list(_POOLS.values()))
+    for pool in pools:
+        libres, pool.libres = pool.libres, []
+        for sesion in libres:
+            await sesion.cerrar()
+
+
+# ============================================
+# LECTURA
+# ============================================
+
+async def obtener_ids_no_leidos(max_total: int | None = None, usuario: str | None = None, clave_app: str | None = None, desde_fecha: str | None = None, usuario_id: int | None = None, filtro_exacto: bool = False, incremental: bool = False) -> List[str]:
+    """Ver ``gmail_client.obtener_ids_no_leidos``."""
+    criterio, fecha_inicio, fecha_fin, fecha_especifica = _criterio_no_leidos(usuario_id, desde_fecha)
+    incremental = incremental and bool(usuario_id) and not fecha_especifica
+
+    async with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        conexion = sesion.conexion
+        ultimo_uid = 0
+        if incremental:
+            ultimo_uid = await asyncio.to_thread(_checkpoint_vigente, usuario_id, "INBOX", sesion.uidvalidity)
+            if ultimo_uid:
+                criterio += f" UID {ultimo_uid + 1}:*"
+        estado, datos = await conexion.uid("SEARCH", None, criterio)
+        ids_decod = _uids_posteriores(estado, datos, ultimo_uid)
+        print(f"📬 Correos NO LEÍDOS dentro del rango ({criterio}): {len(ids_decod)}")
+
+        if ids_decod and filtro_exacto:
+            estado, datos = await conexion.uid("FETCH", _conjunto_imap(ids_decod), "(BODY.PEEK[HEADER.FIELDS (DATE)])")
+            if estado == "OK":
+                ids_decod = _filtrar_por_fecha(datos, ids_decod, fecha_inicio, fecha_fin)
+            print(f"✅ Correos que cumplen el filtro exacto de fecha: {len(ids_decod)}")
+
+    if max_total is not None:
+        ids_decod = ids_decod[:max_total] if incremental else ids_decod[-max_total:]
+    return ids_decod
+
+
+async def obtener_cambios_flags(desde_modseq: int, usuario: str | None = None, clave_app: str | None = None, buzon: str = "INBOX") -> Tuple[Dict[str, Dict[str, Any]], int | None, int | None]:
+    """Ver ``gmail_client.obtener_cambios_flags``."""
+    async with _sesion_imap(usuario, clave_app, buzon) as sesion:
+        conexion = sesion.conexion
+        if "CONDSTORE" not in conexion.capabilities:
+            return {}, None, sesion.uidvalidity
+        if not desde_modseq:
+            estado, datos = await conexion.status(_nombre_buzon(buzon), "(HIGHESTMODSEQ)")
+            return {}, _highestmodseq_de_status(estado, datos), sesion.uidvalidity
+        estado, datos = await conexion.uid("FETCH", "1:*", f"(UID FLAGS X-GM-LABELS) (CHANGEDSINCE {desde_modseq})")
+        if estado != "OK":
+            return {}, None, sesion.uidvalidity
+        cambios, highestmodseq = _cambios_desde_fetch(datos, desde_modseq)
+        return cambios, highestmodseq, sesion.uidvalidity
+
+
+async def descartar_atendidos(ids: List[str], usuario_id: int, usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    """Ver ``gmail_client.descartar_atendidos``."""
+    from .db import obtener_checkpoint_sync
+
+    checkpoint = await asyncio.to_thread(obtener_checkpoint_sync, usuario_id, "INBOX")
+    desde_modseq = checkpoint[2] if checkpoint else 0
+    cambios, highestmodseq, uidvalidity = await obtener_cambios_flags(desde_modseq, usuario, clave_app)
+    return await asyncio.to_thread(_sin_atendidos, ids, usuario_id, checkpoint, cambios, highestmodseq, uidvalidity)
+
+
+async def obtener_uidvalidity(usuario: str | None = None, clave_app: str | None = None, buzon: str = "INBOX") -> int | None:
+    async with _sesion_imap(usuario, clave_app, buzon) as sesion:
+        return sesion.uidvalidity
+
+
+async def obtener_claves_mensajes(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> Dict[str, str]:
+    """Ver ``gmail_client.obtener_claves_mensajes``."""
+    if not ids:
+        return {}
+    async with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        estado, datos = await sesion.conexion.uid("FETCH", _conjunto_imap(ids), "(X-GM-MSGID)")
+        if estado != "OK":
+            return {}
+    return _claves_desde_fetch(datos)
+
+
+async def _correos_por_partes(conexion: ConexionImapAsync, cuenta: str, ids: List[str]) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+    estado, datos = await conexion.uid("FETCH", _conjunto_imap(ids), ITEMS_ESTRUCTURA)
+    if estado != "OK":
+        return {}, list(ids)
+    planes, completos = await asyncio.to_thread(_planes_por_partes, cuenta, datos, ids)
+
+    recibidas: Dict[str, Dict[str, bytes]] = {}
+    for secciones, grupo in _grupos_por_secciones(planes):
+        estado, datos = await conexion.uid("FETCH", _conjunto_imap(grupo), f"({' '.join(secciones)})")
+        if estado != "OK":
+            continue
+        for item in _agrupar_fetch(datos):
+            recibidas[item["uid"]] = item["secciones"]
+    return _armar_correos_por_partes(planes, recibidas, completos)
+
+
+async def _descargar_correos(ids: List[str], por_id: Dict[str, Dict[str, Any]], usuario: str | None, clave_app: str | None, max_bytes: int) -> None:
+    faltantes = [i for i in ids if i not in por_id]
+    if not faltantes:
+        return
+    async with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        conexion = sesion.conexion
+        completos = faltantes
+        if FETCH_PARCIAL:
+            parciales, completos = await _correos_por_partes(conexion, sesion.usuario, faltantes)
+            por_id.update(parciales)
+        lotes: List[List[str]] = []
+        if completos:
+            estado, datos = await conexion.uid("FETCH", _conjunto_imap(completos), ITEMS_TAMANO)
+            revisar = estado == "OK" and not FETCH_PARCIAL
+            en_almacen = await asyncio.to_thread(_correos_desde_almacen, sesion.usuario, datos, completos) if revisar else {}
+            por_id.update(en_almacen)
+            completos = [i for i in completos if i not in en_almacen]
+            lotes = _lotes_desde_tamanos(estado, datos, completos, max_bytes)
+        for lote in lotes:
+            estado, datos = await conexion.uid("FETCH", _conjunto_imap(lote), "(BODY.PEEK[] X-GM-THRID X-GM-MSGID)")
+            if estado == "OK":
+                por_id.update(await asyncio.to_thread(_correos_completos_desde_fetch, sesion.usuario, datos, lote))
+
+
+async def _descargar_con_reintentos(ids: List[str], usuario: str | None, clave_app: str | None, max_bytes: int) -> Dict[str, Dict[str, Any]]:
+    por_id: Dict[str, Dict[str, Any]] = {}
+    for intento in range(REINTENTOS_FETCH + 1):
+        try:
+            await _descargar_correos(ids, por_id, usuario, clave_app, max_bytes)
+            return por_id
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if intento == REINTENTOS_FETCH:
+                print(f"⚠️  [IMAP] Worker de descarga sin conexión tras {intento + 1} intentos: {e}")
+                return por_id
+            print(f"🔁 [IMAP] Conexión perdida en descarga ({e}); reintento {intento + 1}/{REINTENTOS_FETCH}")
+            await asyncio.sleep(min(2 ** intento, 10))
+    return por_id
+
+
+async def obtener_correos_por_ids(ids: List[str], usuario: str | None = None, clave_app: str | None = None, max_bytes_por_fetch: int | None = None, workers: int = 1) -> List[Dict[str, Any]]:
+    """Ver ``gmail_client.obtener_correos_por_ids``; los tramos corren con ``asyncio.gather``."""
+    if not ids:
+        return []
+    max_bytes = max_bytes_por_fetch or MAX_BYTES_POR_FETCH
+    workers = max(1, min(workers or 1, MAX_CONEXIONES_POR_CUENTA, len(ids)))
+    tamano = -(-len(ids) // workers)
+    tramos = [ids[i:i + tamano] for i in range(0, len(ids), tamano)]
+    por_id: Dict[str, Dict[str, Any]] = {}
+    for parcial in await asyncio.gather(*(_descargar_con_reintentos(t, usuario, clave_app, max_bytes) for t in tramos)):
+        por_id.update(parcial)
+    return [por_id[i] for i in ids if i in por_id]
+
+
+async def obtener_historiales_por_threads(thread_ids: List[str], limite: int = 5, usuario: str | None = None, clave_app: str | None = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Ver ``gmail_client.obtener_historiales_por_threads``."""
+    pedidos = list(dict.fromkeys(t for t in thread_ids if t))
+    if not pedidos:
+        return {}
+    user, pwd = _credenciales(usuario, clave_app)
+    uids_por_hilo: Dict[str, List[str]] = {t: [] for t in pedidos}
+    async with _sesion_imap(user, pwd, "[Gmail]/All Mail", "INBOX") as sesion:
+        conexion = sesion.conexion
+        for i in range(0, len(pedidos), HILOS_POR_BUSQUEDA):
+            tramo = pedidos[i : i + HILOS_POR_BUSQUEDA]
+            estado, datos = await conexion.uid("SEARCH", None, _criterio_hilos(tramo))
+            uids = [u.decode() for u in (datos[0] or b"").split()] if estado == "OK" and datos else []
+            if len(tramo) == 1:
+                uids_por_hilo[tramo[0]].extend(uids)
+            elif uids:
+                estado, datos = await conexion.uid("FETCH", _conjunto_imap(uids), "(X-GM-THRID)")
+                if estado == "OK":
+                    _repartir_por_hilo(datos, uids_por_hilo)
+        # Caché de hilos (SQLite/Postgres) y almacén en disco van en hilos aparte
+        cache = await asyncio.to_thread(_CacheHistoriales, user, f"{sesion.buzon}:{sesion.uidvalidity}", pedidos, uids_por_hilo, limite)
+        if almacen.ALMACEN_ACTIVO:
+            for grupo in cache.grupos_faltantes():
+                estado, datos = await conexion.uid("FETCH", _conjunto_imap(grupo), "(X-GM-MSGID)")
+                if estado == "OK":
+                    await asyncio.to_thread(cache.resolver_desde_almacen, datos)
+        for grupo in cache.grupos_faltantes():
+            estado, datos = await conexion.uid("FETCH", _conjunto_imap(grupo), "(BODY.PEEK[] X-GM-MSGID)")
+            if estado == "OK":
+                await asyncio.to_thread(cache.agregar, datos)
+    return await asyncio.to_thread(cache.guardar)
+
+
+async def obtener_historial_por_thread(thread_id: str, limite: int = 5, usuario: str | None = None, clave_app: str | None = None) -> List[Dict[str, Any]]:
+    if not thread_id:
+        return []
+    return (await obtener_historiales_por_threads([thread_id], limite, usuario, clave_app)).get(thread_id, [])
+
+
+async def obtener_correos_antiguos(dias: int = 90, max_total: int = 100, usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    async with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        fecha_limite = datetime.utcnow() - timedelta(days=dias)
+        estado, datos = await sesion.conexion.uid("SEARCH", None, f"BEFORE {_fecha_imap(fecha_limite)}")
+    ids_decod = [i.decode() for i in datos[0].split()] if estado == "OK" and datos and datos[0] else []
+    if max_total is not None:
+        ids_decod = ids_decod[:max_total]
+    return ids_decod
+
+
+# ============================================
+# ESCRITURA (STORE, ARCHIVO, BORRADORES)
+# ============================================
+
+async def _store_por_lotes(conexion: ConexionImapAsync, ids: List[str], operacion: str, valor: str) -> List[str]:
+    """Ver ``gmail_client._store_por_lotes``."""
+    fallidos: List[str] = []
+    for grupo in _conjuntos_acotados(ids):
+        try:
+            estado, datos = await conexion.uid("STORE", _conjunto_imap(grupo), operacion, valor)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            estado, datos = "NO", []
+        if estado == "OK":
+            confirmados = {item["uid"] for item in _agrupar_fetch(datos or [])}
+            fallidos.extend(i for i in grupo if i not in confirmados)
+            continue
+        if len(grupo) == 1:
+            fallidos.extend(grupo)
+            continue
+        for correo_id in grupo:
+            fallidos.extend(await _store_por_lotes(conexion, [correo_id], operacion, valor))
+    return fallidos
+
+
+async def _sin_confirmar_en_buzon(conexion: ConexionImapAsync, ids: List[str]) -> List[str]:
+    if not ids:
+        return []
+    presentes: set[str] = set()
+    for grupo in _conjuntos_acotados(ids):
+        estado, datos = await conexion.uid("SEARCH", None, f"UID {_conjunto_imap(grupo)}")
+        if estado == "OK" and datos and datos[0]:
+            presentes.update(u.decode() for u in datos[0].split())
+    return [i for i in ids if i in presentes]
+
+
+async def marcar_como_leido(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    if not ids:
+        return []
+    async with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        return await _store_por_lotes(sesion.conexion, ids, "+FLAGS", "\\Seen")
+
+
+async def marcar_como_no_leido(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    if not ids:
+        return []
+    async with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        return await _store_por_lotes(sesion.conexion, ids, "-FLAGS", "\\Seen")
+
+
+async def archivar_ids(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    """Ver ``gmail_client.archivar_ids``."""
+    if not ids:
+        return []
+    async with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        conexion = sesion.conexion
+        await _store_por_lotes(conexion, ids, "+X-GM-LABELS", "Archivados")
+        pendientes = await _sin_confirmar_en_buzon(conexion, await _store_por_lotes(conexion, ids, "-X-GM-LABELS", "\\Inbox"))
+        if pendientes:
+            pendientes = await _sin_confirmar_en_buzon(conexion, await _store_por_lotes(conexion, pendientes, "-X-GM-LABELS", "Inbox"))
+        fallidos: List[str] = []
+        for grupo in _conjuntos_acotados(pendientes):
+            try:
+                estado, _ = await conexion.uid("COPY", _conjunto_imap(grupo), '"[Gmail]/All Mail"')
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error:
+                estado = "NO"
+            if estado != "OK":
+                fallidos.extend(grupo)
+                continue
+            fallidos.extend(await _store_por_lotes(conexion, grupo, "+FLAGS", "\\Deleted"))
+        try:
+            await conexion.expunge()
+        except imaplib.IMAP4.error:
+            pass
+    if fallidos:
+        print(f"⚠️  No se pudieron archivar {len(fallidos)} correos: {fallidos[:20]}")
+    return fallidos
+
+
+async def eliminar_correos_por_ids(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> int:
+    if not ids:
+        return 0
+    async with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        fallidos = await _store_por_lotes(sesion.conexion, ids, "+FLAGS", "\\Deleted")
+        try:
+            await sesion.conexion.expunge()
+        except imaplib.IMAP4.error:
+            pass
+    if fallidos:
+        print(f"⚠️  No se pudieron eliminar {len(fallidos)} correos: {fallidos[:20]}")
+    return len(set(ids)) - len(fallidos)
+
+
+async def crear_borrador(
+    responder_a: str,
+    asunto: str,
+    cuerpo: str,
+    in_reply_to: str | None = None,
+    references: str | None = None,
+    usuario: str | None = None,
+    clave_app: str | None = None,
+    firma_personalizada: str | None = None,
+) -> None:
+    """Ver ``gmail_client.crear_borrador``."""
+    user = usuario or os.environ.get("KYBER_GMAIL_USER")
+    pwd = clave_app or os.environ.get("KYBER_GMAIL_APP_PASSWORD")
+    if not user or not pwd:
+        return
+    mensaje = _mensaje_html(user, responder_a, asunto, cuerpo, in_reply_to, references, firma_personalizada, "<br>")
+    timestamp = imaplib.Time2Internaldate(time.time())
+    async with _sesion_imap(user, pwd) as sesion:
+        estado, datos = await sesion.conexion.append("[Gmail]/Drafts", "", timestamp, mensaje.as_bytes())
+        uid = _uid_de_append(estado, datos)
+        thread_id = ""
+        if uid:
+            try:
+                await sesion.seleccionar("[Gmail]/Drafts", "Drafts")
+                est2, dat2 = await sesion.conexion.uid("FETCH", uid, "(X-GM-THRID)")
+                if est2 == "OK":
+                    thread_id = next((_atributo_fetch(x["meta"], "X-GM-THRID") for x in _agrupar_fetch(dat2)), "")
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error:
+                pass
+    _registrar_borrador(user, uid, in_reply_to, references, thread_id)
+
+
+async def construir_indice_borradores(usuario: str | None = None, clave_app: str | None = None) -> None:
+    """Ver ``gmail_client.construir_indice_borradores``; el índice es el mismo para ambos clientes."""
+    user, pwd = _credenciales(usuario, clave_app)
+    indice = _IndiceBorradores()
+    try:
+        async with _sesion_imap(user, pwd, "[Gmail]/Drafts", "Drafts") as sesion:
+            estado, datos = await sesion.conexion.uid("SEARCH", None, "ALL")
+            uids = [u.decode() for u in datos[0].split()] if estado == "OK" and datos and datos[0] else []
+            if uids:
+                estado, datos = await sesion.conexion.uid("FETCH", _conjunto_imap(uids), ITEMS_BORRADORES)
+                if estado == "OK":
+                    _indexar_borradores(indice, datos)
+    except imaplib.IMAP4.abort:
+        raise
+    except imaplib.IMAP4.error as e:
+        print(f"⚠️  No se pudo leer la carpeta de borradores: {e}")
+    with _INDICES_LOCK:
+        _INDICES_BORRADORES[user] = indice
+
+
+async def _indice_borradores(usuario: str | None = None, clave_app: str | None = None) -> _IndiceBorradores:
+    user, pwd = _credenciales(usuario, clave_app)
+    with _INDICES_LOCK:
+        indice = _INDICES_BORRADORES.get(user)
+    if indice is None:
+        await construir_indice_borradores(user, pwd)
+        with _INDICES_LOCK:
+            indice = _INDICES_BORRADORES[user]
+    return indice
+
+
+async def existe_borrador_para_message_id(message_id: str, usuario: str | None = None, clave_app: str | None = None) -> bool:
+    if not message_id:
+        return False
+    indice = await _indice_borradores(usuario, clave_app)
+    return _normalizar_message_id(message_id) in indice.por_message_id
+
+
+async def existe_borrador_para_thread_id(thread_id: str, usuario: str | None = None, clave_app: str | None = None) -> bool:
+    if not thread_id:
+        return False
+    indice = await _indice_borradores(usuario, clave_app)
+    return thread_id in indice.por_thread_id
+
+
+# ============================================
+# SMTP
+# ============================================
+
+class ClienteSmtpAsync:
+    """Cliente SMTP mínimo (EHLO, AUTH PLAIN, MAIL/RCPT/DATA) sobre asyncio streams."""
+
+    def __init__(self, lector: asyncio.StreamReader, escritor: asyncio.StreamWriter) -> None:
+        self.lector = lector
+        self.escritor = escritor
+
+    @classmethod
+    async def abrir(cls, host: str, puerto: int = 465, usar_ssl: bool = True) -> "ClienteSmtpAsync":
+        contexto = ssl.create_default_context() if usar_ssl else None
+        lector, escritor = await asyncio.wait_for(asyncio.open_connection(host, puerto, ssl=contexto), TIMEOUT_SEGUNDOS)
+        cliente = cls(lector, escritor)
+        await cliente._esperar(220)
+        await cliente.comando("EHLO kyber", 250)
+        return cliente
+
+    async def _respuesta(self) -> Tuple[int, str]:
+        lineas: List[str] = []
+        while True:
+            linea = await asyncio.wait_for(self.lector.readline(), TIMEOUT_SEGUNDOS)
+            if not linea:
+                raise ConnectionError("conexión SMTP cerrada por el servidor")
+            texto = linea.decode(errors="replace").rstrip("\r\n")
+            lineas.append(texto[4:])
+            if len(texto) < 4 or texto[3] != "-":
+                return int(texto[:3]), "\n".join(lineas)
+
+    async def _esperar(self, *codigos: int) -> str:
+        codigo, texto = await self._respuesta()
+        if codigo not in codigos:
+            raise RuntimeError(f"SMTP {codigo}: {texto}")
+        return texto
+
+    async def comando(self, linea: str, *codigos: int) -> str:
+        self.escritor.write(linea.encode() + b"\r\n")
+        await self.escritor.drain()
+        return await self._esperar(*codigos)
+
+    async def login(self, usuario: str, clave: str) -> None:
+        credencial = base64.b64encode(f"\0{usuario}\0{clave}".encode()).decode()
+        await self.comando(f"AUTH PLAIN {credencial}", 235)
+
+    async def enviar(self, mensaje: Message) -> None:
+        remitente = parseaddr(mensaje.get("From", ""))[1]
+        destinatarios = [d for _, d in getaddresses(mensaje.get_all("To", []) + mensaje.get_all("Cc", [])) if d]
+        await self.comando(f"MAIL FROM:<{remitente}>", 250)
+        for destinatario in destinatarios:
+            await self.comando(f"RCPT TO:<{destinatario}>", 250, 251)
+        await self.comando("DATA", 354)
+        datos = re.sub(rb"\r\n|\r|\n", b"\r\n", mensaje.as_bytes())
+        datos = re.sub(rb"(?m)^\.", b"..", datos)
+        if not datos.endswith(b"\r\n"):
+            datos += b"\r\n"
+        self.escritor.write(datos + b".\r\n")
+        await self.escritor.drain()
+        await self._esperar(250)
+
+    async def cerrar(self) -> None:
+        try:
+            await self.comando("QUIT", 221)
+        except Exception:
+            pass
+        finally:
+            self.escritor.close()
+
+
+async def _abrir_smtp(usuario: str, clave_app: str) -> ClienteSmtpAsync:
+    cliente = await ClienteSmtpAsync.abrir(SMTP_HOST, SMTP_PUERTO, usar_ssl=SMTP_SSL)
+    await cliente.login(usuario, clave_app)
+    return cliente
+
+
+async def enviar_correo(
+    destinatario: str,
+    asunto: str,
+    cuerpo: str,
+    in_reply_to: str | None = None,
+    references: str | None = None,
+    usuario: str | None = None,
+    clave_app: str | None = None,
+    firma_personalizada: str | None = None,
+) -> bool:
+    """Ver ``gmail_client.enviar_correo``."""
+    user = usuario or os.environ.get("KYBER_GMAIL_USER")
+    pwd = clave_app or os.environ.get("KYBER_GMAIL_APP_PASSWORD")
+    if not user or not pwd:
+        return False
+    mensaje = _mensaje_html(user, destinatario, asunto, cuerpo, in_reply_to, references, firma_personalizada, "<br><br>")
+    try:
+        cliente = await _abrir_smtp(user, pwd)
+        try:
+            await cliente.enviar(mensaje)
+        finally:
+            await cliente.cerrar()
+        return True
+    except Exception as e:
+        print(f"ERROR AL ENVIAR CORREO: {e}")
+        return False
@@ -1,41 +1,433 @@
 import os
 import imaplib
+import smtplib
+import queue
 import email
+import base64
+import binascii
+import quopri
 import time
 import re
+import select
 from datetime import datetime, timedelta
+from email.message import Message
 from email.mime.text import MIMEText
+from email.parser import BytesHeaderParser
 from email.utils import parseaddr
 from email.header import decode_header
-from typing import Any, Dict, List, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
 
+from . import almacen, metricas_imap
 
-def _abrir_conexion(usuario: str | None = None, clave_app: str | None = None) -> imaplib.IMAP4_SSL:
+
+# Servidores de correo; con KYBER_IMAP_SSL=0 / KYBER_SMTP_SSL=0 se habla en claro (kyber.servidor_local).
+IMAP_HOST = os.environ.get("KYBER_IMAP_HOST", "imap.gmail.com")
+IMAP_PUERTO = int(os.environ.get("KYBER_IMAP_PORT", "993"))
+IMAP_SSL = os.environ.get("KYBER_IMAP_SSL", "1") == "1"
+SMTP_HOST = os.environ.get("KYBER_SMTP_HOST", "smtp.gmail.com")
+SMTP_PUERTO = int(os.environ.get("KYBER_SMTP_PORT", "465"))
+SMTP_SSL = os.environ.get("KYBER_SMTP_SSL", "1") == "1"
+# Límite de sesiones IMAP simultáneas por cuenta (Gmail acepta hasta 15).
+MAX_CONEXIONES_POR_CUENTA = int(os.environ.get("KYBER_IMAP_MAX_CONEXIONES", "4"))
+# Segundos de inactividad tras los cuales se verifica la sesión con NOOP.
+KEEPALIVE_SEGUNDOS = int(os.environ.get("KYBER_IMAP_KEEPALIVE", "120"))
+# Segundos máximos de espera por una sesión libre cuando la cuenta está al tope.
+ESPERA_CONEXION_SEGUNDOS = 60
+# Abreviaturas de mes que exige IMAP en SEARCH, sin depender del locale.
+MESES_IMAP = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+# Bytes máximos que se piden al servidor en un solo FETCH de mensajes completos.
+MAX_BYTES_POR_FETCH = int(os.environ.get("KYBER_IMAP_MAX_BYTES_FETCH", str(8 * 1024 * 1024)))
+# Caracteres máximos del message set de un comando (Gmail corta las líneas hacia ~10 KB).
+MAX_LARGO_CONJUNTO = int(os.environ.get("KYBER_IMAP_MAX_LARGO_CONJUNTO", "4000"))
+# Tamaño máximo de la caché de historial de hilos en la base de datos.
+MAX_BYTES_CACHE_HILOS = int(os.environ.get("KYBER_CACHE_HILOS_MAX_BYTES", str(50 * 1024 * 1024)))
+# Hilos por cada UID SEARCH con X-GM-THRID unidos por OR.
+HILOS_POR_BUSQUEDA = int(os.environ.get("KYBER_IMAP_HILOS_POR_BUSQUEDA", "25"))
+# Descarga parcial guiada por BODYSTRUCTURE (KYBER_IMAP_FETCH_PARCIAL=0 vuelve al mensaje completo).
+FETCH_PARCIAL = os.environ.get("KYBER_IMAP_FETCH_PARCIAL", "1") == "1"
+# Bytes que se piden de la parte de texto (la IA usa como mucho 3000 caracteres).
+MAX_BYTES_TEXTO = int(os.environ.get("KYBER_IMAP_MAX_BYTES_TEXTO", str(16 * 1024)))
+# Con HTML hace falta más margen: las etiquetas se descartan al limpiar.
+MAX_BYTES_HTML = int(os.environ.get("KYBER_IMAP_MAX_BYTES_HTML", str(64 * 1024)))
+# La primera imagen solo se descarga si su parte (codificada) no pasa de este tamaño.
+MAX_BYTES_IMAGEN = int(os.environ.get("KYBER_IMAP_MAX_BYTES_IMAGEN", str(1024 * 1024)))
+# Reintentos de cada worker de descarga cuando su sesión se cae a mitad del FETCH.
+REINTENTOS_FETCH = int(os.environ.get("KYBER_IMAP_REINTENTOS_FETCH", "2"))
+# Tope de bytes decodificados (texto + imagen) que se guardan de cada mensaje.
+MAX_BYTES_MENSAJE = int(os.environ.get("KYBER_MAX_BYTES_MENSAJE", str(4 * 1024 * 1024)))
+# Segundos sin envíos tras los que se cierra la sesión SMTP de una cuenta.
+SMTP_INACTIVIDAD_SEGUNDOS = int(os.environ.get("KYBER_SMTP_INACTIVIDAD", "60"))
+# Reintentos de un mensaje cuando la sesión SMTP se cae al enviarlo.
+REINTENTOS_SMTP = int(os.environ.get("KYBER_SMTP_REINTENTOS", "2"))
+
+
+def _credenciales(usuario: str | None = None, clave_app: str | None = None) -> Tuple[str, str]:
     user = usuario or os.environ.get("KYBER_GMAIL_USER")
     pwd = clave_app or os.environ.get("KYBER_GMAIL_APP_PASSWORD")
     if not user or not pwd:
         raise RuntimeError("Credenciales de Gmail no configuradas")
-    conexion = imaplib.IMAP4_SSL("imap.gmail.com")
+    return user, pwd
+
+
+def _abrir_conexion(usuario: str | None = None, clave_app: str | None = None) -> imaplib.IMAP4_SSL:
+    user, pwd = _credenciales(usuario, clave_app)
+    clase = metricas_imap.ImapSSLMedido if IMAP_SSL else metricas_imap.ImapMedido
+    conexion = clase(IMAP_HOST, IMAP_PUERTO, usuario=user)
     conexion.login(user, pwd)
     return conexion
 
 
-def obtener_ids_no_leidos(max_total: int | None = None, usuario: str | None = None, clave_app: str | None = None, desde_fecha: str | None = None, usuario_id: int | None = None) -> List[str]:
-    from datetime import datetime, timedelta
-    import email.utils
-    
+def _nombre_buzon(buzon: str) -> str:
+    """imaplib no entrecomilla los nombres de buzón; '[Gmail]/All Mail' lo necesita."""
+    if " " in buzon and not buzon.startswith('"'):
+        return f'"{buzon}"'
+    return buzon
+
+
+class _SesionImap:
+    """Sesión IMAP autenticada y reutilizable de una cuenta de Gmail."""
+
+    def __init__(self, usuario: str, clave_app: str) -> None:
+        self.usuario = usuario
+        self.clave_app = clave_app
+        self.conexion: imaplib.IMAP4_SSL | None = None
+        self.buzon: str | None = None
+        self.uidvalidity: int | None = None
+        self.ultimo_uso = 0.0
+
+    def conectar(self) -> None:
+        self.cerrar()
+        self.conexion = _abrir_conexion(self.usuario, self.clave_app)
+        self.buzon = None
+        self.uidvalidity = None
+        self.ultimo_uso = time.monotonic()
+
+    def cerrar(self) -> None:
+        if self.conexion is not None:
+            try:
+                self.conexion.logout()
+            except Exception:
+                pass
+        self.conexion = None
+        self.buzon = None
+        self.uidvalidity = None
+
+    def asegurar_viva(self) -> None:
+        """Reconecta si no hay sesión o si el NOOP de keepalive falla."""
+        if self.conexion is None:
+            self.conectar()
+            return
+        if time.monotonic() - self.ultimo_uso < KEEPALIVE_SEGUNDOS:
+            return
+        try:
+            self.conexion.noop()
+            self.ultimo_uso = time.monotonic()
+        except (imaplib.IMAP4.abort, OSError):
+            self.conectar()
+
+    def descartar_pendientes(self) -> None:
+        """Olvida las respuestas no etiquetadas de usos anteriores.
+
+        imaplib las acumula entre comandos: un FETCH suelto del NOOP de
+        keepalive o de otro préstamo se leería como respuesta del siguiente
+        UID FETCH o STORE (sin UID, o como confirmación que no es).
+        """
+        if self.conexion is not None:
+            self.conexion.untagged_responses.clear()
+
+    def seleccionar(self, *buzones: str) -> str:
+        """Selecciona el primer buzón disponible; no repite el SELECT si ya está activo."""
+        if self.buzon is not None and self.buzon in buzones:
+            self.descartar_pendientes()
+            return self.buzon
+        for buzon in buzones:
+            try:
+                estado, _ = self.conexion.select(_nombre_buzon(buzon))
+            except imaplib.IMAP4.abort:
+                self.conectar()
+                estado, _ = self.conexion.select(_nombre_buzon(buzon))
+            except imaplib.IMAP4.error:
+                continue
+            if estado == "OK":
+                self.buzon = buzon
+                _, valores = self.conexion.response("UIDVALIDITY")
+                self.uidvalidity = int(valores[0]) if valores and valores[0] else None
+                return buzon
+        self.buzon = None
+        self.uidvalidity = None
+        raise imaplib.IMAP4.error(f"No se pudo seleccionar ninguno de {buzones}")
+
+
+class _PoolCuenta:
+    def __init__(self) -> None:
+        self.cupos = threading.BoundedSemaphore(MAX_CONEXIONES_POR_CUENTA)
+        self.libres: List[_SesionImap] = []
+        self.lock = threading.Lock()
+
+
+_POOLS: Dict[str, _PoolCuenta] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _pool_de(usuario: str) -> _PoolCuenta:
+    with _POOLS_LOCK:
+        pool = _POOLS.get(usuario)
+        if pool is None:
+            pool = _PoolCuenta()
+            _POOLS[usuario] = pool
+        return pool
+
+
+@contextmanager
+def _sesion_imap(usuario: str | None = None, clave_app: str | None = None, *buzones: str) -> Iterator[_SesionImap]:
+    """Presta una sesión del pool de la cuenta, seleccionando el buzón pedido.
+
+    Las sesiones que fallan con ``abort`` o error de socket se descartan y la
+    siguiente petición abre una nueva; el resto vuelve al pool al terminar.
+    """
+    user, pwd = _credenciales(usuario, clave_app)
+    pool = _pool_de(user)
+    if not pool.cupos.acquire(timeout=ESPERA_CONEXION_SEGUNDOS):
+        raise RuntimeError(f"No hay conexiones IMAP libres para {user}")
+    sesion: _SesionImap | None = None
+    try:
+        with pool.lock:
+            while pool.libres and sesion is None:
+                candidata = pool.libres.pop()
+                if candidata.clave_app == pwd:
+                    sesion = candidata
+                else:
+                    candidata.cerrar()
+        if sesion is None:
+            sesion = _SesionImap(user, pwd)
+        sesion.asegurar_viva()
+        sesion.descartar_pendientes()
+        if buzones:
+            sesion.seleccionar(*buzones)
+        yield sesion
+    except (imaplib.IMAP4.abort, OSError):
+        if sesion is not None:
+            sesion.cerrar()
+            sesion = None
+        raise
+    finally:
+        if sesion is not None and sesion.conexion is not None:
+            sesion.ultimo_uso = time.monotonic()
+            with pool.lock:
+                pool.libres.append(sesion)
+        pool.cupos.release()
+
+
+def cerrar_conexiones_imap(usuario: str | None = None) -> None:
+    """Cierra las sesiones IMAP inactivas del pool (de una cuenta o de todas)."""
+    with _POOLS_LOCK:
+        pools = [_POOLS[usuario]] if usuario in _POOLS else ([] if usuario else list(_POOLS.values()))
+    for pool in pools:
+        with pool.lock:
+            libres, pool.libres = pool.libres, []
+        for sesion in libres:
+            sesion.cerrar()
+
+
+def abrir_conexion_idle(usuario: str | None = None, clave_app: str | None = None) -> imaplib.IMAP4 | None:
+    """Conexión dedicada (fuera del pool) con INBOX seleccionado para IDLE.
+
+    Devuelve None si el servidor no anuncia la capacidad IDLE.
+    """
     conexion = _abrir_conexion(usuario, clave_app)
+    if "IDLE" not in conexion.capabilities:
+        try:
+            conexion.logout()
+        except Exception:
+            pass
+        return None
     conexion.select("INBOX")
-    
+    return conexion
+
+
+def esperar_correo_nuevo(conexion: imaplib.IMAP4, segundos: float, detener: threading.Event | None = None) -> bool:
+    """Mantiene un IDLE hasta ``segundos`` y devuelve True si el servidor avisó EXISTS.
+
+    imaplib (3.11) no implementa IDLE, así que se habla el protocolo a mano:
+    se espera en el socket por tramos cortos para poder atender ``detener``
+    y se cierra siempre con DONE, leyendo hasta la respuesta etiquetada.
+    """
+    tag = conexion._new_tag()
+    conexion.send(tag + b" IDLE\r\n")
+    hay_nuevos = False
+    while True:
+        linea = conexion.readline()
+        if not linea:
+            raise imaplib.IMAP4.abort("conexión cerrada al iniciar IDLE")
+        if linea.startswith(b"+"):
+            break
+        if linea.startswith(tag):
+            raise imaplib.IMAP4.error(f"IDLE rechazado: {linea.decode(errors='replace').strip()}")
+        hay_nuevos = hay_nuevos or linea.rstrip().upper().endswith(b"EXISTS")
+
+    fin = time.monotonic() + segundos
+    sock = conexion.socket()
+    while not hay_nuevos and time.monotonic() < fin:
+        if detener is not None and detener.is_set():
+            break
+        pendiente = getattr(sock, "pending", lambda: 0)()
+        if not pendiente:
+            listos, _, _ = select.select([sock], [], [], min(2.0, max(0.0, fin - time.monotonic())))
+            if not listos:
+                continue
+        linea = conexion.readline()
+        if not linea:
+            raise imaplib.IMAP4.abort("conexión cerrada durante IDLE")
+        hay_nuevos = linea.rstrip().upper().endswith(b"EXISTS")
+
+    conexion.send(b"DONE\r\n")
+    while True:
+        linea = conexion.readline()
+        if not linea:
+            raise imaplib.IMAP4.abort("conexión cerrada al terminar IDLE")
+        if linea.startswith(tag):
+            break
+        hay_nuevos = hay_nuevos or linea.rstrip().upper().endswith(b"EXISTS")
+    return hay_nuevos
+
+
+def _fecha_imap(fecha: datetime) -> str:
+    """Formato de fecha de SEARCH ("5-Mar-2026"), independiente del locale."""
+    return f"{fecha.day}-{MESES_IMAP[fecha.month - 1]}-{fecha.year}"
+
+
+def _rango_de_escaneo(hoy: datetime, filtro_fecha_especifica: int, fecha_filtro: str | None, desde_fecha: str | None) -> Tuple[datetime, datetime]:
+    """Calcula la ventana [inicio, fin] de los tres modos de fecha del escaneo."""
+    dias_nombres = ["LUNES", "MARTES", "MIÉRCOLES", "JUEVES", "VIERNES", "SÁBADO", "DOMINGO"]
+    dia_semana = hoy.weekday()  # 0=lunes, 1=martes, ..., 6=domingo
+    inicio_hoy = hoy.replace(hour=0, minute=0, second=0, microsecond=0)
+    fin_hoy = hoy.replace(hour=23, minute=59, second=59, microsecond=999999)
+
+    if filtro_fecha_especifica == 1 and fecha_filtro:
+        # Filtrar por fecha específica
+        try:
+            fecha_obj = datetime.strptime(fecha_filtro, '%Y-%m-%d')
+            print(f"📅 Filtrando correos de la fecha específica: {fecha_filtro}")
+            return (
+                fecha_obj.replace(hour=0, minute=0, second=0, microsecond=0),
+                fecha_obj.replace(hour=23, minute=59, second=59, microsecond=999999),
+            )
+        except Exception as e:
+            print(f"⚠️  Error parseando fecha específica, usando fecha actual: {e}")
+            return inicio_hoy, fin_hoy
+    if desde_fecha:
+        # Usar la fecha proporcionada (lógica original para lunes)
+        try:
+            # Parsear la fecha en formato IMAP "DD-Mon-YYYY"
+            fecha_dt = datetime.strptime(desde_fecha, '%d-%b-%Y')
+            print(f"📅 Filtrando correos desde fecha proporcionada: {desde_fecha}")
+            return fecha_dt.replace(hour=0, minute=0, second=0, microsecond=0), fin_hoy
+        except Exception as e:
+            print(f"⚠️  Error parseando fecha proporcionada, usando fecha actual: {e}")
+            return inicio_hoy, fin_hoy
+    if dia_semana == 0:  # LUNES
+        # Leer correos del sábado (hace 2 días), domingo (hace 1 día) y lunes (hoy)
+        fecha_inicio = inicio_hoy - timedelta(days=2)
+        print(f"📅 Filtrando correos desde SÁBADO {fecha_inicio.strftime('%d/%m/%Y')} hasta LUNES {fin_hoy.strftime('%d/%m/%Y')}")
+        return fecha_inicio, fin_hoy
+    # MARTES a DOMINGO: leer solo correos de HOY
+    print(f"📅 Filtrando correos solo de HOY {dias_nombres[dia_semana]} {inicio_hoy.strftime('%d/%m/%Y')}")
+    return inicio_hoy, fin_hoy
+
+
+def _refinar_por_fecha(conexion: imaplib.IMAP4, ids: List[str], fecha_inicio: datetime, fecha_fin: datetime) -> List[str]:
+    """Filtro exacto por la cabecera Date, con un único FETCH para todos los ids."""
+    estado, datos = conexion.uid("FETCH", _conjunto_imap(ids), "(BODY.PEEK[HEADER.FIELDS (DATE)])")
+    if estado != "OK":
+        return ids
+    return _filtrar_por_fecha(datos, ids, fecha_inicio, fecha_fin)
+
+
+def _filtrar_por_fecha(datos: List[Any], ids: List[str], fecha_inicio: datetime, fecha_fin: datetime) -> List[str]:
+    """Ids cuya cabecera Date (de la respuesta FETCH) cae en el rango."""
+    import email.utils
+
+    fechas: Dict[str, str] = {}
+    for item in _agrupar_fetch(datos):
+        cabecera = next(iter(item["secciones"].values()), b"")
+        fechas[item["uid"]] = email.message_from_bytes(cabecera).get("Date", "")
+
+    ids_filtrados = []
+    for correo_id in ids:
+        fecha_str = fechas.get(correo_id, "")
+        try:
+            fecha_tuple = email.utils.parsedate_tz(fecha_str) if fecha_str else None
+            if not fecha_tuple:
+                print(f"⚠️  Correo ID {correo_id} no tiene fecha, incluyendo por seguridad")
+                ids_filtrados.append(correo_id)
+                continue
+            fecha_correo = datetime.fromtimestamp(email.utils.mktime_tz(fecha_tuple))
+            # Verificar si el correo está en el rango de fechas
+            if fecha_inicio <= fecha_correo <= fecha_fin:
+                ids_filtrados.append(correo_id)
+            else:
+                print(f"🔍 Correo ID {correo_id}: {fecha_correo.strftime('%d/%m/%Y %H:%M')} - Fuera del rango")
+        except Exception as e:
+            print(f"⚠️  Error procesando correo ID {correo_id}: {e}")
+            ids_filtrados.append(correo_id)
+    return ids_filtrados
+
+
+def obtener_ids_no_leidos(max_total: int | None = None, usuario: str | None = None, clave_app: str | None = None, desde_fecha: str | None = None, usuario_id: int | None = None, filtro_exacto: bool = False, incremental: bool = False) -> List[str]:
+    """UIDs de los correos no leídos dentro de la ventana de fechas del escaneo.
+
+    La ventana viaja en la propia búsqueda (``UNSEEN SINCE ... BEFORE ...``),
+    que Gmail evalúa por fecha interna y día completo. Con ``filtro_exacto``
+    se comprueba además la cabecera Date de todos los candidatos en un FETCH.
+
+    Con ``incremental`` solo se buscan UIDs posteriores al checkpoint guardado
+    del usuario; si el UIDVALIDITY del buzón cambió, se reinicia el checkpoint
+    y se hace una resincronización completa de la ventana. En modo
+    incremental se devuelven los ``max_total`` más antiguos, para que el
+    checkpoint avance sin saltarse correos.
+    """
+    criterio, fecha_inicio, fecha_fin, fecha_especifica = _criterio_no_leidos(usuario_id, desde_fecha)
+    # La búsqueda por fecha específica es un re-escaneo histórico: no usa ni mueve el checkpoint.
+    incremental = incremental and bool(usuario_id) and not fecha_especifica
+
+    with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        conexion = sesion.conexion
+        ultimo_uid = 0
+        if incremental:
+            ultimo_uid = _checkpoint_vigente(usuario_id, "INBOX", sesion.uidvalidity)
+            if ultimo_uid:
+                criterio += f" UID {ultimo_uid + 1}:*"
+        estado, datos = conexion.uid("SEARCH", None, criterio)
+        ids_decod = _uids_posteriores(estado, datos, ultimo_uid)
+        print(f"📬 Correos NO LEÍDOS dentro del rango ({criterio}): {len(ids_decod)}")
+
+        if ids_decod and filtro_exacto:
+            ids_decod = _refinar_por_fecha(conexion, ids_decod, fecha_inicio, fecha_fin)
+            print(f"✅ Correos que cumplen el filtro exacto de fecha: {len(ids_decod)}")
+
+    if max_total is not None:
+        ids_decod = ids_decod[:max_total] if incremental else ids_decod[-max_total:]
+
+    return ids_decod
+
+
+def _criterio_no_leidos(usuario_id: int | None, desde_fecha: str | None) -> Tuple[str, datetime, datetime, bool]:
+    """Criterio UNSEEN SINCE/BEFORE del escaneo según la configuración del usuario.
+
+    Devuelve ``(criterio, fecha_inicio, fecha_fin, fecha_especifica)``.
+    """
     # Detectar día de la semana y configuración de filtro
     hoy = datetime.now()
     dia_semana = hoy.weekday()  # 0=lunes, 1=martes, ..., 6=domingo
     dias_nombres = ["LUNES", "MARTES", "MIÉRCOLES", "JUEVES", "VIERNES", "SÁBADO", "DOMINGO"]
-    
+
     # Verificar configuración de filtro por fecha específica
     filtro_fecha_especifica = 0
     fecha_filtro = None
-    
+
     if usuario_id:
         try:
             from .db import obtener_usuario_por_id
@@ -45,318 +437,953 @@ def obtener_ids_no_leidos(max_total: int | None = None, usuario: str | None = No
                 fecha_filtro = usuario_data[12] if len(usuario_data) > 12 and usuario_data[12] else None
         except Exception as e:
             print(f"⚠️  Error obteniendo configuración de filtro: {e}")
-    
+
     print(f"\n{'='*60}")
     print(f"🔍 ESCANEO INICIADO - Hoy es {dias_nombres[dia_semana]} {hoy.strftime('%d/%m/%Y %H:%M')}")
     if filtro_fecha_especifica == 1 and fecha_filtro:
         print(f"📅 FILTRADO POR FECHA ESPECÍFICA: {fecha_filtro}")
     print(f"{'='*60}")
-    
-    # Buscar correos no leídos
-    estado, datos = conexion.search(None, 'UNSEEN')
-    ids = datos[0].split()
-    ids_decod = [i.decode() for i in ids]
-    
-    print(f"📬 Total de correos NO LEÍDOS en bandeja: {len(ids_decod)}")
-    
-    if ids_decod:
-        ids_filtrados = []
-        
-        # Definir rango de fechas
-        if filtro_fecha_especifica == 1 and fecha_filtro:
-            # Filtrar por fecha específica
-            try:
-                fecha_obj = datetime.strptime(fecha_filtro, '%Y-%m-%d')
-                fecha_inicio = fecha_obj.replace(hour=0, minute=0, second=0, microsecond=0)
-                fecha_fin = fecha_obj.replace(hour=23, minute=59, second=59, microsecond=999999)
-                print(f"📅 Filtrando correos de la fecha específica: {fecha_filtro}")
-            except Exception as e:
-                print(f"⚠️  Error parseando fecha específica, usando fecha actual: {e}")
-                fecha_inicio = hoy.replace(hour=0, minute=0, second=0, microsecond=0)
-                fecha_fin = hoy.replace(hour=23, minute=59, second=59, microsecond=999999)
-        elif desde_fecha:
-            # Usar la fecha proporcionada (lógica original para lunes)
-            try:
-                # Parsear la fecha en formato IMAP "DD-Mon-YYYY"
-                fecha_dt = datetime.strptime(desde_fecha, '%d-%b-%Y')
-                fecha_inicio = fecha_dt.replace(hour=0, minute=0, second=0, microsecond=0)
-                fecha_fin = hoy.replace(hour=23, minute=59, second=59, microsecond=999999)
-                print(f"📅 Filtrando correos desde fecha proporcionada: {desde_fecha}")
-            except Exception as e:
-                print(f"⚠️  Error parseando fecha proporcionada, usando fecha actual: {e}")
-                fecha_inicio = hoy.replace(hour=0, minute=0, second=0, microsecond=0)
-                fecha_fin = hoy.replace(hour=23, minute=59, second=59, microsecond=999999)
-        else:
-            # Lógica normal según día de la semana
-            if dia_semana == 0:  # LUNES
-                # Leer correos del sábado (hace 2 días), domingo (hace 1 día) y lunes (hoy)
-                fecha_sabado = (hoy - timedelta(days=2)).replace(hour=0, minute=0, second=0, microsecond=0)
-                fecha_inicio = fecha_sabado
-                fecha_fin = hoy.replace(hour=23, minute=59, second=59, microsecond=999999)
-                print(f"📅 Filtrando correos desde SÁBADO {fecha_inicio.strftime('%d/%m/%Y')} hasta LUNES {fecha_fin.strftime('%d/%m/%Y')}")
-            else:  # MARTES a DOMINGO
-                # Leer solo correos de HOY
-                fecha_inicio = hoy.replace(hour=0, minute=0, second=0, microsecond=0)
-                fecha_fin = hoy.replace(hour=23, minute=59, second=59, microsecond=999999)
-                print(f"📅 Filtrando correos solo de HOY {dias_nombres[dia_semana]} {fecha_inicio.strftime('%d/%m/%Y')}")
-        
-        # Filtrar correos por fecha
-        for correo_id in ids_decod:
-            try:
-                estado_fetch, datos_fetch = conexion.fetch(correo_id.encode(), '(BODY.PEEK[HEADER.FIELDS (DATE)])')
-                if estado_fetch == 'OK':
-                    header_data = datos_fetch[0][1]
-                    msg = email.message_from_bytes(header_data)
-                    fecha_str = msg.get('Date', '')
-                    
-                    if fecha_str:
-                        fecha_tuple = email.utils.parsedate_tz(fecha_str)
-                        if fecha_tuple:
-                            fecha_correo = datetime.fromtimestamp(email.utils.mktime_tz(fecha_tuple))
-                            
-                            # Verificar si el correo está en el rango de fechas
-                            if fecha_inicio <= fecha_correo <= fecha_fin:
-                                ids_filtrados.append(correo_id)
-                            else:
-                                print(f"🔍 Correo ID {correo_id}: {fecha_correo.strftime('%d/%m/%Y %H:%M')} - Fuera del rango")
-                    else:
-                        print(f"⚠️  Correo ID {correo_id} no tiene fecha, incluyendo por seguridad")
-                        ids_filtrados.append(correo_id)
-            except Exception as e:
-                print(f"⚠️  Error procesando correo ID {correo_id}: {e}")
-                ids_filtrados.append(correo_id)
-        
-        ids_decod = ids_filtrados
-        print(f"✅ Correos que cumplen el filtro de fecha: {len(ids_decod)}")
-    
-    conexion.logout()
-    
-    if max_total is not None:
-        ids_decod = ids_decod[-max_total:]
-    
-    return ids_decod
 
+    fecha_inicio, fecha_fin = _rango_de_escaneo(hoy, filtro_fecha_especifica, fecha_filtro, desde_fecha)
+    criterio = f"UNSEEN SINCE {_fecha_imap(fecha_inicio)} BEFORE {_fecha_imap(fecha_fin + timedelta(days=1))}"
+    return criterio, fecha_inicio, fecha_fin, bool(filtro_fecha_especifica == 1 and fecha_filtro)
 
-def obtener_correos_por_ids(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> List[Dict[str, Any]]:
-    conexion = _abrir_conexion(usuario, clave_app)
-    conexion.select("INBOX")
-    resultados: List[Dict[str, str]] = []
-    for correo_id in ids:
-        estado, datos_correo = conexion.fetch(correo_id.encode(), "(BODY.PEEK[] X-GM-THRID)")
+
+def _uids_posteriores(estado: str, datos: List[Any], ultimo_uid: int) -> List[str]:
+    """UIDs de una respuesta SEARCH mayores que ``ultimo_uid``, en orden."""
+    ids_decod = [i.decode() for i in datos[0].split()] if estado == "OK" and datos and datos[0] else []
+    # "n:*" incluye siempre el último UID aunque sea menor que n.
+    return sorted((i for i in ids_decod if int(i) > ultimo_uid), key=int)
+
+
+def _checkpoint_vigente(usuario_id: int, buzon: str, uidvalidity: int | None) -> int:
+    """Último UID procesado, o 0 si no hay checkpoint o el UIDVALIDITY cambió."""
+    from .db import guardar_checkpoint_sync, guardar_modseq_sync, obtener_checkpoint_sync
+
+    if uidvalidity is None:
+        return 0
+    checkpoint = obtener_checkpoint_sync(usuario_id, buzon)
+    if checkpoint and checkpoint[0] == uidvalidity:
+        print(f"🔖 Checkpoint {buzon}: UID > {checkpoint[1]}")
+        return int(checkpoint[1] or 0)
+    if checkpoint:
+        print(f"♻️  UIDVALIDITY de {buzon} cambió ({checkpoint[0]} -> {uidvalidity}), resincronizando")
+    guardar_checkpoint_sync(usuario_id, buzon, uidvalidity, 0)
+    guardar_modseq_sync(usuario_id, buzon, uidvalidity, 0)
+    return 0
+
+
+def obtener_cambios_flags(desde_modseq: int, usuario: str | None = None, clave_app: str | None = None, buzon: str = "INBOX") -> Tuple[Dict[str, Dict[str, Any]], int | None, int | None]:
+    """Flags y etiquetas de los mensajes con MODSEQ posterior a ``desde_modseq`` (CONDSTORE).
+
+    Devuelve ``({uid: {"flags", "etiquetas"}}, highestmodseq, uidvalidity)``.
+    Sin ``desde_modseq`` solo consulta el HIGHESTMODSEQ actual (STATUS), que
+    sirve de punto de partida; si el servidor no anuncia CONDSTORE, el
+    highestmodseq devuelto es None.
+    """
+    with _sesion_imap(usuario, clave_app, buzon) as sesion:
+        conexion = sesion.conexion
+        if "CONDSTORE" not in conexion.capabilities:
+            return {}, None, sesion.uidvalidity
+        if not desde_modseq:
+            estado, datos = conexion.status(_nombre_buzon(buzon), "(HIGHESTMODSEQ)")
+            return {}, _highestmodseq_de_status(estado, datos), sesion.uidvalidity
+        estado, datos = conexion.uid("FETCH", "1:*", f"(UID FLAGS X-GM-LABELS) (CHANGEDSINCE {desde_modseq})")
         if estado != "OK":
+            return {}, None, sesion.uidvalidity
+        cambios, highestmodseq = _cambios_desde_fetch(datos, desde_modseq)
+        return cambios, highestmodseq, sesion.uidvalidity
+
+
+def _highestmodseq_de_status(estado: str, datos: List[Any]) -> int | None:
+    m = re.search(rb"HIGHESTMODSEQ (\d+)", datos[0] or b"") if estado == "OK" and datos else None
+    return int(m.group(1)) if m else None
+
+
+def _cambios_desde_fetch(datos: List[Any], desde_modseq: int) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """Flags, etiquetas y MODSEQ máximo de una respuesta FETCH con CHANGEDSINCE."""
+    cambios: Dict[str, Dict[str, Any]] = {}
+    highestmodseq = desde_modseq
+    for item in _agrupar_fetch(datos):
+        if not item["uid"]:
             continue
-        raw = datos_correo[0]
-        raw_bytes = raw[1] if isinstance(raw, tuple) else raw
-        mensaje = email.message_from_bytes(raw_bytes)
-        thread_id = ""
-        try:
-            raw_str = raw[0].decode() if isinstance(raw, tuple) else b"".decode()
-        except Exception:
-            raw_str = ""
-        try:
-            if not raw_str and isinstance(datos_correo[0], bytes):
-                raw_str = datos_correo[0].decode(errors="ignore")
-        except Exception:
-            pass
-        try:
-            mthr = re.search(r"X-GM-THRID\s+(\d+)", raw_str or "")
-            if mthr:
-                thread_id = mthr.group(1)
-        except Exception:
-            thread_id = ""
-        remitente_raw = mensaje.get("From", "")
-        asunto_raw = mensaje.get("Subject", "")
-        message_id = mensaje.get("Message-ID", "")
+        flags = re.search(r"FLAGS \(([^)]*)\)", item["meta"])
+        etiquetas = re.search(r"X-GM-LABELS \(([^)]*)\)", item["meta"])
+        modseq = re.search(r"MODSEQ \((\d+)\)", item["meta"])
+        cambios[item["uid"]] = {
+            "flags": set(flags.group(1).split()) if flags else set(),
+            "etiquetas": set(re.findall(r'"[^"]*"|\S+', etiquetas.group(1))) if etiquetas else set(),
+        }
+        if modseq:
+            highestmodseq = max(highestmodseq, int(modseq.group(1)))
+    return cambios, highestmodseq
 
-        def _dec(h: str) -> str:
-            try:
-                parts = decode_header(h)
-                out = ""
-                for text, enc in parts:
-                    if isinstance(text, bytes):
-                        out += text.decode(enc or "utf-8", errors="replace")
-                    else:
-                        out += text
-                return out
-            except Exception:
-                return h
-
-        remitente = _dec(remitente_raw)
-        asunto = _dec(asunto_raw)
-        from_email = parseaddr(remitente_raw)[1]
-
-        cuerpo = ""
-        imagen_mime: str | None = None
-        imagen_datos: bytes | None = None
-        if mensaje.is_multipart():
-            for parte in mensaje.walk():
-                tipo = parte.get_content_type()
-                disposicion = str(parte.get("Content-Disposition"))
-                if tipo == "text/plain" and "attachment" not in disposicion:
-                    cuerpo = parte.get_payload(decode=True).decode(
-                        parte.get_content_charset() or "utf-8",
-                        errors="replace",
-                    )
-                    break
-            if not cuerpo:
-                for parte in mensaje.walk():
-                    tipo = parte.get_content_type()
-                    disposicion = str(parte.get("Content-Disposition"))
-                    if tipo == "text/html" and "attachment" not in disposicion:
-                        html = parte.get_payload(decode=True).decode(
-                            parte.get_content_charset() or "utf-8",
-                            errors="replace",
-                        )
-                        cuerpo = re.sub(r"<[^>]+>", " ", html)
-                        cuerpo = re.sub(r"\s+", " ", cuerpo).strip()
-                        break
-            if imagen_mime is None:
-                for parte in mensaje.walk():
-                    tipo = parte.get_content_type()
-                    if tipo.startswith("image/"):
-                        datos = parte.get_payload(decode=True)
-                        if isinstance(datos, bytes):
-                            imagen_mime = tipo
-                            imagen_datos = datos
-                            break
-        else:
-            cuerpo = mensaje.get_payload(decode=True).decode(
-                mensaje.get_content_charset() or "utf-8",
-                errors="replace",
-            )
 
-        resultados.append(
-            {
-                "id": correo_id,
-                "remitente": remitente,
-                "asunto": asunto,
-                "cuerpo": cuerpo,
-                "message_id": message_id,
-                "from_email": from_email or remitente,
-                "imagen_mime": imagen_mime,
-                "imagen_datos": imagen_datos,
-                "thread_id": thread_id,
-            }
-        )
+def descartar_atendidos(ids: List[str], usuario_id: int, usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    """Quita de ``ids`` los correos que una persona leyó o respondió desde el último MODSEQ guardado.
 
-    conexion.logout()
-    return resultados
+    Cada llamada cuesta un ``UID FETCH 1:* ... (CHANGEDSINCE n)`` cuya respuesta
+    solo trae los mensajes modificados. Los archivados salen de INBOX y ya no
+    aparecen al descargar el lote.
+    """
+    from .db import obtener_checkpoint_sync
 
-def obtener_historial_por_thread(thread_id: str, limite: int = 5, usuario: str | None = None, clave_app: str | None = None) -> List[Dict[str, Any]]:
-    if not thread_id:
-        return []
-    conexion = _abrir_conexion(usuario, clave_app)
+    checkpoint = obtener_checkpoint_sync(usuario_id, "INBOX")
+    desde_modseq = checkpoint[2] if checkpoint else 0
+    cambios, highestmodseq, uidvalidity = obtener_cambios_flags(desde_modseq, usuario, clave_app)
+    return _sin_atendidos(ids, usuario_id, checkpoint, cambios, highestmodseq, uidvalidity)
+
+
+def _sin_atendidos(ids: List[str], usuario_id: int, checkpoint: Tuple[Any, ...] | None, cambios: Dict[str, Dict[str, Any]], highestmodseq: int | None, uidvalidity: int | None) -> List[str]:
+    from .db import guardar_modseq_sync
+
+    if highestmodseq is None or uidvalidity is None:
+        return ids
+    if checkpoint and checkpoint[0] != uidvalidity:
+        return ids
+    guardar_modseq_sync(usuario_id, "INBOX", uidvalidity, highestmodseq)
+    atendidos = {
+        uid for uid, cambio in cambios.items()
+        if cambio["flags"] & {"\\Seen", "\\Answered", "\\Deleted"}
+    }
+    restantes = [i for i in ids if i not in atendidos]
+    if len(restantes) != len(ids):
+        print(f"👤 {len(ids) - len(restantes)} correos ya atendidos por una persona, omitidos")
+    return restantes
+
+
+def obtener_uidvalidity(usuario: str | None = None, clave_app: str | None = None, buzon: str = "INBOX") -> int | None:
+    """UIDVALIDITY actual del buzón (sin ida y vuelta si la sesión ya lo tiene seleccionado)."""
+    with _sesion_imap(usuario, clave_app, buzon) as sesion:
+        return sesion.uidvalidity
+
+
+def obtener_claves_mensajes(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> Dict[str, str]:
+    """Clave estable de cada UID (su X-GM-MSGID) sin bajar cuerpos.
+
+    El Message-ID no sirve de clave: lo elige el remitente, y uno repetido a
+    propósito haría saltar correos que nunca se clasificaron.
+    """
+    if not ids:
+        return {}
+    with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        estado, datos = sesion.conexion.uid("FETCH", _conjunto_imap(ids), "(X-GM-MSGID)")
+        if estado != "OK":
+            return {}
+    return _claves_desde_fetch(datos)
+
+
+def _claves_desde_fetch(datos: List[Any]) -> Dict[str, str]:
+    claves: Dict[str, str] = {}
+    for item in _agrupar_fetch(datos):
+        gm_msgid = _atributo_fetch(item["meta"], "X-GM-MSGID")
+        if gm_msgid:
+            claves[item["uid"]] = gm_msgid
+    return claves
+
+
+def _conjunto_imap(ids: List[str]) -> str:
+    """Compacta una lista de ids en un message set IMAP ("3:7,9,12:13")."""
+    numeros = sorted({int(i) for i in ids})
+    tramos: List[str] = []
+    inicio = previo = None
+    for n in numeros:
+        if previo is not None and n == previo + 1:
+            previo = n
+            continue
+        if inicio is not None:
+            tramos.append(str(inicio) if inicio == previo else f"{inicio}:{previo}")
+        inicio = previo = n
+    if inicio is not None:
+        tramos.append(str(inicio) if inicio == previo else f"{inicio}:{previo}")
+    return ",".join(tramos)
+
+
+def _agrupar_fetch(datos: List[Any]) -> List[Dict[str, Any]]:
+    """Agrupa la respuesta de imaplib a un FETCH de varios mensajes.
+
+    Cada elemento trae ``seq``, ``uid`` (vacío si el FETCH no lo devolvió),
+    ``meta`` (atributos sin literal, p. ej. X-GM-THRID) y ``secciones``
+    (etiqueta como ``BODY[]`` -> bytes).
+    """
+    mensajes: List[Dict[str, Any]] = []
+    actual: Dict[str, Any] | None = None
+    abiertos = 0
+    for item in datos:
+        if item is None:
+            continue
+        cabecera = item[0] if isinstance(item, tuple) else item
+        texto = cabecera.decode("utf-8", errors="replace")
+        # Solo empieza otro mensaje cuando el paréntesis del anterior ya cerró
+        inicio = re.match(r"\s*(\d+) \(", texto) if abiertos <= 0 else None
+        if inicio:
+            abiertos = 1
+            actual = {"seq": inicio.group(1), "meta": "", "secciones": {}}
+            mensajes.append(actual)
+            texto = texto[inicio.end():]
+        if actual is None:
+            continue
+        if isinstance(item, tuple):
+            metodo = re.search(r"((?:BODY|BINARY)\[[^\]]*\](?:<\d+>)?|RFC822(?:\.HEADER|\.TEXT)?)\s*\{\d+\}\s*$", texto, re.IGNORECASE)
+            literal = re.search(r"\{\d+\}\s*$", texto)
+            if metodo:
+                actual["secciones"][metodo.group(1).upper()] = item[1]
+                texto = texto[: metodo.start()]
+            elif literal:
+                # Literal dentro de otro atributo (p. ej. un nombre de archivo en BODYSTRUCTURE)
+                valor = item[1].decode("utf-8", errors="replace").replace("\\", "\\\\").replace('"', '\\"')
+                texto = f'{texto[: literal.start()]}"{valor}"'
+        actual["meta"] += " " + texto
+        sin_cadenas = re.sub(r'"(?:[^"\\]|\\.)*"', "", texto)
+        abiertos += sin_cadenas.count("(") - sin_cadenas.count(")")
+    for mensaje in mensajes:
+        mensaje["uid"] = _atributo_fetch(mensaje["meta"], "UID")
+    return mensajes
+
+
+def _atributo_fetch(meta: str, nombre: str) -> str:
+    m = re.search(rf"{re.escape(nombre)}\s+(\d+)", meta or "")
+    return m.group(1) if m else ""
+
+
+def _decodificar_cabecera(h: str) -> str:
     try:
-        conexion.select("[Gmail]/All Mail")
+        parts = decode_header(h)
+        out = ""
+        for text, enc in parts:
+            if isinstance(text, bytes):
+                try:
+                    out += text.decode(enc or "utf-8", errors="replace")
+                except LookupError:
+                    # Cabeceras en UTF-8 crudo llegan como "unknown-8bit"
+                    out += text.decode("utf-8", errors="replace")
+            else:
+                out += text
+        return out
     except Exception:
-        conexion.select("INBOX")
-    estado, datos = conexion.search(None, f"X-GM-THRID {thread_id}")
+        return h
+
+
+def _cabecera_y_cuerpo(raw: bytes, inicio: int, fin: int) -> Tuple[int, int]:
+    """Fin de las cabeceras y comienzo del cuerpo de la entidad ``raw[inicio:fin]``."""
+    if raw.startswith(b"\r\n", inicio):
+        return inicio, inicio + 2
+    if raw.startswith(b"\n", inicio):
+        return inicio, inicio + 1
+    crlf = raw.find(b"\r\n\r\n", inicio, fin)
+    lf = raw.find(b"\n\n", inicio, fin)
+    if crlf != -1 and (lf == -1 or crlf < lf):
+        return crlf + 2, crlf + 4
+    if lf != -1:
+        return lf + 1, lf + 2
+    return fin, fin
+
+
+def _siguiente_delimitador(raw: bytes, delimitador: bytes, inicio: int, fin: int) -> int:
+    """Posición del próximo ``--boundary`` a comienzo de línea, o -1."""
+    if raw.startswith(delimitador, inicio):
+        return inicio
+    pos = raw.find(b"\n" + delimitador, inicio, fin)
+    return pos + 1 if pos != -1 else -1
+
+
+def _hojas_mime(raw: bytes, inicio: int = 0, fin: int | None = None) -> Iterator[Tuple[Message, int, int]]:
+    """Recorre las partes hoja en el orden de ``walk()`` sin copiar sus cuerpos.
+
+    Solo se parsean las cabeceras de cada parte (con el FeedParser de la
+    librería estándar); de cada hoja se devuelven sus cabeceras y el rango
+    ``[desde, hasta)`` de su cuerpo dentro de ``raw``. Al ser un generador,
+    quien deja de iterar deja de recorrer el mensaje.
+    """
+    fin = len(raw) if fin is None else fin
+    fin_cabecera, cuerpo = _cabecera_y_cuerpo(raw, inicio, fin)
+    cabeceras = BytesHeaderParser().parsebytes(raw[inicio:fin_cabecera])
+    if cabeceras.get_content_type() == "message/rfc822":
+        yield from _hojas_mime(raw, cuerpo, fin)
+        return
+    boundary = cabeceras.get_boundary() if cabeceras.get_content_maintype() == "multipart" else None
+    if not boundary:
+        yield cabeceras, cuerpo, fin
+        return
+    delimitador = b"--" + boundary.encode("ascii", errors="replace")
+    pos = _siguiente_delimitador(raw, delimitador, cuerpo, fin)
+    while pos != -1:
+        despues = pos + len(delimitador)
+        if raw.startswith(b"--", despues):
+            break
+        salto = raw.find(b"\n", despues, fin)
+        if salto == -1:
+            break
+        siguiente = _siguiente_delimitador(raw, delimitador, salto + 1, fin)
+        hasta = siguiente if siguiente != -1 else fin
+        # El salto de línea previo al delimitador pertenece al delimitador
+        if raw[hasta - 2:hasta] == b"\r\n":
+            hasta -= 2
+        elif raw[hasta - 1:hasta] == b"\n":
+            hasta -= 1
+        yield from _hojas_mime(raw, salto + 1, max(hasta, salto + 1))
+        pos = siguiente
+
+
+def _texto_de_hoja(raw: bytes, parte: Message, desde: int, hasta: int, max_bytes: int) -> str:
+    datos = _decodificar_parte(raw[desde:min(hasta, desde + max_bytes)], parte.get("Content-Transfer-Encoding", "7bit").strip().lower())
+    try:
+        return datos.decode(parte.get_content_charset() or "utf-8", errors="replace")
+    except LookupError:
+        return datos.decode("utf-8", errors="replace")
+
+
+def _leer_mime(raw_bytes: bytes, completo: bool = True) -> Tuple[Message, str, str | None, bytes | None]:
+    """Cabeceras, texto y primera imagen de un mensaje, sin materializar adjuntos.
+
+    Mismo criterio que el recorrido con ``walk()``: el primer text/plain que
+    no sea adjunto, si no hay el primer text/html (sin etiquetas), y la
+    primera parte image/*; con ``completo=False`` solo el text/plain. Deja
+    de recorrer en cuanto tiene lo que busca y nunca decodifica más de
+    MAX_BYTES_MENSAJE bytes por mensaje: el texto se corta y una imagen que
+    no cabe se omite.
+    """
+    fin_cabecera, inicio_cuerpo = _cabecera_y_cuerpo(raw_bytes, 0, len(raw_bytes))
+    cabecera = BytesHeaderParser().parsebytes(raw_bytes[:fin_cabecera])
+    if cabecera.get_content_maintype() != "multipart":
+        return cabecera, _texto_de_hoja(raw_bytes, cabecera, inicio_cuerpo, len(raw_bytes), MAX_BYTES_MENSAJE), None, None
+
+    texto = html = imagen = None
+    for parte, desde, hasta in _hojas_mime(raw_bytes):
+        tipo = parte.get_content_type()
+        adjunto = "attachment" in str(parte.get("Content-Disposition"))
+        if tipo == "text/plain" and not adjunto and texto is None:
+            texto = (parte, desde, hasta)
+        elif completo and tipo == "text/html" and not adjunto and html is None and texto is None:
+            html = (parte, desde, hasta)
+        elif completo and tipo.startswith("image/") and imagen is None:
+            imagen = (parte, desde, hasta)
+        if texto is not None and (imagen is not None or not completo):
+            break
+
+    presupuesto = MAX_BYTES_MENSAJE
+    cuerpo = ""
+    if texto is not None:
+        cuerpo = _texto_de_hoja(raw_bytes, *texto, presupuesto)
+    elif html is not None:
+        cuerpo = re.sub(r"<[^>]+>", " ", _texto_de_hoja(raw_bytes, *html, presupuesto))
+        cuerpo = re.sub(r"\s+", " ", cuerpo).strip()
+    presupuesto -= len(cuerpo.encode("utf-8", errors="replace"))
+    if imagen is None:
+        return cabecera, cuerpo, None, None
+    parte, desde, hasta = imagen
+    if hasta - desde > presupuesto:
+        print(f"⚠️  [MIME] Imagen de {(hasta - desde) // 1024} KB omitida: supera el tope por mensaje")
+        return cabecera, cuerpo, None, None
+    datos = _decodificar_parte(raw_bytes[desde:hasta], parte.get("Content-Transfer-Encoding", "7bit").strip().lower())
+    return cabecera, cuerpo, parte.get_content_type(), datos
+
+
+def _correo_desde_bytes(correo_id: str, raw_bytes: bytes, thread_id: str = "") -> Dict[str, Any]:
+    mensaje, cuerpo, imagen_mime, imagen_datos = _leer_mime(raw_bytes)
+    remitente_raw = mensaje.get("From", "")
+    asunto_raw = mensaje.get("Subject", "")
+    message_id = mensaje.get("Message-ID", "")
+
+    remitente = _decodificar_cabecera(remitente_raw)
+    asunto = _decodificar_cabecera(asunto_raw)
+    from_email = parseaddr(remitente_raw)[1]
+
+    return {
+        "id": correo_id,
+        "remitente": remitente,
+        "asunto": asunto,
+        "cuerpo": cuerpo,
+        "message_id": message_id,
+        "from_email": from_email or remitente,
+        "imagen_mime": imagen_mime,
+        "imagen_datos": imagen_datos,
+        "thread_id": thread_id,
+    }
+
+
+def _lotes_desde_tamanos(estado: str, datos: List[Any], ids: List[str], max_bytes: int) -> List[List[str]]:
+    """Reparte los ids en lotes cuyo RFC822.SIZE sumado no supera ``max_bytes``."""
+    tamanos: Dict[str, int] = {}
+    if estado == "OK":
+        for item in _agrupar_fetch(datos):
+            tamano = _atributo_fetch(item["meta"], "RFC822.SIZE")
+            if tamano:
+                tamanos[item["uid"]] = int(tamano)
+    lotes: List[List[str]] = []
+    lote: List[str] = []
+    acumulado = 0
+    for correo_id in ids:
+        tamano = tamanos.get(correo_id, 0)
+        if lote and acumulado + tamano > max_bytes:
+            lotes.append(lote)
+            lote, acumulado = [], 0
+        lote.append(correo_id)
+        acumulado += tamano
+    if lote:
+        lotes.append(lote)
+    return lotes
+
+
+def _parsear_sexp(texto: str, inicio: int = 0) -> Tuple[Any, int]:
+    """Lee una expresión IMAP (lista entre paréntesis, cadena, NIL o átomo)."""
+    i = inicio
+    while i < len(texto) and texto[i] == " ":
+        i += 1
+    if texto[i] == "(":
+        elementos: List[Any] = []
+        i += 1
+        while True:
+            while i < len(texto) and texto[i] == " ":
+                i += 1
+            if texto[i] == ")":
+                return elementos, i + 1
+            valor, i = _parsear_sexp(texto, i)
+            elementos.append(valor)
+    if texto[i] == '"':
+        valor = []
+        i += 1
+        while texto[i] != '"':
+            if texto[i] == "\\":
+                i += 1
+            valor.append(texto[i])
+            i += 1
+        return "".join(valor), i + 1
+    fin = i
+    while fin < len(texto) and texto[fin] not in " ()":
+        fin += 1
+    atomo = texto[i:fin]
+    return (None if atomo.upper() == "NIL" else atomo), fin
+
+
+def _partes_bodystructure(estructura: List[Any], prefijo: str = "") -> List[Dict[str, Any]]:
+    """Aplana un BODYSTRUCTURE en partes hoja, en el mismo orden que ``walk()``."""
+    if estructura and isinstance(estructura[0], list):
+        # Multiparte: primero las partes hijas (listas), luego el subtipo y la extensión
+        partes: List[Dict[str, Any]] = []
+        for indice, hijo in enumerate(estructura):
+            if not isinstance(hijo, list):
+                break
+            partes.extend(_partes_bodystructure(hijo, f"{prefijo}{indice + 1}."))
+        return partes
+    parametros = estructura[2] if isinstance(estructura[2], list) else []
+    nombres = [str(x).lower() for x in parametros[0::2]]
+    charset = parametros[2 * nombres.index("charset") + 1] if "charset" in nombres else None
+    extension = estructura[7:]
+    adjunto = any(
+        isinstance(x, list) and x and isinstance(x[0], str) and x[0].lower() == "attachment"
+        for x in extension
+    )
+    return [{
+        "numero": prefijo.rstrip(".") or "1",
+        "tipo": f"{estructura[0]}/{estructura[1]}".lower(),
+        "charset": charset,
+        "codificacion": (estructura[5] or "7bit").lower(),
+        "tamano": int(estructura[6] or 0),
+        "adjunto": adjunto,
+    }]
+
+
+def _decodificar_parte(datos: bytes, codificacion: str) -> bytes:
+    """Deshace el Content-Transfer-Encoding, tolerando un corte a mitad (rango parcial)."""
+    if codificacion == "base64":
+        limpio = re.sub(rb"[^A-Za-z0-9+/=]", b"", datos)
+        limpio = limpio[: len(limpio) - len(limpio) % 4]
+        try:
+            return base64.b64decode(limpio)
+        except (binascii.Error, ValueError):
+            return b""
+    if codificacion == "quoted-printable":
+        return quopri.decodestring(re.sub(rb"=[0-9A-Fa-f]?$", b"", datos))
+    return datos
+
+
+def _texto_de_parte(datos: bytes, parte: Dict[str, Any]) -> str:
+    crudo = _decodificar_parte(datos, parte["codificacion"])
+    try:
+        return crudo.decode(parte["charset"] or "utf-8", errors="replace")
+    except LookupError:
+        return crudo.decode("utf-8", errors="replace")
+
+
+def _correos_por_partes(conexion: imaplib.IMAP4, cuenta: str, ids: List[str]) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+    """Descarga en dos fases solo lo que usa la IA.
+
+    1. ``BODYSTRUCTURE`` + cabeceras + X-GM-THRID de todos los ids.
+    2. Por cada grupo de mensajes con las mismas secciones, un FETCH de la
+       parte de texto con rango (``BODY.PEEK[1]<0.N>``) y de la primera
+       imagen si no pasa de MAX_BYTES_IMAGEN.
+
+    Devuelve los correos armados y los ids que hay que pedir completos
+    (estructura ilegible o secciones que no llegaron).
+    """
+    estado, datos = conexion.uid("FETCH", _conjunto_imap(ids), ITEMS_ESTRUCTURA)
     if estado != "OK":
-        conexion.logout()
-        return []
-    ids = datos[0].split()
-    ids_decod = [i.decode() for i in ids][-limite:]
-    historial: List[Dict[str, Any]] = []
-    for mid in ids_decod:
-        est2, dat2 = conexion.fetch(mid.encode(), "(BODY.PEEK[])")
-        if est2 != "OK":
+        return {}, list(ids)
+    planes, completos = _planes_por_partes(cuenta, datos, ids)
+
+    recibidas: Dict[str, Dict[str, bytes]] = {}
+    for secciones, grupo in _grupos_por_secciones(planes):
+        estado, datos = conexion.uid("FETCH", _conjunto_imap(grupo), f"({' '.join(secciones)})")
+        if estado != "OK":
             continue
-        msg = email.message_from_bytes(dat2[0][1])
-        remitente_raw = msg.get("From", "")
-        asunto_raw = msg.get("Subject", "")
-        fecha_raw = msg.get("Date", "")
-        def _dec(h: str) -> str:
-            try:
-                parts = decode_header(h)
-                out = ""
-                for text, enc in parts:
-                    if isinstance(text, bytes):
-                        out += text.decode(enc or "utf-8", errors="replace")
-                    else:
-                        out += text
-                return out
-            except Exception:
-                return h
-        remitente = _dec(remitente_raw)
-        asunto = _dec(asunto_raw)
-        cuerpo = ""
-        if msg.is_multipart():
-            for parte in msg.walk():
-                tipo = parte.get_content_type()
-                disp = str(parte.get("Content-Disposition"))
-                if tipo == "text/plain" and "attachment" not in disp:
-                    try:
-                        cuerpo = parte.get_payload(decode=True).decode(parte.get_content_charset() or "utf-8", errors="replace")
-                    except Exception:
-                        cuerpo = ""
-                    break
+        for item in _agrupar_fetch(datos):
+            recibidas[item["uid"]] = item["secciones"]
+    return _armar_correos_por_partes(planes, recibidas, completos)
+
+
+# Fase 1 de la descarga parcial: estructura, cabeceras e identificadores de Gmail.
+ITEMS_ESTRUCTURA = "(X-GM-THRID X-GM-MSGID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID)])"
+# Antes de bajar mensajes completos: tamaño y clave para el almacén local.
+ITEMS_TAMANO = "(RFC822.SIZE X-GM-THRID X-GM-MSGID)"
+
+
+def _clave_de_item(item: Dict[str, Any]) -> str:
+    """Clave del almacén local a partir de un FETCH con X-GM-MSGID ("" si no vino)."""
+    return almacen.clave_mensaje(_atributo_fetch(item["meta"], "X-GM-MSGID"))
+
+
+def _correos_desde_almacen(cuenta: str, datos: List[Any], ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Correos de ``ids`` que ya están en el almacén local (según un FETCH de ITEMS_TAMANO)."""
+    correos: Dict[str, Dict[str, Any]] = {}
+    if not almacen.ALMACEN_ACTIVO:
+        return correos
+    for item in _agrupar_fetch(datos):
+        if item["uid"] not in ids:
+            continue
+        raw_bytes = almacen.leer(cuenta, _clave_de_item(item))
+        if raw_bytes is not None:
+            correos[item["uid"]] = _correo_desde_bytes(item["uid"], raw_bytes, _atributo_fetch(item["meta"], "X-GM-THRID"))
+    return correos
+
+
+def _planes_por_partes(cuenta: str, datos: List[Any], ids: List[str]) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+    """Fase 1: qué secciones pedir de cada id según su BODYSTRUCTURE.
+
+    Los que ya están en el almacén local llegan con el correo armado
+    (``plan["correo"]``) y sin secciones que pedir.
+    """
+    planes: Dict[str, Dict[str, Any]] = {}
+    completos: List[str] = []
+    for item in _agrupar_fetch(datos):
+        uid = item["uid"]
+        if uid not in ids:
+            continue
+        raw_bytes = almacen.leer(cuenta, _clave_de_item(item)) if almacen.ALMACEN_ACTIVO else None
+        if raw_bytes is not None:
+            thread_id = _atributo_fetch(item["meta"], "X-GM-THRID")
+            planes[uid] = {"correo": _correo_desde_bytes(uid, raw_bytes, thread_id), "secciones": ()}
+            continue
+        posicion = item["meta"].upper().find("BODYSTRUCTURE ")
+        try:
+            estructura, _ = _parsear_sexp(item["meta"], posicion + len("BODYSTRUCTURE "))
+            partes = _partes_bodystructure(estructura)
+        except (IndexError, ValueError, TypeError):
+            partes = []
+        if posicion < 0 or not partes:
+            completos.append(uid)
+            continue
+        multiparte = isinstance(estructura[0], list)
+        texto = None
+        if multiparte:
+            texto = next((x for x in partes if x["tipo"] == "text/plain" and not x["adjunto"]), None)
+            texto = texto or next((x for x in partes if x["tipo"] == "text/html" and not x["adjunto"]), None)
         else:
-            try:
-                cuerpo = msg.get_payload(decode=True).decode(msg.get_content_charset() or "utf-8", errors="replace")
-            except Exception:
-                cuerpo = ""
-        cuerpo = re.sub(r"\s+", " ", cuerpo or "").strip()
-        historial.append({"from": remitente, "subject": asunto, "date": fecha_raw, "body": cuerpo})
-    conexion.logout()
-    return historial
+            texto = partes[0]
+        imagen = next((x for x in partes if x["tipo"].startswith("image/")), None) if multiparte else None
+        if imagen is not None and imagen["tamano"] > MAX_BYTES_IMAGEN:
+            imagen = None
+        secciones = []
+        if texto is not None:
+            limite = MAX_BYTES_HTML if texto["tipo"] == "text/html" else MAX_BYTES_TEXTO
+            secciones.append(f"BODY.PEEK[{texto['numero']}]<0.{limite}>")
+        if imagen is not None:
+            secciones.append(f"BODY.PEEK[{imagen['numero']}]")
+        planes[uid] = {
+            "cabecera": next(iter(item["secciones"].values()), b""),
+            "thread_id": _atributo_fetch(item["meta"], "X-GM-THRID"),
+            "texto": texto,
+            "imagen": imagen,
+            "multiparte": multiparte,
+            "secciones": tuple(secciones),
+        }
+    completos.extend(i for i in ids if i not in planes and i not in completos)
+    return planes, completos
 
 
-def marcar_como_leido(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> None:
-    if not ids:
+def _grupos_por_secciones(planes: Dict[str, Dict[str, Any]]) -> List[Tuple[Tuple[str, ...], List[str]]]:
+    """Fase 2: un FETCH por cada combinación de secciones (y message set acotado)."""
+    grupos: Dict[Tuple[str, ...], List[str]] = {}
+    for uid, plan in planes.items():
+        grupos.setdefault(plan["secciones"], []).append(uid)
+    return [
+        (secciones, grupo)
+        for secciones, uids in grupos.items() if secciones
+        for grupo in _conjuntos_acotados(uids)
+    ]
+
+
+def _armar_correos_por_partes(planes: Dict[str, Dict[str, Any]], recibidas: Dict[str, Dict[str, bytes]], completos: List[str]) -> Tuple[Dict[str, Dict[str, Any]], List[str]]:
+    """Arma los correos con las secciones recibidas; lo que falte pasa a ``completos``."""
+    correos: Dict[str, Dict[str, Any]] = {}
+    for uid, plan in planes.items():
+        if "correo" in plan:
+            correos[uid] = plan["correo"]
+            continue
+        obtenidas = recibidas.get(uid, {})
+        texto, imagen = plan["texto"], plan["imagen"]
+        datos_texto = obtenidas.get(f"BODY[{texto['numero']}]<0>") if texto else b""
+        datos_imagen = obtenidas.get(f"BODY[{imagen['numero']}]") if imagen else None
+        if datos_texto is None or (imagen is not None and datos_imagen is None):
+            completos.append(uid)
+            continue
+        mensaje = email.message_from_bytes(plan["cabecera"])
+        remitente_raw = mensaje.get("From", "")
+        cuerpo = _texto_de_parte(datos_texto, texto) if texto else ""
+        if plan["multiparte"] and texto and texto["tipo"] == "text/html":
+            cuerpo = re.sub(r"<[^>]+>", " ", cuerpo)
+            cuerpo = re.sub(r"\s+", " ", cuerpo).strip()
+        correos[uid] = {
+            "id": uid,
+            "remitente": _decodificar_cabecera(remitente_raw),
+            "asunto": _decodificar_cabecera(mensaje.get("Subject", "")),
+            "cuerpo": cuerpo,
+            "message_id": mensaje.get("Message-ID", ""),
+            "from_email": parseaddr(remitente_raw)[1] or _decodificar_cabecera(remitente_raw),
+            "imagen_mime": imagen["tipo"] if imagen else None,
+            "imagen_datos": _decodificar_parte(datos_imagen, imagen["codificacion"]) if imagen else None,
+            "thread_id": plan["thread_id"],
+        }
+    return correos, completos
+
+
+def _descargar_correos(ids: List[str], por_id: Dict[str, Dict[str, Any]], usuario: str | None, clave_app: str | None, max_bytes: int) -> None:
+    """Descarga en una sola sesión los ids que aún no están en ``por_id``."""
+    faltantes = [i for i in ids if i not in por_id]
+    if not faltantes:
         return
-    conexion = _abrir_conexion(usuario, clave_app)
-    conexion.select("INBOX")
-    for correo_id in ids:
+    with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        conexion = sesion.conexion
+        completos = faltantes
+        if FETCH_PARCIAL:
+            parciales, completos = _correos_por_partes(conexion, sesion.usuario, faltantes)
+            por_id.update(parciales)
+        lotes: List[List[str]] = []
+        if completos:
+            estado, datos = conexion.uid("FETCH", _conjunto_imap(completos), ITEMS_TAMANO)
+            # Con FETCH_PARCIAL el almacén ya se consultó en la fase 1 y sus aciertos vinieron en ``parciales``
+            revisar = estado == "OK" and not FETCH_PARCIAL
+            en_almacen = _correos_desde_almacen(sesion.usuario, datos, completos) if revisar else {}
+            por_id.update(en_almacen)
+            completos = [i for i in completos if i not in en_almacen]
+            lotes = _lotes_desde_tamanos(estado, datos, completos, max_bytes)
+        for lote in lotes:
+            estado, datos = conexion.uid("FETCH", _conjunto_imap(lote), "(BODY.PEEK[] X-GM-THRID X-GM-MSGID)")
+            if estado == "OK":
+                por_id.update(_correos_completos_desde_fetch(sesion.usuario, datos, lote))
+
+
+def _correos_completos_desde_fetch(cuenta: str, datos: List[Any], lote: List[str]) -> Dict[str, Dict[str, Any]]:
+    correos: Dict[str, Dict[str, Any]] = {}
+    for item in _agrupar_fetch(datos):
+        raw_bytes = item["secciones"].get("BODY[]")
+        if raw_bytes is None or item["uid"] not in lote:
+            continue
+        thread_id = _atributo_fetch(item["meta"], "X-GM-THRID")
+        correos[item["uid"]] = _correo_desde_bytes(item["uid"], raw_bytes, thread_id)
+        almacen.guardar(cuenta, _clave_de_item(item), raw_bytes)
+    return correos
+
+
+def _descargar_con_reintentos(ids: List[str], usuario: str | None, clave_app: str | None, max_bytes: int) -> Dict[str, Dict[str, Any]]:
+    """Worker de descarga: si su sesión se cae, reintenta solo lo que le falta."""
+    por_id: Dict[str, Dict[str, Any]] = {}
+    for intento in range(REINTENTOS_FETCH + 1):
         try:
-            conexion.store(correo_id, "+FLAGS", "\\Seen")
-        except Exception:
-            pass
-    conexion.logout()
+            _descargar_correos(ids, por_id, usuario, clave_app, max_bytes)
+            return por_id
+        except (imaplib.IMAP4.abort, OSError) as e:
+            if intento == REINTENTOS_FETCH:
+                print(f"⚠️  [IMAP] Worker de descarga sin conexión tras {intento + 1} intentos: {e}")
+                return por_id
+            print(f"🔁 [IMAP] Conexión perdida en descarga ({e}); reintento {intento + 1}/{REINTENTOS_FETCH}")
+            time.sleep(min(2 ** intento, 10))
+    return por_id
+
+
+def obtener_correos_por_ids(ids: List[str], usuario: str | None = None, clave_app: str | None = None, max_bytes_por_fetch: int | None = None, workers: int = 1) -> List[Dict[str, Any]]:
+    """Descarga los correos pedidos con un FETCH por lote en vez de uno por id.
+
+    Por defecto solo se bajan la parte de texto (con rango) y una imagen
+    pequeña, guiándose por BODYSTRUCTURE; los mensajes que no se pueden
+    resolver así se piden completos, en lotes que no traen más de
+    ``max_bytes_por_fetch`` bytes (KYBER_IMAP_MAX_BYTES_FETCH por defecto).
 
-def marcar_como_no_leido(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> None:
+    Con ``workers`` > 1 la lista se reparte en tramos contiguos, cada uno
+    descargado en su propia sesión del pool; el resultado conserva el orden
+    de ``ids``.
+    """
     if not ids:
-        return
-    conexion = _abrir_conexion(usuario, clave_app)
-    conexion.select("INBOX")
-    for correo_id in ids:
+        return []
+    max_bytes = max_bytes_por_fetch or MAX_BYTES_POR_FETCH
+    workers = max(1, min(workers or 1, MAX_CONEXIONES_POR_CUENTA, len(ids)))
+    if workers == 1:
+        por_id = _descargar_con_reintentos(ids, usuario, clave_app, max_bytes)
+        return [por_id[i] for i in ids if i in por_id]
+
+    tamano = -(-len(ids) // workers)
+    tramos = [ids[i:i + tamano] for i in range(0, len(ids), tamano)]
+    por_id = {}
+    with ThreadPoolExecutor(max_workers=len(tramos), thread_name_prefix="kyber-fetch") as ejecutor:
+        futuros = [ejecutor.submit(_descargar_con_reintentos, tramo, usuario, clave_app, max_bytes) for tramo in tramos]
+        for futuro in futuros:
+            por_id.update(futuro.result())
+    return [por_id[i] for i in ids if i in por_id]
+
+
+def _entrada_historial(raw_bytes: bytes) -> Dict[str, str]:
+    msg, cuerpo, _, _ = _leer_mime(raw_bytes, completo=False)
+    cuerpo = re.sub(r"\s+", " ", cuerpo or "").strip()
+    return {
+        "from": _decodificar_cabecera(msg.get("From", "")),
+        "subject": _decodificar_cabecera(msg.get("Subject", "")),
+        "date": msg.get("Date", ""),
+        "body": cuerpo,
+    }
+
+
+def _criterio_hilos(thread_ids: List[str]) -> str:
+    """``OR X-GM-THRID a OR X-GM-THRID b X-GM-THRID c`` (OR de IMAP es binario)."""
+    criterio = f"X-GM-THRID {thread_ids[-1]}"
+    for thread_id in reversed(thread_ids[:-1]):
+        criterio = f"OR X-GM-THRID {thread_id} {criterio}"
+    return criterio
+
+
+def obtener_historiales_por_threads(thread_ids: List[str], limite: int = 5, usuario: str | None = None, clave_app: str | None = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Historial de varios hilos a la vez, apoyándose en la caché ``historial_hilos``.
+
+    Un UID SEARCH con los X-GM-THRID unidos por OR (por tramos de
+    HILOS_POR_BUSQUEDA) dice qué UIDs tiene hoy cada hilo; si hay más de un
+    hilo, un FETCH de X-GM-THRID los reparte. Después se descargan en un solo
+    FETCH los mensajes que no estaban en la caché. Un hilo cuyo UID más
+    nuevo ya estaba guardado no descarga nada.
+    """
+    pedidos = list(dict.fromkeys(t for t in thread_ids if t))
+    if not pedidos:
+        return {}
+    user, pwd = _credenciales(usuario, clave_app)
+    uids_por_hilo: Dict[str, List[str]] = {t: [] for t in pedidos}
+    with _sesion_imap(user, pwd, "[Gmail]/All Mail", "INBOX") as sesion:
+        conexion = sesion.conexion
+        for i in range(0, len(pedidos), HILOS_POR_BUSQUEDA):
+            tramo = pedidos[i : i + HILOS_POR_BUSQUEDA]
+            estado, datos = conexion.uid("SEARCH", None, _criterio_hilos(tramo))
+            uids = [u.decode() for u in (datos[0] or b"").split()] if estado == "OK" and datos else []
+            if len(tramo) == 1:
+                uids_por_hilo[tramo[0]].extend(uids)
+            elif uids:
+                estado, datos = conexion.uid("FETCH", _conjunto_imap(uids), "(X-GM-THRID)")
+                if estado == "OK":
+                    _repartir_por_hilo(datos, uids_por_hilo)
+        # Los UIDs solo valen para el buzón y UIDVALIDITY en que se leyeron
+        cache = _CacheHistoriales(user, f"{sesion.buzon}:{sesion.uidvalidity}", pedidos, uids_por_hilo, limite)
+        if almacen.ALMACEN_ACTIVO:
+            for grupo in cache.grupos_faltantes():
+                estado, datos = conexion.uid("FETCH", _conjunto_imap(grupo), "(X-GM-MSGID)")
+                if estado == "OK":
+                    cache.resolver_desde_almacen(datos)
+        for grupo in cache.grupos_faltantes():
+            estado, datos = conexion.uid("FETCH", _conjunto_imap(grupo), "(BODY.PEEK[] X-GM-MSGID)")
+            if estado == "OK":
+                cache.agregar(datos)
+    return cache.guardar()
+
+
+def _repartir_por_hilo(datos: List[Any], uids_por_hilo: Dict[str, List[str]]) -> None:
+    for item in _agrupar_fetch(datos):
+        thread_id = _atributo_fetch(item["meta"], "X-GM-THRID")
+        if thread_id in uids_por_hilo and item["uid"]:
+            uids_por_hilo[thread_id].append(item["uid"])
+
+
+class _CacheHistoriales:
+    """Cruza los UIDs actuales de cada hilo con la caché ``historial_hilos``."""
+
+    def __init__(self, cuenta: str, buzon: str, pedidos: List[str], uids_por_hilo: Dict[str, List[str]], limite: int) -> None:
+        from .db import obtener_historial_hilo
+
+        self.cuenta = cuenta
+        self.buzon = buzon
+        self.pedidos = pedidos
+        self.uids_por_hilo = uids_por_hilo
+        self.conocidos: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.en_cache: Dict[str, Tuple[str, int, List[Dict[str, Any]]] | None] = {}
+        self.faltantes: Dict[str, str] = {}
+        self.por_descargar: set[str] = set()
+        for thread_id in pedidos:
+            uids_por_hilo[thread_id] = sorted(set(uids_por_hilo[thread_id]), key=int)[-limite:]
+            self.en_cache[thread_id] = obtener_historial_hilo(cuenta, thread_id)
+            previo = self.en_cache[thread_id]
+            self.conocidos[thread_id] = {m["uid"]: m for m in previo[2] if "uid" in m} if previo and previo[0] == buzon else {}
+            for uid in uids_por_hilo[thread_id]:
+                if uid not in self.conocidos[thread_id]:
+                    self.faltantes[uid] = thread_id
+        self.por_descargar = set(self.faltantes)
+
+    def grupos_faltantes(self) -> List[List[str]]:
+        return _conjuntos_acotados(list(self.por_descargar)) if self.por_descargar else []
+
+    def _conocer(self, uid: str, raw_bytes: bytes) -> None:
+        self.conocidos[self.faltantes[uid]][uid] = {"uid": uid, **_entrada_historial(raw_bytes)}
+        self.por_descargar.discard(uid)
+
+    def resolver_desde_almacen(self, datos: List[Any]) -> None:
+        """Toma del almacén local los faltantes cuyas claves trae ``datos``."""
+        for item in _agrupar_fetch(datos):
+            if item["uid"] in self.por_descargar:
+                raw_bytes = almacen.leer(self.cuenta, _clave_de_item(item))
+                if raw_bytes is not None:
+                    self._conocer(item["uid"], raw_bytes)
+
+    def agregar(self, datos: List[Any]) -> None:
+        for item in _agrupar_fetch(datos):
+            raw_bytes = item["secciones"].get("BODY[]")
+            if raw_bytes is not None and item["uid"] in self.por_descargar:
+                self._conocer(item["uid"], raw_bytes)
+                almacen.guardar(self.cuenta, _clave_de_item(item), raw_bytes)
+
+    def guardar(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Persiste los hilos que cambiaron y devuelve los historiales sin la clave ``uid``."""
+        from .db import guardar_historial_hilo
+
+        resultado: Dict[str, List[Dict[str, Any]]] = {}
+        for thread_id in self.pedidos:
+            uids = self.uids_por_hilo[thread_id]
+            historial = [self.conocidos[thread_id][u] for u in uids if u in self.conocidos[thread_id]]
+            previo = self.en_cache[thread_id]
+            nuevos = any(self.faltantes.get(u) == thread_id for u in uids)
+            if uids and (nuevos or not previo or previo[0] != self.buzon or len(historial) != len(previo[2])):
+                guardar_historial_hilo(self.cuenta, thread_id, self.buzon, int(uids[-1]), historial, MAX_BYTES_CACHE_HILOS)
+            resultado[thread_id] = [{k: v for k, v in m.items() if k != "uid"} for m in historial]
+        return resultado
+
+
+def obtener_historial_por_thread(thread_id: str, limite: int = 5, usuario: str | None = None, clave_app: str | None = None) -> List[Dict[str, Any]]:
+    """Últimos ``limite`` mensajes de un hilo (ver ``obtener_historiales_por_threads``)."""
+    if not thread_id:
+        return []
+    return obtener_historiales_por_threads([thread_id], limite, usuario, clave_app).get(thread_id, [])
+
+
+def _conjuntos_acotados(ids: List[str], max_caracteres: int | None = None) -> List[List[str]]:
+    """Parte los ids en grupos cuyo message set no pasa de ``max_caracteres``."""
+    limite = max_caracteres or MAX_LARGO_CONJUNTO
+    grupos: List[List[str]] = []
+    grupo: List[str] = []
+    largo = 0
+    for correo_id in sorted({str(i) for i in ids}, key=int):
+        # Cota superior: cada id suma su longitud más un separador
+        if grupo and largo + len(correo_id) + 1 > limite:
+            grupos.append(grupo)
+            grupo, largo = [], 0
+        grupo.append(correo_id)
+        largo += len(correo_id) + 1
+    if grupo:
+        grupos.append(grupo)
+    return grupos
+
+
+def _store_por_lotes(conexion: imaplib.IMAP4, ids: List[str], operacion: str, valor: str) -> List[str]:
+    """UID STORE por message set; devuelve los ids que el servidor no confirmó.
+
+    Sin ``.SILENT`` el servidor responde un FETCH por mensaje modificado, así
+    se sabe qué ids fallaron. Si un lote entero es rechazado se reintenta id
+    por id para aislar los culpables.
+    """
+    fallidos: List[str] = []
+    for grupo in _conjuntos_acotados(ids):
         try:
-            conexion.store(correo_id, "-FLAGS", "\\Seen")
-        except Exception:
-            pass
-    conexion.logout()
-def archivar_ids(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> None:
+            estado, datos = conexion.uid("STORE", _conjunto_imap(grupo), operacion, valor)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error:
+            estado, datos = "NO", []
+        if estado == "OK":
+            confirmados = {item["uid"] for item in _agrupar_fetch(datos or [])}
+            fallidos.extend(i for i in grupo if i not in confirmados)
+            continue
+        if len(grupo) == 1:
+            fallidos.extend(grupo)
+            continue
+        for correo_id in grupo:
+            fallidos.extend(_store_por_lotes(conexion, [correo_id], operacion, valor))
+    return fallidos
+
+
+def _sin_confirmar_en_buzon(conexion: imaplib.IMAP4, ids: List[str]) -> List[str]:
+    """De los ids sin confirmar, los que siguen en el buzón seleccionado.
+
+    Al quitar la etiqueta \\Inbox el mensaje sale de la vista y Gmail puede
+    no devolver el FETCH de confirmación; que ya no esté cuenta como éxito.
+    """
     if not ids:
-        return
-    conexion = _abrir_conexion(usuario, clave_app)
-    conexion.select("INBOX")
-    for correo_id in ids:
-        ok = False
-        try:
-            conexion.store(correo_id, "+X-GM-LABELS", "Archivados")
-        except Exception:
-            pass
+        return []
+    presentes: set[str] = set()
+    for grupo in _conjuntos_acotados(ids):
+        estado, datos = conexion.uid("SEARCH", None, f"UID {_conjunto_imap(grupo)}")
+        if estado == "OK" and datos and datos[0]:
+            presentes.update(u.decode() for u in datos[0].split())
+    return [i for i in ids if i in presentes]
+
+
+def marcar_como_leido(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    """Marca los correos como leídos; devuelve los ids que no se pudieron marcar."""
+    if not ids:
+        return []
+    with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        return _store_por_lotes(sesion.conexion, ids, "+FLAGS", "\\Seen")
+
+def marcar_como_no_leido(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    """Marca los correos como no leídos; devuelve los ids que no se pudieron marcar."""
+    if not ids:
+        return []
+    with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        return _store_por_lotes(sesion.conexion, ids, "-FLAGS", "\\Seen")
+
+def archivar_ids(ids: List[str], usuario: str | None = None, clave_app: str | None = None) -> List[str]:
+    """Archiva (etiqueta "Archivados" y sale de INBOX); devuelve los ids que no se archivaron.
+
+    Cada paso es un comando por message set; solo los ids que fallan pasan
+    a la alternativa siguiente (etiqueta "Inbox", y luego COPY + \\Deleted).
+    """
+    if not ids:
+        return []
+    with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        conexion = sesion.conexion
+        _store_por_lotes(conexion, ids, "+X-GM-LABELS", "Archivados")
+        pendientes = _sin_confirmar_en_buzon(conexion, _store_por_lotes(conexion, ids, "-X-GM-LABELS", "\\Inbox"))
+        if pendientes:
+            pendientes = _sin_confirmar_en_buzon(conexion, _store_por_lotes(conexion, pendientes, "-X-GM-LABELS", "Inbox"))
+        fallidos: List[str] = []
+        for grupo in _conjuntos_acotados(pendientes):
+            try:
+                estado, _ = conexion.uid("COPY", _conjunto_imap(grupo), '"[Gmail]/All Mail"')
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error:
+                estado = "NO"
+            if estado != "OK":
+                fallidos.extend(grupo)
+                continue
+            fallidos.extend(_store_por_lotes(conexion, grupo, "+FLAGS", "\\Deleted"))
         try:
-            conexion.store(correo_id, "-X-GM-LABELS", "\\Inbox")
-            ok = True
+            conexion.expunge()
         except Exception:
             pass
-        if not ok:
-            try:
-                conexion.store(correo_id, "-X-GM-LABELS", "Inbox")
-                ok = True
-            except Exception:
-                pass
-        if not ok:
-            try:
-                conexion.copy(correo_id, "[Gmail]/All Mail")
-                conexion.store(correo_id, "+FLAGS", "\\Deleted")
-            except Exception:
-                pass
-    try:
-        conexion.expunge()
-    except Exception:
-        pass
-    conexion.logout()
+    if fallidos:
+        print(f"⚠️  No se pudieron archivar {len(fallidos)} correos: {fallidos[:20]}")
+    return fallidos
 
 def crear_borrador(
     responder_a: str,
@@ -382,36 +1409,276 @@ def crear_borrador(
     #     "Sabanarlarga, Atlántico"
     # )
     
+    escritor = EscritorBorradores(user, pwd)
+    escritor.agregar(responder_a, asunto, cuerpo, in_reply_to, references, firma)
+    escritor.escribir()
+
+
+class EscritorBorradores:
+    """Acumula los borradores de un chunk y los escribe todos en una sola sesión.
+
+    Con MULTIAPPEND (RFC 3502) va un único APPEND con todos los mensajes;
+    si no (Gmail), un APPEND por borrador sobre la misma conexión. Los UIDs
+    del APPENDUID y un FETCH de X-GM-THRID actualizan el índice de
+    borradores sin releer la carpeta.
+    """
+
+    def __init__(self, usuario: str | None = None, clave_app: str | None = None) -> None:
+        self.usuario = usuario
+        self.clave_app = clave_app
+        self.pendientes: List[Dict[str, Any]] = []
+
+    def agregar(
+        self,
+        responder_a: str,
+        asunto: str,
+        cuerpo: str,
+        in_reply_to: str | None = None,
+        references: str | None = None,
+        firma_personalizada: str | None = None,
+        thread_id: str = "",
+    ) -> None:
+        user = self.usuario or os.environ.get("KYBER_GMAIL_USER") or ""
+        self.pendientes.append({
+            "mensaje": _mensaje_html(user, responder_a, asunto, cuerpo, in_reply_to, references, firma_personalizada, "<br>"),
+            "in_reply_to": in_reply_to,
+            "references": references,
+            "thread_id": thread_id,
+        })
+
+    def tiene_pendiente(self, thread_id: str = "", message_id: str = "") -> bool:
+        """Si ya hay un borrador en cola para ese hilo o mensaje (aún no escrito)."""
+        mid = _normalizar_message_id(message_id) if message_id else ""
+        for pendiente in self.pendientes:
+            if thread_id and pendiente["thread_id"] == thread_id:
+                return True
+            if mid and mid in f"{pendiente['in_reply_to'] or ''} {pendiente['references'] or ''}":
+                return True
+        return False
+
+    def escribir(self) -> List[str]:
+        """Escribe los borradores pendientes; devuelve sus UIDs ("" si no se conocen)."""
+        pendientes, self.pendientes = self.pendientes, []
+        if not pendientes:
+            return []
+        user, pwd = _credenciales(self.usuario, self.clave_app)
+        uids = [""] * len(pendientes)
+        hilos: Dict[str, str] = {}
+        with _sesion_imap(user, pwd) as sesion:
+            conexion = sesion.conexion
+            escritos = None
+            if len(pendientes) > 1 and "MULTIAPPEND" in conexion.capabilities:
+                with metricas_imap.medir(conexion, "MULTIAPPEND"):
+                    escritos = _multiappend(conexion, "[Gmail]/Drafts", [p["mensaje"].as_bytes() for p in pendientes])
+            if escritos is not None:
+                uids = escritos
+            else:
+                timestamp = imaplib.Time2Internaldate(time.time())
+                for indice, pendiente in enumerate(pendientes):
+                    estado, datos = conexion.append("[Gmail]/Drafts", "", timestamp, pendiente["mensaje"].as_bytes())
+                    uids[indice] = _uid_de_append(estado, datos)
+            conocidos = [u for u in uids if u]
+            if conocidos:
+                try:
+                    sesion.seleccionar("[Gmail]/Drafts", "Drafts")
+                    estado, datos = conexion.uid("FETCH", _conjunto_imap(conocidos), "(X-GM-THRID)")
+                    if estado == "OK":
+                        hilos = {x["uid"]: _atributo_fetch(x["meta"], "X-GM-THRID") for x in _agrupar_fetch(datos)}
+                except imaplib.IMAP4.abort:
+                    raise
+                except imaplib.IMAP4.error:
+                    pass
+        for uid, pendiente in zip(uids, pendientes):
+            _registrar_borrador(user, uid, pendiente["in_reply_to"], pendiente["references"], hilos.get(uid, "") or pendiente["thread_id"])
+        if len(pendientes) > 1:
+            print(f"📝 [IMAP] {len(pendientes)} borradores escritos en una sesión")
+        return uids
+
+
+def _multiappend(conexion: imaplib.IMAP4, buzon: str, mensajes: List[bytes]) -> List[str] | None:
+    """APPEND con varios literales (imaplib no lo implementa).
+
+    Devuelve los UIDs asignados ("" si el servidor no manda APPENDUID), o
+    None si el servidor rechazó el comando (que es atómico: no escribió nada).
+    """
+    tag = conexion._new_tag()
+    fecha = imaplib.Time2Internaldate(time.time())
+    literales = [re.sub(rb"\r\n|\r|\n", b"\r\n", m) for m in mensajes]
+    partes = [f"{fecha} {{{len(literales[0])}}}".encode()]
+    partes += [f" {fecha} {{{len(l)}}}".encode() for l in literales[1:]]
+    conexion.send(tag + b" APPEND " + _nombre_buzon(buzon).encode() + b" " + partes[0] + b"\r\n")
+    siguiente = 0
+    while True:
+        linea = conexion.readline()
+        if not linea:
+            raise imaplib.IMAP4.abort("conexión cerrada durante MULTIAPPEND")
+        if linea.startswith(b"+") and siguiente < len(literales):
+            cola = partes[siguiente + 1] if siguiente + 1 < len(partes) else b""
+            conexion.send(literales[siguiente] + cola + b"\r\n")
+            siguiente += 1
+            continue
+        if linea.startswith(tag):
+            break
+    if not linea[len(tag):].strip().upper().startswith(b"OK"):
+        print(f"⚠️  MULTIAPPEND rechazado: {linea.decode(errors='replace').strip()}")
+        return None
+    m = re.search(rb"APPENDUID \d+ ([\d:,]+)", linea)
+    if not m:
+        return [""] * len(mensajes)
+    uids: List[str] = []
+    for tramo in m.group(1).decode().split(","):
+        inicio, _, fin = tramo.partition(":")
+        uids.extend(str(u) for u in range(int(inicio), int(fin or inicio) + 1))
+    return uids if len(uids) == len(mensajes) else [""] * len(mensajes)
+
+
+def _mensaje_html(
+    remitente: str,
+    destinatario: str,
+    asunto: str,
+    cuerpo: str,
+    in_reply_to: str | None,
+    references: str | None,
+    firma: str | None,
+    separador_firma: str,
+) -> MIMEText:
+    """Arma la respuesta en HTML con la firma y las cabeceras de hilo."""
     if firma and firma.strip() not in cuerpo:
         firma_html = firma.replace("\n", "<br>")
-        cuerpo = f"{cuerpo}<br>{firma_html}"
+        cuerpo = f"{cuerpo}{separador_firma}{firma_html}"
 
     # Convertir saltos de línea del cuerpo a HTML
     cuerpo_html = cuerpo.replace("\n", "<br>")
 
     mensaje = MIMEText(cuerpo_html, "html", _charset="utf-8")
-    mensaje["From"] = user
-    mensaje["To"] = responder_a
+    mensaje["From"] = remitente
+    mensaje["To"] = destinatario
     mensaje["Subject"] = asunto
     if in_reply_to:
         mensaje["In-Reply-To"] = in_reply_to
     if references:
         mensaje["References"] = references
+    return mensaje
 
-    conexion = _abrir_conexion(user, pwd)
 
-    timestamp = imaplib.Time2Internaldate(time.time())
-    conexion.append(
-        "[Gmail]/Drafts",
-        "",
-        timestamp,
-        mensaje.as_bytes(),
-    )
+def _uid_de_append(estado: str, datos: List[Any]) -> str:
+    """UID asignado por el servidor según el código APPENDUID de la respuesta."""
+    mapp = re.search(rb"APPENDUID \d+ (\d+)", datos[0] or b"") if estado == "OK" and datos else None
+    return mapp.group(1).decode() if mapp else ""
 
-    conexion.logout()
 
+def _registrar_borrador(user: str, uid: str, in_reply_to: str | None, references: str | None, thread_id: str) -> None:
+    with _INDICES_LOCK:
+        indice = _INDICES_BORRADORES.get(user)
+    if indice is not None:
+        indice.registrar(uid, f"{in_reply_to or ''} {references or ''}", thread_id)
 
-def enviar_correo(
+
+def _abrir_smtp(usuario: str, clave_app: str) -> smtplib.SMTP:
+    if SMTP_SSL:
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PUERTO, timeout=60)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PUERTO, timeout=60)
+    server.login(usuario, clave_app)
+    return server
+
+
+class EnvioPendiente:
+    """Estado de entrega de un mensaje encolado ("EN_COLA", "ENVIADO" o "FALLIDO")."""
+
+    def __init__(self, mensaje: MIMEText, clave_app: str) -> None:
+        self.mensaje = mensaje
+        self.clave_app = clave_app
+        self.estado = "EN_COLA"
+        self.error: str | None = None
+        self._listo = threading.Event()
+
+    def terminar(self, estado: str, error: str | None = None) -> None:
+        self.estado = estado
+        self.error = error
+        self._listo.set()
+
+    def esperar(self, timeout: float | None = None) -> bool:
+        """Bloquea hasta que el mensaje se entregue o falle; True si se envió."""
+        self._listo.wait(timeout)
+        return self.estado == "ENVIADO"
+
+
+class _ColaEnvio(threading.Thread):
+    """Hilo de envío de una cuenta: una sola sesión SMTP autenticada para toda la cola.
+
+    Los mensajes salen uno tras otro por la misma sesión (sin TLS ni AUTH
+    por correo). Si la sesión se cae se reconecta y se reintenta el mensaje;
+    un rechazo del servidor a ese mensaje no se reintenta. Tras
+    SMTP_INACTIVIDAD_SEGUNDOS sin envíos, la sesión se cierra y el hilo termina.
+    """
+
+    def __init__(self, usuario: str) -> None:
+        super().__init__(name=f"kyber-smtp-{usuario}", daemon=True)
+        self.usuario = usuario
+        self.cola: "queue.Queue[EnvioPendiente | None]" = queue.Queue()
+        self.smtp: smtplib.SMTP | None = None
+        self.clave_app: str | None = None
+
+    def run(self) -> None:
+        while True:
+            try:
+                envio = self.cola.get(timeout=SMTP_INACTIVIDAD_SEGUNDOS)
+            except queue.Empty:
+                with _COLAS_LOCK:
+                    if not self.cola.empty():
+                        continue
+                    if _COLAS_ENVIO.get(self.usuario) is self:
+                        del _COLAS_ENVIO[self.usuario]
+                self._cerrar()
+                return
+            if envio is None:
+                self._cerrar()
+                return
+            self._enviar(envio)
+
+    def _cerrar(self) -> None:
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+        self.smtp = None
+
+    def _enviar(self, envio: EnvioPendiente) -> None:
+        error = ""
+        for intento in range(REINTENTOS_SMTP + 1):
+            try:
+                if self.smtp is None or self.clave_app != envio.clave_app:
+                    self._cerrar()
+                    self.smtp = _abrir_smtp(self.usuario, envio.clave_app)
+                    self.clave_app = envio.clave_app
+                self.smtp.send_message(envio.mensaje)
+                envio.terminar("ENVIADO")
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError) as e:
+                error = str(e) or type(e).__name__
+            except smtplib.SMTPException as e:
+                # Rechazo del propio mensaje (destinatario, contenido, credenciales)
+                try:
+                    self.smtp.rset()
+                except Exception:
+                    self._cerrar()
+                envio.terminar("FALLIDO", str(e))
+                return
+            except OSError as e:
+                error = str(e) or type(e).__name__
+            self._cerrar()
+            if intento < REINTENTOS_SMTP:
+                print(f"🔁 [SMTP] Sesión perdida para {self.usuario} ({error}); reconectando {intento + 1}/{REINTENTOS_SMTP}")
+        envio.terminar("FALLIDO", error)
+
+
+_COLAS_ENVIO: Dict[str, _ColaEnvio] = {}
+_COLAS_LOCK = threading.Lock()
+
+
+def encolar_correo(
     destinatario: str,
     asunto: str,
     cuerpo: str,
@@ -420,118 +1687,144 @@ def enviar_correo(
     usuario: str | None = None,
     clave_app: str | None = None,
     firma_personalizada: str | None = None,
-) -> bool:
-    """Envía un correo electrónico inmediatamente usando SMTP."""
+) -> EnvioPendiente:
+    """Encola un correo en la sesión SMTP de la cuenta y devuelve su estado de entrega."""
     user = usuario or os.environ.get("KYBER_GMAIL_USER")
     pwd = clave_app or os.environ.get("KYBER_GMAIL_APP_PASSWORD")
+    mensaje = _mensaje_html(user or "", destinatario, asunto, cuerpo, in_reply_to, references, firma_personalizada, "<br><br>")
+    envio = EnvioPendiente(mensaje, pwd or "")
     if not user or not pwd:
+        envio.terminar("FALLIDO", "Credenciales de Gmail no configuradas")
+        return envio
+    with _COLAS_LOCK:
+        cola = _COLAS_ENVIO.get(user)
+        if cola is None or not cola.is_alive():
+            cola = _ColaEnvio(user)
+            _COLAS_ENVIO[user] = cola
+            cola.start()
+        cola.cola.put(envio)
+    return envio
+
+
+def cerrar_colas_envio() -> None:
+    """Vacía las colas pendientes y cierra las sesiones SMTP (al apagar el servidor)."""
+    with _COLAS_LOCK:
+        colas = list(_COLAS_ENVIO.values())
+        _COLAS_ENVIO.clear()
+    for cola in colas:
+        cola.cola.put(None)
+    for cola in colas:
+        cola.join(timeout=30)
+
+
+def enviar_correo(
+    destinatario: str,
+    asunto: str,
+    cuerpo: str,
+    in_reply_to: str | None = None,
+    references: str | None = None,
+    usuario: str | None = None,
+    clave_app: str | None = None,
+    firma_personalizada: str | None = None,
+) -> bool:
+    """Envía un correo electrónico inmediatamente usando SMTP (por la cola de la cuenta)."""
+    envio = encolar_correo(destinatario, asunto, cuerpo, in_reply_to, references, usuario, clave_app, firma_personalizada)
+    if not envio.esperar():
+        print(f"ERROR AL ENVIAR CORREO: {envio.error}")
         return False
-        
-    firma = firma_personalizada 
-    if firma and firma.strip() not in cuerpo:
-        firma_html = firma.replace("\n", "<br>")
-        cuerpo = f"{cuerpo}<br><br>{firma_html}"
+    return True
 
-    cuerpo_html = cuerpo.replace("\n", "<br>")
+def _normalizar_message_id(message_id: str) -> str:
+    mid = (message_id or "").strip()
+    if mid and not mid.startswith("<"):
+        mid = f"<{mid}>"
+    return mid
 
-    mensaje = MIMEText(cuerpo_html, "html", _charset="utf-8")
-    mensaje["From"] = user
-    mensaje["To"] = destinatario
-    mensaje["Subject"] = asunto
-    if in_reply_to:
-        mensaje["In-Reply-To"] = in_reply_to
-    if references:
-        mensaje["References"] = references
 
+class _IndiceBorradores:
+    """Borradores de una cuenta indexados por los mensajes a los que responden."""
+
+    def __init__(self) -> None:
+        self.por_message_id: Dict[str, str] = {}
+        self.por_thread_id: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def registrar(self, uid: str, referencias: str, thread_id: str = "") -> None:
+        with self.lock:
+            for mid in re.findall(r"<[^>]+>", referencias or ""):
+                self.por_message_id[mid] = uid
+            if thread_id:
+                self.por_thread_id[thread_id] = uid
+
+
+_INDICES_BORRADORES: Dict[str, _IndiceBorradores] = {}
+_INDICES_LOCK = threading.Lock()
+# Fase única de la lectura de borradores: a qué mensajes e hilo responde cada uno.
+ITEMS_BORRADORES = "(X-GM-THRID BODY.PEEK[HEADER.FIELDS (IN-REPLY-TO REFERENCES)])"
+
+
+def _indexar_borradores(indice: _IndiceBorradores, datos: List[Any]) -> None:
+    """Registra en ``indice`` cada borrador de un FETCH de ITEMS_BORRADORES."""
+    for item in _agrupar_fetch(datos):
+        cabecera = next(iter(item["secciones"].values()), b"")
+        msg = email.message_from_bytes(cabecera)
+        referencias = f"{msg.get('In-Reply-To', '') or ''} {msg.get('References', '') or ''}"
+        indice.registrar(
+            _atributo_fetch(item["meta"], "UID"),
+            referencias,
+            _atributo_fetch(item["meta"], "X-GM-THRID"),
+        )
+
+
+def construir_indice_borradores(usuario: str | None = None, clave_app: str | None = None) -> None:
+    """Lee una sola vez los borradores (In-Reply-To, References, X-GM-THRID).
+
+    Se llama al inicio de cada escaneo; las consultas posteriores de
+    ``existe_borrador_para_*`` se responden desde memoria.
+    """
+    user, pwd = _credenciales(usuario, clave_app)
+    indice = _IndiceBorradores()
     try:
-        import smtplib
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(user, pwd)
-            server.send_message(mensaje)
-        return True
-    except Exception as e:
-        print(f"ERROR AL ENVIAR CORREO: {e}")
-        return False
+        with _sesion_imap(user, pwd, "[Gmail]/Drafts", "Drafts") as sesion:
+            conexion = sesion.conexion
+            estado, datos = conexion.uid("SEARCH", None, "ALL")
+            uids = [u.decode() for u in datos[0].split()] if estado == "OK" and datos and datos[0] else []
+            if uids:
+                estado, datos = conexion.uid("FETCH", _conjunto_imap(uids), ITEMS_BORRADORES)
+                if estado == "OK":
+                    _indexar_borradores(indice, datos)
+    except imaplib.IMAP4.abort:
+        raise
+    except imaplib.IMAP4.error as e:
+        print(f"⚠️  No se pudo leer la carpeta de borradores: {e}")
+    with _INDICES_LOCK:
+        _INDICES_BORRADORES[user] = indice
+
+
+def _indice_borradores(usuario: str | None = None, clave_app: str | None = None) -> _IndiceBorradores:
+    user, pwd = _credenciales(usuario, clave_app)
+    with _INDICES_LOCK:
+        indice = _INDICES_BORRADORES.get(user)
+    if indice is None:
+        construir_indice_borradores(user, pwd)
+        with _INDICES_LOCK:
+            indice = _INDICES_BORRADORES[user]
+    return indice
+
 
 def existe_borrador_para_message_id(message_id: str, usuario: str | None = None, clave_app: str | None = None) -> bool:
     if not message_id:
         return False
-    conexion = _abrir_conexion(usuario, clave_app)
-    try:
-        try:
-            conexion.select("[Gmail]/Drafts")
-        except Exception:
-            try:
-                conexion.select("Drafts")
-            except Exception:
-                return False
-        estado, datos = conexion.search(None, "ALL")
-        if estado != "OK":
-            return False
-        ids = datos[0].split()
-        for bid in ids:
-            est2, dat2 = conexion.fetch(bid, "(BODY.PEEK[HEADER])")
-            if est2 != "OK":
-                continue
-            raw = dat2[0][1]
-            try:
-                msg = email.message_from_bytes(raw)
-            except Exception:
-                continue
-            in_reply = msg.get("In-Reply-To", "") or ""
-            refs = msg.get("References", "") or ""
-            if message_id in in_reply or message_id in refs:
-                return True
-        return False
-    finally:
-        _FER_DEV_SHEI_200226 = "F-E-R-D-E-V-S-H-E-I-20-02-26"
-        try:
-            conexion.logout()
-        except Exception:
-            pass
+    indice = _indice_borradores(usuario, clave_app)
+    _FER_DEV_SHEI_200226 = "F-E-R-D-E-V-S-H-E-I-20-02-26"
+    return _normalizar_message_id(message_id) in indice.por_message_id
+
+
 def existe_borrador_para_thread_id(thread_id: str, usuario: str | None = None, clave_app: str | None = None) -> bool:
     if not thread_id:
         return False
-    conexion = _abrir_conexion(usuario, clave_app)
-    try:
-        try:
-            conexion.select("[Gmail]/Drafts")
-        except Exception:
-            try:
-                conexion.select("Drafts")
-            except Exception:
-                return False
-        estado, datos = conexion.search(None, "ALL")
-        if estado != "OK":
-            return False
-        ids = datos[0].split()
-        for bid in ids:
-            est2, dat2 = conexion.fetch(bid, "(BODY.PEEK[] X-GM-THRID)")
-            if est2 != "OK":
-                continue
-            raw = dat2[0]
-            raw_str = ""
-            try:
-                raw_str = raw[0].decode() if isinstance(raw, tuple) else b"".decode()
-            except Exception:
-                raw_str = ""
-            try:
-                if not raw_str and isinstance(dat2[0], bytes):
-                    raw_str = dat2[0].decode(errors="ignore")
-            except Exception:
-                pass
-            try:
-                mthr = re.search(r"X-GM-THRID\s+(\d+)", raw_str or "")
-                if mthr and mthr.group(1) == thread_id:
-                    return True
-            except Exception:
-                pass
-        return False
-    finally:
-        try:
-            conexion.logout()
-        except Exception:
-            pass
+    indice = _indice_borradores(usuario, clave_app)
+    return thread_id in indice.por_thread_id
 
 
 def detectar_link_unsubscribe(mensaje: email.message.Message) -> str | None:
@@ -587,41 +1880,34 @@ def eliminar_correos_por_ids(ids: List[str], usuario: str | None = None, clave_a
     if not ids:
         return 0
     
-    conexion = _abrir_conexion(usuario, clave_app)
-    conexion.select("INBOX")
-    eliminados = 0
+    with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        conexion = sesion.conexion
+        # Marcar como eliminado, un STORE por message set
+        fallidos = _store_por_lotes(conexion, ids, "+FLAGS", "\\Deleted")
     
-    for correo_id in ids:
+        # Expunge para eliminar permanentemente
         try:
-            # Marcar como eliminado
-            conexion.store(correo_id, "+FLAGS", "\\Deleted")
-            eliminados += 1
+            conexion.expunge()
         except Exception:
             pass
     
-    # Expunge para eliminar permanentemente
-    try:
-        conexion.expunge()
-    except Exception:
-        pass
-    
-    conexion.logout()
-    return eliminados
+    if fallidos:
+        print(f"⚠️  No se pudieron eliminar {len(fallidos)} correos: {fallidos[:20]}")
+    return len(set(ids)) - len(fallidos)
 
 
 def obtener_correos_antiguos(dias: int = 90, max_total: int = 100, usuario: str | None = None, clave_app: str | None = None) -> List[str]:
     """Obtiene IDs de correos más antiguos que X días."""
-    conexion = _abrir_conexion(usuario, clave_app)
-    conexion.select("INBOX")
+    with _sesion_imap(usuario, clave_app, "INBOX") as sesion:
+        conexion = sesion.conexion
     
-    # Calcular fecha límite
-    fecha_limite = datetime.utcnow() - timedelta(days=dias)
-    fecha_str = fecha_limite.strftime("%d-%b-%Y")
+        # Calcular fecha límite
+        fecha_limite = datetime.utcnow() - timedelta(days=dias)
+        fecha_str = _fecha_imap(fecha_limite)
     
-    # Buscar correos antes de esa fecha
-    estado, datos = conexion.search(None, f'BEFORE {fecha_str}')
-    ids = datos[0].split()
-    conexion.logout()
+        # Buscar correos antes de esa fecha
+        estado, datos = conexion.uid("SEARCH", None, f'BEFORE {fecha_str}')
+        ids = datos[0].split()
     
     ids_decod = [i.decode() for i in ids]
     if max_total is not None:
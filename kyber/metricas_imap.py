@@ -0,0 +1,183 @@
+"""Métricas por comando IMAP: cantidad, bytes y latencia, por usuario y por escaneo.
+
+``ImapMedido`` / ``ImapSSLMedido`` son las clases de imaplib con una capa
+fina que cronometra cada comando y cuenta los bytes que pasan por el socket;
+``gmail_async`` registra lo mismo desde su propio cliente. Los acumulados se
+exportan en /metrics y ``medir_escaneo`` deja un resumen de cada escaneo.
+"""
+import imaplib
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, List
+
+
+# Límites superiores (segundos) de los buckets del histograma de latencia.
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+_LOCK = threading.Lock()
+# {usuario: {comando: {"cantidad", "bytes_enviados", "bytes_recibidos", "segundos", "histograma"}}}
+_METRICAS: Dict[str, Dict[str, Dict[str, Any]]] = {}
+_ULTIMOS_ESCANEOS: Dict[str, Dict[str, Any]] = {}
+
+
+def _nueva_entrada() -> Dict[str, Any]:
+    return {"cantidad": 0, "bytes_enviados": 0, "bytes_recibidos": 0, "segundos": 0.0, "histograma": [0] * len(BUCKETS_LATENCIA)}
+
+
+def registrar(usuario: str, comando: str, segundos: float, bytes_enviados: int = 0, bytes_recibidos: int = 0) -> None:
+    """Suma una ejecución de ``comando`` a las métricas de ``usuario``."""
+    bucket = next(i for i, limite in enumerate(BUCKETS_LATENCIA) if segundos <= limite)
+    with _LOCK:
+        entrada = _METRICAS.setdefault(usuario or "", {}).setdefault(comando, _nueva_entrada())
+        entrada["cantidad"] += 1
+        entrada["bytes_enviados"] += bytes_enviados
+        entrada["bytes_recibidos"] += bytes_recibidos
+        entrada["segundos"] += segundos
+        entrada["histograma"][bucket] += 1
+
+
+def instantanea(usuario: str) -> Dict[str, Dict[str, Any]]:
+    with _LOCK:
+        return {
+            comando: {**entrada, "histograma": list(entrada["histograma"])}
+            for comando, entrada in _METRICAS.get(usuario or "", {}).items()
+        }
+
+
+def diferencia(antes: Dict[str, Dict[str, Any]], despues: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    resultado: Dict[str, Dict[str, Any]] = {}
+    for comando, entrada in despues.items():
+        previa = antes.get(comando, _nueva_entrada())
+        if entrada["cantidad"] == previa["cantidad"]:
+            continue
+        resultado[comando] = {
+            "cantidad": entrada["cantidad"] - previa["cantidad"],
+            "bytes_enviados": entrada["bytes_enviados"] - previa["bytes_enviados"],
+            "bytes_recibidos": entrada["bytes_recibidos"] - previa["bytes_recibidos"],
+            "segundos": entrada["segundos"] - previa["segundos"],
+            "histograma": [a - b for a, b in zip(entrada["histograma"], previa["histograma"])],
+        }
+    return resultado
+
+
+def percentil(histograma: List[int], fraccion: float) -> float:
+    """Cota superior del bucket donde cae el percentil pedido."""
+    total = sum(histograma)
+    if not total:
+        return 0.0
+    acumulado = 0
+    for limite, cantidad in zip(BUCKETS_LATENCIA, histograma):
+        acumulado += cantidad
+        if acumulado >= fraccion * total:
+            return limite
+    return BUCKETS_LATENCIA[-1]
+
+
+def _exportable(metricas: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        comando: {
+            **entrada,
+            "segundos": round(entrada["segundos"], 4),
+            "p50": percentil(entrada["histograma"], 0.5),
+            "p95": percentil(entrada["histograma"], 0.95),
+        }
+        for comando, entrada in metricas.items()
+    }
+
+
+def exportar(usuario: str) -> Dict[str, Any]:
+    """Acumulados del usuario y su último escaneo, para /metrics."""
+    with _LOCK:
+        ultimo = _ULTIMOS_ESCANEOS.get(usuario or "")
+    return {
+        "buckets": [str(b) if b != float("inf") else "+Inf" for b in BUCKETS_LATENCIA],
+        "comandos": _exportable(instantanea(usuario)),
+        "ultimo_escaneo": ultimo,
+    }
+
+
+def resumen(metricas: Dict[str, Dict[str, Any]]) -> str:
+    comandos = sum(e["cantidad"] for e in metricas.values())
+    recibidos = sum(e["bytes_recibidos"] for e in metricas.values())
+    segundos = sum(e["segundos"] for e in metricas.values())
+    detalle = " · ".join(
+        f"{comando} ×{e['cantidad']} ({e['segundos']:.2f} s, p95 ≤{percentil(e['histograma'], 0.95) * 1000:.0f} ms, {e['bytes_recibidos'] // 1024} KB)"
+        for comando, e in sorted(metricas.items(), key=lambda x: -x[1]["segundos"])
+    )
+    return f"{comandos} comandos, {recibidos / 1024:.0f} KB recibidos, {segundos:.2f} s en IMAP | {detalle}"
+
+
+@contextmanager
+def medir_escaneo(usuario: str | None) -> Iterator[None]:
+    """Imprime y guarda (para /metrics) lo que hizo IMAP durante el bloque."""
+    usuario = usuario or ""
+    antes = instantanea(usuario)
+    inicio = time.time()
+    try:
+        yield
+    finally:
+        cambios = diferencia(antes, instantanea(usuario))
+        with _LOCK:
+            _ULTIMOS_ESCANEOS[usuario] = {"inicio": inicio, "segundos": round(time.time() - inicio, 3), "comandos": _exportable(cambios)}
+        if cambios:
+            print(f"📊 [IMAP] Escaneo de {usuario}: {resumen(cambios)}")
+
+
+class _Medicion:
+    """Capa sobre imaplib: cuenta bytes del socket y cronometra cada comando."""
+
+    def __init__(self, *args: Any, usuario: str = "", **kwargs: Any) -> None:
+        self.usuario_medido = usuario
+        self.bytes_enviados = 0
+        self.bytes_recibidos = 0
+        super().__init__(*args, **kwargs)
+
+    def open(self, *args: Any, **kwargs: Any) -> None:
+        inicio = time.perf_counter()
+        super().open(*args, **kwargs)
+        registrar(self.usuario_medido, "CONNECT", time.perf_counter() - inicio)
+
+    def send(self, data: bytes) -> None:
+        self.bytes_enviados += len(data)
+        super().send(data)
+
+    def read(self, size: int) -> bytes:
+        datos = super().read(size)
+        self.bytes_recibidos += len(datos)
+        return datos
+
+    def readline(self) -> bytes:
+        linea = super().readline()
+        self.bytes_recibidos += len(linea)
+        return linea
+
+    def _simple_command(self, name: str, *args: Any) -> Any:
+        comando = f"{name} {str(args[0]).upper()}" if name == "UID" and args else name
+        enviados, recibidos, inicio = self.bytes_enviados, self.bytes_recibidos, time.perf_counter()
+        try:
+            return super()._simple_command(name, *args)
+        finally:
+            registrar(self.usuario_medido, comando, time.perf_counter() - inicio, self.bytes_enviados - enviados, self.bytes_recibidos - recibidos)
+
+    @contextmanager
+    def medir(self, comando: str) -> Iterator[None]:
+        """Para comandos armados a mano (p. ej. MULTIAPPEND) fuera de ``_simple_command``."""
+        enviados, recibidos, inicio = self.bytes_enviados, self.bytes_recibidos, time.perf_counter()
+        try:
+            yield
+        finally:
+            registrar(self.usuario_medido, comando, time.perf_counter() - inicio, self.bytes_enviados - enviados, self.bytes_recibidos - recibidos)
+
+
+def medir(conexion: Any, comando: str) -> ContextManager[None]:
+    """``conexion.medir(comando)`` si la conexión está instrumentada; si no, nada."""
+    return conexion.medir(comando) if isinstance(conexion, _Medicion) else nullcontext()
+
+
+class ImapMedido(_Medicion, imaplib.IMAP4):
+    pass
+
+
+class ImapSSLMedido(_Medicion, imaplib.IMAP4_SSL):
+    pass
@@ -0,0 +1,1162 @@
+"""Servidor IMAP/SMTP local que imita a Gmail para pruebas y benchmarks.
+
+Soporta el subconjunto de IMAP4rev1 que usa ``gmail_client`` más las
+extensiones de Gmail (X-GM-THRID, X-GM-MSGID, X-GM-LABELS, X-GM-RAW), los
+buzones ``INBOX``, ``[Gmail]/Drafts`` y ``[Gmail]/All Mail``, UIDPLUS,
+CONDSTORE, IDLE y (opcionalmente) MULTIAPPEND; el SMTP acepta AUTH PLAIN y
+LOGIN y guarda lo enviado. Todo vive en memoria.
+
+Para apuntar Kyber a él::
+
+    python -m kyber.servidor_local --mensajes 1000 --usuario yo@local --clave clave
+    KYBER_IMAP_HOST=127.0.0.1 KYBER_IMAP_PORT=1143 KYBER_IMAP_SSL=0 \
+    KYBER_SMTP_HOST=127.0.0.1 KYBER_SMTP_PORT=1025 KYBER_SMTP_SSL=0 python main.py
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import email
+import email.utils
+import functools
+import itertools
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.message import Message
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+BUZON_INBOX = "INBOX"
+BUZON_BORRADORES = "[Gmail]/Drafts"
+BUZON_TODOS = "[Gmail]/All Mail"
+
+_MESES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+# ============================================
+# MODELO EN MEMORIA
+# ============================================
+
+class MensajeLocal:
+    def __init__(self, uid: int, raw: bytes, fecha: datetime, thrid: int, msgid: int, etiquetas: set[str], flags: set[str], modseq: int) -> None:
+        self.uid = uid
+        self.raw = raw
+        self.fecha = fecha
+        self.thrid = thrid
+        self.msgid = msgid
+        self.etiquetas = etiquetas
+        self.flags = flags
+        self.modseq = modseq
+        self._parseado: Message | None = None
+
+    @property
+    def mensaje(self) -> Message:
+        if self._parseado is None:
+            self._parseado = email.message_from_bytes(self.raw)
+        return self._parseado
+
+
+class CuentaLocal:
+    """Cuenta de Gmail simulada: un único almacén etiquetado, como el real."""
+
+    def __init__(self, usuario: str, clave: str) -> None:
+        self.usuario = usuario
+        self.clave = clave
+        self.uidvalidity = int(time.time())
+        self.mensajes: Dict[int, MensajeLocal] = {}
+        self._uid = itertools.count(1)
+        self._gm_id = itertools.count(1_600_000_000_000_000_000)
+        self.modseq = 1
+        self.lock = threading.RLock()
+        self.cambios = threading.Condition(self.lock)
+        self._threads_por_message_id: Dict[str, int] = {}
+
+    def _siguiente_modseq(self) -> int:
+        self.modseq += 1
+        return self.modseq
+
+    def agregar(self, raw: bytes, etiquetas: Iterable[str] = ("\\Inbox",), flags: Iterable[str] = (), fecha: datetime | None = None) -> MensajeLocal:
+        raw = _normalizar_crlf(raw)
+        with self.lock:
+            cabeceras = email.message_from_bytes(raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n")
+            if fecha is None:
+                try:
+                    fecha = email.utils.parsedate_to_datetime(cabeceras.get("Date", ""))
+                except Exception:
+                    fecha = None
+                fecha = fecha or datetime.now(timezone.utc)
+            if fecha.tzinfo is None:
+                fecha = fecha.replace(tzinfo=timezone.utc)
+            thrid = None
+            referencias = f"{cabeceras.get('In-Reply-To', '')} {cabeceras.get('References', '')}"
+            for ref in re.findall(r"<[^>]+>", referencias):
+                if ref in self._threads_por_message_id:
+                    thrid = self._threads_por_message_id[ref]
+                    break
+            msgid = next(self._gm_id)
+            thrid = thrid or msgid
+            mid = (cabeceras.get("Message-ID") or "").strip()
+            if mid:
+                self._threads_por_message_id.setdefault(mid, thrid)
+            uid = next(self._uid)
+            msg = MensajeLocal(uid, raw, fecha, thrid, msgid, set(etiquetas), set(flags), self._siguiente_modseq())
+            self.mensajes[uid] = msg
+            self.cambios.notify_all()
+            return msg
+
+    def uids_de(self, buzon: str) -> List[int]:
+        with self.lock:
+            return sorted(uid for uid, m in self.mensajes.items() if _pertenece(m, buzon))
+
+
+def _pertenece(msg: MensajeLocal, buzon: str) -> bool:
+    if buzon == BUZON_INBOX:
+        return "\\Inbox" in msg.etiquetas
+    if buzon in (BUZON_BORRADORES, "Drafts"):
+        return "\\Draft" in msg.etiquetas
+    if buzon == BUZON_TODOS:
+        return "\\Draft" not in msg.etiquetas
+    return buzon in msg.etiquetas
+
+
+def _normalizar_crlf(raw: bytes) -> bytes:
+    return re.sub(rb"\r?\n", b"\r\n", raw)
+
+
+def _buzon_existe(buzon: str) -> bool:
+    return buzon in (BUZON_INBOX, BUZON_BORRADORES, BUZON_TODOS)
+
+
+# ============================================
+# ANÁLISIS DE COMANDOS
+# ============================================
+
+_LITERAL = re.compile(rb"\{(\d+)\+?\}\r\n$")
+
+
+def _tokenizar(texto: str, literales: List[bytes]) -> List[Any]:
+    """Convierte una línea de comando IMAP en una lista anidada de tokens."""
+    pila: List[List[Any]] = [[]]
+    i = 0
+    n = len(texto)
+    while i < n:
+        c = texto[i]
+        if c == " ":
+            i += 1
+        elif c == "(":
+            pila.append([])
+            i += 1
+        elif c == ")":
+            lista = pila.pop()
+            pila[-1].append(lista)
+            i += 1
+        elif c == '"':
+            j = i + 1
+            partes = []
+            while j < n and texto[j] != '"':
+                if texto[j] == "\\" and j + 1 < n:
+                    j += 1
+                partes.append(texto[j])
+                j += 1
+            pila[-1].append("".join(partes))
+            i = j + 1
+        elif c == "\x00":
+            j = texto.index("\x00", i + 1)
+            pila[-1].append(literales[int(texto[i + 1:j])])
+            i = j + 1
+        else:
+            j = i
+            profundidad = 0
+            while j < n:
+                cj = texto[j]
+                if cj == "[":
+                    profundidad += 1
+                elif cj == "]":
+                    profundidad -= 1
+                elif profundidad == 0 and cj in " ()":
+                    break
+                j += 1
+            pila[-1].append(texto[i:j])
+            i = j
+    return pila[0]
+
+
+@functools.lru_cache(maxsize=64)
+def _conjunto(secuencia: str, maximo: int) -> frozenset[int]:
+    """Expande un message set IMAP ('1:3,7,9:*') a un conjunto de números.
+
+    SEARCH lo evalúa una vez por mensaje, de ahí la caché.
+    """
+    resultado: set[int] = set()
+    for parte in secuencia.split(","):
+        if ":" in parte:
+            a, b = parte.split(":", 1)
+            ia = maximo if a == "*" else int(a)
+            ib = maximo if b == "*" else int(b)
+            if ia > ib:
+                ia, ib = ib, ia
+            if ia <= maximo:
+                resultado.update(range(ia, min(ib, maximo) + 1))
+            elif a == "*" or b == "*":
+                resultado.add(maximo)
+        else:
+            resultado.add(maximo if parte == "*" else int(parte))
+    return frozenset(resultado)
+
+
+@functools.lru_cache(maxsize=64)
+def _fecha_imap(texto: str) -> datetime:
+    dia, mes, anio = texto.split("-")
+    return datetime(int(anio), _MESES.index(mes.capitalize()) + 1, int(dia))
+
+
+def _cadena(valor: str | None) -> str:
+    if valor is None:
+        return "NIL"
+    return '"' + valor.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+# ============================================
+# BODYSTRUCTURE Y SECCIONES
+# ============================================
+
+def _cuerpo_crudo(parte: Message) -> bytes:
+    carga = parte.get_payload(decode=False)
+    if isinstance(carga, list):
+        return b""
+    return str(carga).encode("utf-8", "surrogateescape")
+
+
+def _bodystructure(parte: Message) -> str:
+    if parte.is_multipart():
+        hijos = "".join(_bodystructure(h) for h in parte.get_payload())
+        frontera = parte.get_boundary()
+        params = f'("boundary" {_cadena(frontera)})' if frontera else "NIL"
+        return f"({hijos} {_cadena(parte.get_content_subtype())} {params} NIL NIL)"
+    maintype = parte.get_content_maintype()
+    subtype = parte.get_content_subtype()
+    params = [(k, v) for k, v in parte.get_params(header="content-type") or [] if "/" not in k]
+    params_txt = "(" + " ".join(f"{_cadena(k)} {_cadena(str(v))}" for k, v in params) + ")" if params else "NIL"
+    cuerpo = _cuerpo_crudo(parte)
+    codificacion = (parte.get("Content-Transfer-Encoding") or "7bit").strip()
+    disposicion = parte.get_content_disposition()
+    if disposicion:
+        nombre = parte.get_filename()
+        disp_params = f'("filename" {_cadena(nombre)})' if nombre else "NIL"
+        disp_txt = f"({_cadena(disposicion)} {disp_params})"
+    else:
+        disp_txt = "NIL"
+    base = f"{_cadena(maintype)} {_cadena(subtype)} {params_txt} {_cadena(parte.get('Content-ID'))} NIL {_cadena(codificacion)} {len(cuerpo)}"
+    if maintype == "text":
+        lineas = cuerpo.count(b"\n") + 1
+        base += f" {lineas}"
+    return f"({base} NIL {disp_txt} NIL)"
+
+
+def _parte_por_numero(msg: Message, numero: str) -> Message | None:
+    actual = msg
+    for pieza in numero.split("."):
+        idx = int(pieza)
+        if actual.is_multipart():
+            hijos = actual.get_payload()
+            if idx < 1 or idx > len(hijos):
+                return None
+            actual = hijos[idx - 1]
+        elif idx != 1:
+            return None
+    return actual
+
+
+def _separar_cabecera(raw: bytes) -> Tuple[bytes, bytes]:
+    if b"\r\n\r\n" in raw:
+        cab, cuerpo = raw.split(b"\r\n\r\n", 1)
+        return cab + b"\r\n\r\n", cuerpo
+    return raw, b""
+
+
+def _campos_cabecera(cabecera: bytes, nombres: List[str], excluir: bool = False) -> bytes:
+    nombres_min = {n.lower() for n in nombres}
+    lineas: List[bytes] = []
+    actual: List[bytes] = []
+    for linea in cabecera.split(b"\r\n"):
+        if linea[:1] in (b" ", b"\t") and actual:
+            actual.append(linea)
+            continue
+        if actual:
+            lineas.append(b"\r\n".join(actual))
+        actual = [linea] if linea else []
+    if actual:
+        lineas.append(b"\r\n".join(actual))
+    salida = []
+    for bloque in lineas:
+        nombre = bloque.split(b":", 1)[0].decode("ascii", "replace").strip().lower()
+        if (nombre in nombres_min) != excluir:
+            salida.append(bloque + b"\r\n")
+    return b"".join(salida) + b"\r\n"
+
+
+def _seccion(msg: MensajeLocal, seccion: str) -> bytes:
+    if seccion == "":
+        return msg.raw
+    cabecera, cuerpo = _separar_cabecera(msg.raw)
+    sec_up = seccion.upper()
+    if sec_up == "HEADER":
+        return cabecera
+    if sec_up == "TEXT":
+        return cuerpo
+    m = re.match(r"HEADER\.FIELDS(\.NOT)?\s*\((.*)\)", seccion, re.IGNORECASE)
+    if m:
+        return _campos_cabecera(cabecera, m.group(2).split(), excluir=bool(m.group(1)))
+    m = re.match(r"([\d.]+?)(?:\.(MIME|HEADER|TEXT))?$", seccion, re.IGNORECASE)
+    if m:
+        parte = _parte_por_numero(msg.mensaje, m.group(1))
+        if parte is None:
+            return b""
+        if m.group(2):
+            return parte.as_bytes().split(b"\n\n", 1)[0] + b"\r\n\r\n"
+        return _cuerpo_crudo(parte)
+    return b""
+
+
+# ============================================
+# BÚSQUEDA
+# ============================================
+
+def _evaluar_busqueda(tokens: List[Any], msg: MensajeLocal, seq: int, maximo_seq: int, maximo_uid: int) -> bool:
+    i = 0
+
+    def uno() -> bool:
+        nonlocal i
+        tok = tokens[i]
+        i += 1
+        if isinstance(tok, list):
+            return _evaluar_busqueda(tok, msg, seq, maximo_seq, maximo_uid)
+        clave = tok.upper() if isinstance(tok, str) else tok
+        if clave == "ALL":
+            return True
+        if clave in ("UNSEEN", "SEEN", "ANSWERED", "UNANSWERED", "DELETED", "UNDELETED", "FLAGGED", "UNFLAGGED", "DRAFT"):
+            negado = clave.startswith("UN")
+            flag = "\\" + clave[2:].capitalize() if negado else "\\" + clave.capitalize()
+            return (flag in msg.flags) != negado
+        if clave in ("SINCE", "BEFORE", "ON"):
+            fecha = _fecha_imap(tokens[i])
+            i += 1
+            dia = msg.fecha.astimezone(timezone.utc).replace(tzinfo=None).date()
+            if clave == "SINCE":
+                return dia >= fecha.date()
+            if clave == "BEFORE":
+                return dia < fecha.date()
+            return dia == fecha.date()
+        if clave == "UID":
+            conjunto = _conjunto(tokens[i], maximo_uid)
+            i += 1
+            return msg.uid in conjunto
+        if clave == "X-GM-THRID":
+            valor = int(tokens[i])
+            i += 1
+            return msg.thrid == valor
+        if clave == "X-GM-MSGID":
+            valor = int(tokens[i])
+            i += 1
+            return msg.msgid == valor
+        if clave == "X-GM-RAW":
+            consulta = str(tokens[i])
+            i += 1
+            return _evaluar_gm_raw(consulta, msg)
+        if clave == "HEADER":
+            nombre, valor = tokens[i], tokens[i + 1]
+            i += 2
+            return valor.lower() in str(msg.mensaje.get(nombre, "")).lower()
+        if clave == "MODSEQ":
+            valor = int(tokens[i])
+            i += 1
+            return msg.modseq >= valor
+        if clave == "NOT":
+            return not uno()
+        if clave == "OR":
+            a = uno()
+            b = uno()
+            return a or b
+        if isinstance(tok, str) and re.match(r"^[\d*:,]+$", tok):
+            return seq in _conjunto(tok, maximo_seq)
+        raise ValueError(f"criterio no soportado: {tok}")
+
+    resultado = True
+    while i < len(tokens):
+        resultado = uno() and resultado
+    return resultado
+
+
+def _evaluar_gm_raw(consulta: str, msg: MensajeLocal) -> bool:
+    dia = msg.fecha.astimezone(timezone.utc).date()
+    for termino in consulta.split():
+        clave, _, valor = termino.partition(":")
+        clave = clave.lower()
+        if clave == "after":
+            if dia < datetime.strptime(valor, "%Y/%m/%d").date():
+                return False
+        elif clave == "before":
+            if dia >= datetime.strptime(valor, "%Y/%m/%d").date():
+                return False
+        elif clave == "is" and valor == "unread":
+            if "\\Seen" in msg.flags:
+                return False
+        elif clave == "in" and valor == "inbox":
+            if "\\Inbox" not in msg.etiquetas:
+                return False
+    return True
+
+
+# ============================================
+# SESIÓN IMAP
+# ============================================
+
+class MetricasServidor:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.comandos: Dict[str, int] = {}
+        self.bytes_entrada = 0
+        self.bytes_salida = 0
+        self.conexiones = 0
+
+    def contar(self, comando: str) -> None:
+        with self.lock:
+            self.comandos[comando] = self.comandos.get(comando, 0) + 1
+
+    def reiniciar(self) -> None:
+        with self.lock:
+            self.comandos = {}
+            self.bytes_entrada = 0
+            self.bytes_salida = 0
+            self.conexiones = 0
+
+    def resumen(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "round_trips": sum(self.comandos.values()),
+                "comandos": dict(self.comandos),
+                "bytes_entrada": self.bytes_entrada,
+                "bytes_salida": self.bytes_salida,
+                "conexiones": self.conexiones,
+            }
+
+
+class _ManejadorImap(socketserver.StreamRequestHandler):
+    server: "ServidorImapLocal"
+
+    def setup(self) -> None:
+        super().setup()
+        # Respuestas de varias líneas: sin Nagle cada comando costaría ~40 ms en localhost
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.cuenta: CuentaLocal | None = None
+        self.buzon: str | None = None
+        self.solo_lectura = False
+        self.vista: List[int] = []
+        self.condstore = False
+        self.server.metricas.contar("CONNECT")
+        with self.server.metricas.lock:
+            self.server.metricas.conexiones += 1
+
+    # --- E/S ---
+    def _escribir(self, datos: bytes) -> None:
+        with self.server.metricas.lock:
+            self.server.metricas.bytes_salida += len(datos)
+        self.wfile.write(datos)
+
+    def _linea(self, texto: str) -> None:
+        self._escribir(texto.encode("utf-8", "surrogateescape") + b"\r\n")
+
+    def _leer_linea(self) -> bytes:
+        linea = self.rfile.readline()
+        with self.server.metricas.lock:
+            self.server.metricas.bytes_entrada += len(linea)
+        return linea
+
+    def _leer_comando(self) -> Tuple[str, List[bytes]] | None:
+        literales: List[bytes] = []
+        partes: List[str] = []
+        while True:
+            linea = self._leer_linea()
+            if not linea:
+                return None
+            m = _LITERAL.search(linea)
+            if not m:
+                partes.append(linea.rstrip(b"\r\n").decode("utf-8", "surrogateescape"))
+                return "".join(partes), literales
+            partes.append(linea[: m.start()].decode("utf-8", "surrogateescape"))
+            if not linea.rstrip(b"\r\n").endswith(b"+}"):
+                self._linea("+ Ready for literal data")
+            literal = self.rfile.read(int(m.group(1)))
+            with self.server.metricas.lock:
+                self.server.metricas.bytes_entrada += len(literal)
+            partes.append(f"\x00{len(literales)}\x00")
+            literales.append(literal)
+
+    def handle(self) -> None:
+        self._linea("* OK Kyber servidor IMAP local listo")
+        while True:
+            leido = self._leer_comando()
+            if leido is None:
+                return
+            texto, literales = leido
+            if not texto.strip():
+                continue
+            tokens = _tokenizar(texto, literales)
+            if len(tokens) < 2:
+                self._linea(f"{tokens[0] if tokens else '*'} BAD comando vacío")
+                continue
+            tag, comando, args = tokens[0], str(tokens[1]).upper(), tokens[2:]
+            nombre_metrica = comando
+            if comando == "UID" and args:
+                nombre_metrica = f"UID {str(args[0]).upper()}"
+            self.server.metricas.contar(nombre_metrica)
+            if self.server.latencia:
+                time.sleep(self.server.latencia)
+            try:
+                fin = self._despachar(tag, comando, args)
+            except (ValueError, IndexError, KeyError) as e:
+                self._linea(f"{tag} BAD {e}")
+                continue
+            if fin:
+                return
+
+    def _despachar(self, tag: str, comando: str, args: List[Any]) -> bool:
+        if comando == "CAPABILITY":
+            self._linea("* CAPABILITY " + " ".join(self.server.capacidades))
+            self._linea(f"{tag} OK CAPABILITY completed")
+        elif comando == "LOGIN":
+            cuenta = self.server.cuentas.get(str(args[0]))
+            if cuenta is None or cuenta.clave != str(args[1]):
+                self._linea(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials")
+            else:
+                self.cuenta = cuenta
+                self._linea(f"{tag} OK {cuenta.usuario} authenticated (Success)")
+        elif comando == "LOGOUT":
+            self._linea("* BYE LOGOUT Requested")
+            self._linea(f"{tag} OK 73 good day")
+            return True
+        elif comando == "NOOP":
+            self._notificar_existentes()
+            self._linea(f"{tag} OK Success")
+        elif self.cuenta is None:
+            self._linea(f"{tag} BAD not authenticated")
+        elif comando == "ENABLE":
+            if any(str(a).upper() == "CONDSTORE" for a in args):
+                self.condstore = True
+                self._linea("* ENABLED CONDSTORE")
+            self._linea(f"{tag} OK Success")
+        elif comando in ("SELECT", "EXAMINE"):
+            self._select(tag, str(args[0]), comando == "EXAMINE", args[1:])
+        elif comando == "STATUS":
+            self._status(tag, str(args[0]), args[1])
+        elif comando == "APPEND":
+            self._append(tag, args)
+        elif comando == "IDLE":
+            self._idle(tag)
+        elif self.buzon is None:
+            self._linea(f"{tag} BAD no mailbox selected")
+        else:
+            # Como un servidor real, informa de mensajes nuevos antes de atender el comando.
+            self._notificar_existentes()
+            self._despachar_seleccionado(tag, comando, args)
+        return False
+
+    def _despachar_seleccionado(self, tag: str, comando: str, args: List[Any]) -> None:
+        usar_uid = comando == "UID"
+        if usar_uid:
+            comando, args = str(args[0]).upper(), args[1:]
+        if comando == "SEARCH":
+            self._search(tag, args, usar_uid)
+        elif comando == "FETCH":
+            self._fetch(tag, args, usar_uid)
+        elif comando == "STORE":
+            self._store(tag, args, usar_uid)
+        elif comando == "COPY":
+            self._copy(tag, args, usar_uid)
+        elif comando == "EXPUNGE" and not usar_uid:
+            self._expunge(tag)
+        elif comando == "CLOSE" and not usar_uid:
+            self.buzon = None
+            self._linea(f"{tag} OK Returned to authenticated state")
+        else:
+            self._linea(f"{tag} BAD comando no soportado {comando}")
+
+    # --- Buzones ---
+    def _select(self, tag: str, buzon: str, solo_lectura: bool, extra: List[Any]) -> None:
+        if not _buzon_existe(buzon):
+            self.buzon = None
+            self._linea(f"{tag} NO [NONEXISTENT] Unknown Mailbox: {buzon}")
+            return
+        if extra and isinstance(extra[0], list) and any(str(x).upper() == "CONDSTORE" for x in extra[0]):
+            self.condstore = True
+        cuenta = self.cuenta
+        with cuenta.lock:
+            self.vista = cuenta.uids_de(buzon)
+            no_leidos = [u for u in self.vista if "\\Seen" not in cuenta.mensajes[u].flags]
+            uidnext = max(cuenta.mensajes, default=0) + 1
+        self.buzon = buzon
+        self.solo_lectura = solo_lectura
+        self._linea("* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)")
+        self._linea("* OK [PERMANENTFLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen \\*)] Flags permitted.")
+        self._linea(f"* OK [UIDVALIDITY {cuenta.uidvalidity}] UIDs valid.")
+        self._linea(f"* {len(self.vista)} EXISTS")
+        self._linea("* 0 RECENT")
+        if no_leidos:
+            self._linea(f"* OK [UNSEEN {self.vista.index(no_leidos[0]) + 1}] first unseen")
+        self._linea(f"* OK [UIDNEXT {uidnext}] Predicted next UID.")
+        self._linea(f"* OK [HIGHESTMODSEQ {cuenta.modseq}]")
+        modo = "READ-ONLY" if solo_lectura else "READ-WRITE"
+        self._linea(f"{tag} OK [{modo}] {buzon} selected. (Success)")
+
+    def _status(self, tag: str, buzon: str, items: List[Any]) -> None:
+        if not _buzon_existe(buzon):
+            self._linea(f"{tag} NO [NONEXISTENT] Unknown Mailbox")
+            return
+        cuenta = self.cuenta
+        with cuenta.lock:
+            uids = cuenta.uids_de(buzon)
+            valores = {
+                "MESSAGES": len(uids),
+                "UIDNEXT": max(cuenta.mensajes, default=0) + 1,
+                "UIDVALIDITY": cuenta.uidvalidity,
+                "UNSEEN": sum(1 for u in uids if "\\Seen" not in cuenta.mensajes[u].flags),
+                "RECENT": 0,
+                "HIGHESTMODSEQ": cuenta.modseq,
+            }
+        partes = [f"{str(i).upper()} {valores[str(i).upper()]}" for i in items]
+        self._linea(f"* STATUS {_cadena(buzon)} ({' '.join(partes)})")
+        self._linea(f"{tag} OK STATUS completed")
+
+    def _notificar_existentes(self) -> None:
+        if self.buzon is None or self.cuenta is None:
+            return
+        actuales = self.cuenta.uids_de(self.buzon)
+        if len(actuales) == len(self.vista) and actuales[-1:] == self.vista[-1:]:
+            return
+        vistos = set(self.vista)
+        nuevos = [u for u in actuales if u not in vistos]
+        if nuevos:
+            self.vista.extend(nuevos)
+            self._linea(f"* {len(self.vista)} EXISTS")
+
+    # --- SEARCH ---
+    def _search(self, tag: str, args: List[Any], usar_uid: bool) -> None:
+        if args and str(args[0]).upper() == "CHARSET":
+            args = args[2:]
+        cuenta = self.cuenta
+        resultado: List[int] = []
+        with cuenta.lock:
+            maximo_uid = max(cuenta.mensajes, default=0)
+            for seq, uid in enumerate(self.vista, start=1):
+                msg = cuenta.mensajes.get(uid)
+                if msg is None:
+                    continue
+                if _evaluar_busqueda(args, msg, seq, len(self.vista), maximo_uid):
+                    resultado.append(uid if usar_uid else seq)
+        self._linea("* SEARCH" + "".join(f" {n}" for n in resultado))
+        self._linea(f"{tag} OK SEARCH completed (Success)")
+
+    def _resolver(self, conjunto: str, usar_uid: bool) -> List[Tuple[int, int]]:
+        """Devuelve pares (seq, uid) del buzón seleccionado para un message set."""
+        if usar_uid:
+            maximo = self.vista[-1] if self.vista else 0
+            if conjunto.endswith(":*") and self.vista:
+                maximo = max(maximo, int(conjunto.split(",")[-1].split(":")[0]))
+            pedidos = _conjunto(conjunto, maximo)
+            return [(seq, uid) for seq, uid in enumerate(self.vista, start=1) if uid in pedidos and uid in self.cuenta.mensajes]
+        pedidos = _conjunto(conjunto, len(self.vista))
+        return [(seq, uid) for seq, uid in enumerate(self.vista, start=1) if seq in pedidos and uid in self.cuenta.mensajes]
+
+    # --- FETCH ---
+    def _fetch(self, tag: str, args: List[Any], usar_uid: bool) -> None:
+        conjunto = str(args[0])
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        modificadores = args[2] if len(args) > 2 and isinstance(args[2], list) else []
+        desde_modseq = None
+        for j, mod in enumerate(modificadores):
+            if str(mod).upper() == "CHANGEDSINCE":
+                desde_modseq = int(modificadores[j + 1])
+        expandidos: List[str] = []
+        for item in items:
+            nombre = str(item).upper()
+            if nombre == "ALL":
+                expandidos += ["FLAGS", "INTERNALDATE", "RFC822.SIZE"]
+            elif nombre == "FAST":
+                expandidos += ["FLAGS", "INTERNALDATE", "RFC822.SIZE"]
+            else:
+                expandidos.append(str(item))
+        if usar_uid and not any(x.upper() == "UID" for x in expandidos):
+            expandidos.insert(0, "UID")
+        if desde_modseq is not None and not any(x.upper() == "MODSEQ" for x in expandidos):
+            expandidos.append("MODSEQ")
+        cuenta = self.cuenta
+        with cuenta.lock:
+            pares = self._resolver(conjunto, usar_uid)
+            for seq, uid in pares:
+                msg = cuenta.mensajes[uid]
+                if desde_modseq is not None and msg.modseq <= desde_modseq:
+                    continue
+                self._escribir(self._respuesta_fetch(seq, msg, expandidos))
+        self._linea(f"{tag} OK Success")
+
+    def _respuesta_fetch(self, seq: int, msg: MensajeLocal, items: List[str]) -> bytes:
+        partes: List[bytes] = []
+        marcar_leido = False
+        for item in items:
+            nombre = item.upper()
+            if nombre == "UID":
+                partes.append(f"UID {msg.uid}".encode())
+            elif nombre == "FLAGS":
+                partes.append(f"FLAGS ({' '.join(sorted(msg.flags))})".encode())
+            elif nombre == "INTERNALDATE":
+                partes.append(f'INTERNALDATE "{msg.fecha.strftime("%d-")}{_MESES[msg.fecha.month - 1]}{msg.fecha.strftime("-%Y %H:%M:%S %z")}"'.encode())
+            elif nombre == "RFC822.SIZE":
+                partes.append(f"RFC822.SIZE {len(msg.raw)}".encode())
+            elif nombre == "X-GM-THRID":
+                partes.append(f"X-GM-THRID {msg.thrid}".encode())
+            elif nombre == "X-GM-MSGID":
+                partes.append(f"X-GM-MSGID {msg.msgid}".encode())
+            elif nombre == "X-GM-LABELS":
+                etiquetas = " ".join(_cadena(e) if " " in e else e for e in sorted(msg.etiquetas))
+                partes.append(f"X-GM-LABELS ({etiquetas})".encode())
+            elif nombre == "MODSEQ":
+                partes.append(f"MODSEQ ({msg.modseq})".encode())
+            elif nombre == "BODYSTRUCTURE" or nombre == "BODY":
+                partes.append(f"{nombre} {_bodystructure(msg.mensaje)}".encode("utf-8", "surrogateescape"))
+            elif nombre in ("RFC822", "RFC822.HEADER", "RFC822.TEXT"):
+                datos = {"RFC822": msg.raw, "RFC822.HEADER": _seccion(msg, "HEADER"), "RFC822.TEXT": _seccion(msg, "TEXT")}[nombre]
+                partes.append(f"{nombre} {{{len(datos)}}}\r\n".encode() + datos)
+                marcar_leido = marcar_leido or nombre != "RFC822.HEADER"
+            else:
+                m = re.match(r"BODY(\.PEEK)?\[(.*)\](?:<(\d+)\.(\d+)>)?$", item, re.IGNORECASE | re.DOTALL)
+                if not m:
+                    raise ValueError(f"atributo FETCH no soportado: {item}")
+                datos = _seccion(msg, m.group(2))
+                etiqueta = f"BODY[{m.group(2)}]"
+                if m.group(3) is not None:
+                    inicio, cantidad = int(m.group(3)), int(m.group(4))
+                    datos = datos[inicio:inicio + cantidad]
+                    etiqueta += f"<{inicio}>"
+                partes.append(f"{etiqueta} {{{len(datos)}}}\r\n".encode("utf-8", "surrogateescape") + datos)
+                marcar_leido = marcar_leido or not m.group(1)
+        if marcar_leido and not self.solo_lectura and "\\Seen" not in msg.flags:
+            msg.flags.add("\\Seen")
+            msg.modseq = self.cuenta._siguiente_modseq()
+        # Como Gmail, los atributos con literal van al final de la respuesta.
+        partes.sort(key=lambda p: b"{" in p.split(b"\r\n", 1)[0])
+        return f"* {seq} FETCH (".encode() + b" ".join(partes) + b")\r\n"
+
+    # --- STORE / COPY / EXPUNGE ---
+    def _store(self, tag: str, args: List[Any], usar_uid: bool) -> None:
+        conjunto = str(args[0])
+        resto = args[1:]
+        if resto and isinstance(resto[0], list):
+            resto = resto[1:]
+        operacion = str(resto[0]).upper()
+        valores = resto[1] if isinstance(resto[1], list) else resto[1:]
+        valores = [str(v) for v in valores]
+        silencioso = operacion.endswith(".SILENT")
+        operacion = operacion.replace(".SILENT", "")
+        es_etiqueta = "X-GM-LABELS" in operacion
+        cuenta = self.cuenta
+        with cuenta.lock:
+            for seq, uid in self._resolver(conjunto, usar_uid):
+                msg = cuenta.mensajes[uid]
+                destino = msg.etiquetas if es_etiqueta else msg.flags
+                normalizados = ["\\Inbox" if v.lower() in ("\\inbox", "inbox") and es_etiqueta else v for v in valores]
+                if operacion.startswith("+"):
+                    destino.update(normalizados)
+                elif operacion.startswith("-"):
+                    destino.difference_update(normalizados)
+                else:
+                    destino.clear()
+                    destino.update(normalizados)
+                msg.modseq = cuenta._siguiente_modseq()
+                if not silencioso:
+                    if es_etiqueta:
+                        etiquetas = " ".join(_cadena(e) if " " in e else e for e in sorted(msg.etiquetas))
+                        cuerpo = f"X-GM-LABELS ({etiquetas})"
+                    else:
+                        cuerpo = f"FLAGS ({' '.join(sorted(msg.flags))})"
+                    uid_txt = f"UID {uid} " if usar_uid else ""
+                    self._linea(f"* {seq} FETCH ({uid_txt}{cuerpo} MODSEQ ({msg.modseq}))")
+            cuenta.cambios.notify_all()
+        self._linea(f"{tag} OK Success")
+
+    def _copy(self, tag: str, args: List[Any], usar_uid: bool) -> None:
+        conjunto, destino = str(args[0]), str(args[1])
+        cuenta = self.cuenta
+        with cuenta.lock:
+            for _, uid in self._resolver(conjunto, usar_uid):
+                msg = cuenta.mensajes[uid]
+                if destino == BUZON_INBOX:
+                    msg.etiquetas.add("\\Inbox")
+                elif destino not in (BUZON_TODOS,):
+                    msg.etiquetas.add(destino)
+                msg.modseq = cuenta._siguiente_modseq()
+        self._linea(f"{tag} OK Success")
+
+    def _expunge(self, tag: str) -> None:
+        cuenta = self.cuenta
+        with cuenta.lock:
+            for seq in range(len(self.vista), 0, -1):
+                uid = self.vista[seq - 1]
+                msg = cuenta.mensajes.get(uid)
+                if msg is None or "\\Deleted" not in msg.flags:
+                    continue
+                if self.buzon == BUZON_INBOX:
+                    msg.etiquetas.discard("\\Inbox")
+                    msg.flags.discard("\\Deleted")
+                    msg.modseq = cuenta._siguiente_modseq()
+                else:
+                    del cuenta.mensajes[uid]
+                del self.vista[seq - 1]
+                self._linea(f"* {seq} EXPUNGE")
+        self._linea(f"{tag} OK Success")
+
+    # --- APPEND ---
+    def _append(self, tag: str, args: List[Any]) -> None:
+        buzon = str(args[0])
+        if not _buzon_existe(buzon):
+            self._linea(f"{tag} NO [TRYCREATE] Folder doesn't exist")
+            return
+        mensajes: List[Tuple[set[str], bytes]] = []
+        flags: set[str] = set()
+        for arg in args[1:]:
+            if isinstance(arg, list):
+                flags = {str(f) for f in arg}
+            elif isinstance(arg, bytes):
+                mensajes.append((flags, arg))
+                flags = set()
+        if len(mensajes) > 1 and "MULTIAPPEND" not in self.server.capacidades:
+            self._linea(f"{tag} BAD MULTIAPPEND no soportado")
+            return
+        etiquetas = {"\\Draft"} if buzon == BUZON_BORRADORES else ({"\\Inbox"} if buzon == BUZON_INBOX else set())
+        uids = []
+        for flags_msg, raw in mensajes:
+            nuevo = self.cuenta.agregar(raw, etiquetas=set(etiquetas), flags=flags_msg | ({"\\Draft"} if buzon == BUZON_BORRADORES else set()))
+            uids.append(nuevo.uid)
+        rango = str(uids[0]) if len(uids) == 1 else f"{uids[0]}:{uids[-1]}"
+        self._linea(f"{tag} OK [APPENDUID {self.cuenta.uidvalidity} {rango}] (Success)")
+
+    # --- IDLE ---
+    def _idle(self, tag: str) -> None:
+        self._linea("+ idling")
+        cuenta = self.cuenta
+        fin = threading.Event()
+
+        def vigilar() -> None:
+            with cuenta.lock:
+                while not fin.is_set():
+                    if self.buzon is not None:
+                        actuales = cuenta.uids_de(self.buzon)
+                        if len(actuales) > len(self.vista) or any(u not in cuenta.mensajes for u in self.vista):
+                            self.vista = actuales
+                            try:
+                                self._linea(f"* {len(actuales)} EXISTS")
+                            except OSError:
+                                return
+                    cuenta.cambios.wait(timeout=0.5)
+
+        hilo = threading.Thread(target=vigilar, daemon=True)
+        hilo.start()
+        linea = self._leer_linea()
+        fin.set()
+        with cuenta.lock:
+            cuenta.cambios.notify_all()
+        hilo.join(timeout=2)
+        if linea.strip().upper() == b"DONE":
+            self._linea(f"{tag} OK IDLE terminated (Success)")
+        else:
+            self._linea(f"{tag} BAD se esperaba DONE")
+
+
+class ServidorImapLocal(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, direccion: Tuple[str, int] = ("127.0.0.1", 0), multiappend: bool = False, latencia: float = 0.0) -> None:
+        super().__init__(direccion, _ManejadorImap)
+        self.cuentas: Dict[str, CuentaLocal] = {}
+        self.metricas = MetricasServidor()
+        self.latencia = latencia
+        self.capacidades = ["IMAP4rev1", "UNSELECT", "IDLE", "NAMESPACE", "QUOTA", "ID", "XLIST", "CHILDREN", "X-GM-EXT-1", "UIDPLUS", "ENABLE", "MOVE", "CONDSTORE", "ESEARCH", "LIST-EXTENDED", "SPECIAL-USE"]
+        if multiappend:
+            self.capacidades.append("MULTIAPPEND")
+
+    def crear_cuenta(self, usuario: str, clave: str) -> CuentaLocal:
+        cuenta = CuentaLocal(usuario, clave)
+        self.cuentas[usuario] = cuenta
+        return cuenta
+
+    @property
+    def puerto(self) -> int:
+        return self.server_address[1]
+
+    def iniciar(self) -> "ServidorImapLocal":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+# ============================================
+# SMTP
+# ============================================
+
+class _ManejadorSmtp(socketserver.StreamRequestHandler):
+    server: "ServidorSmtpLocal"
+
+    def _linea(self, texto: str) -> None:
+        datos = texto.encode("utf-8", "surrogateescape") + b"\r\n"
+        with self.server.metricas.lock:
+            self.server.metricas.bytes_salida += len(datos)
+        self.wfile.write(datos)
+
+    def _leer_linea(self) -> bytes:
+        linea = self.rfile.readline()
+        with self.server.metricas.lock:
+            self.server.metricas.bytes_entrada += len(linea)
+        return linea
+
+    def setup(self) -> None:
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _autenticar(self, usuario: str, clave: str) -> bool:
+        cuenta = self.server.cuentas.get(usuario)
+        return cuenta is not None and cuenta.clave == clave
+
+    def handle(self) -> None:
+        self.server.metricas.contar("CONNECT")
+        with self.server.metricas.lock:
+            self.server.metricas.conexiones += 1
+        usuario: str | None = None
+        remitente: str | None = None
+        destinatarios: List[str] = []
+        self._linea("220 smtp.kyber.local ESMTP listo")
+        while True:
+            linea = self._leer_linea()
+            if not linea:
+                return
+            texto = linea.rstrip(b"\r\n").decode("utf-8", "surrogateescape")
+            comando, _, resto = texto.partition(" ")
+            comando = comando.upper()
+            self.server.metricas.contar(comando)
+            if self.server.latencia:
+                time.sleep(self.server.latencia)
+            if comando in ("EHLO", "HELO"):
+                self._linea("250-smtp.kyber.local")
+                self._linea("250-AUTH PLAIN LOGIN")
+                self._linea("250 8BITMIME")
+            elif comando == "AUTH":
+                mecanismo, _, inicial = resto.partition(" ")
+                if mecanismo.upper() == "PLAIN":
+                    if not inicial:
+                        self._linea("334 ")
+                        inicial = self._leer_linea().strip().decode()
+                    _, u, c = base64.b64decode(inicial).decode("utf-8", "replace").split("\x00", 2)
+                elif mecanismo.upper() == "LOGIN":
+                    self._linea("334 VXNlcm5hbWU6")
+                    u = base64.b64decode(self._leer_linea().strip()).decode("utf-8", "replace")
+                    self._linea("334 UGFzc3dvcmQ6")
+                    c = base64.b64decode(self._leer_linea().strip()).decode("utf-8", "replace")
+                else:
+                    self._linea("504 mecanismo no soportado")
+                    continue
+                if self._autenticar(u, c):
+                    usuario = u
+                    self._linea("235 2.7.0 Accepted")
+                else:
+                    self._linea("535 5.7.8 Username and Password not accepted")
+            elif comando in ("NOOP",):
+                self._linea("250 OK")
+            elif comando == "RSET":
+                remitente, destinatarios = None, []
+                self._linea("250 OK")
+            elif comando == "QUIT":
+                self._linea("221 bye")
+                return
+            elif usuario is None:
+                self._linea("530 5.7.0 Authentication Required")
+            elif comando == "MAIL":
+                remitente = re.sub(r"(?i)^FROM:\s*", "", resto).split(" ")[0].strip("<>")
+                destinatarios = []
+                self._linea("250 OK")
+            elif comando == "RCPT":
+                destino = re.sub(r"(?i)^TO:\s*", "", resto).split(" ")[0].strip("<>")
+                if destino.lower() in self.server.rechazados:
+                    self._linea("550 5.1.1 The email account that you tried to reach does not exist")
+                else:
+                    destinatarios.append(destino)
+                    self._linea("250 OK")
+            elif comando == "DATA":
+                if remitente is None or not destinatarios:
+                    self._linea("503 5.5.1 MAIL/RCPT first")
+                    continue
+                self._linea("354 Go ahead")
+                lineas: List[bytes] = []
+                while True:
+                    dato = self._leer_linea()
+                    if not dato or dato in (b".\r\n", b".\n"):
+                        break
+                    lineas.append(dato[1:] if dato.startswith(b"..") else dato)
+                with self.server.lock:
+                    self.server.enviados.append({"usuario": usuario, "remitente": remitente, "destinatarios": list(destinatarios), "raw": b"".join(lineas)})
+                remitente, destinatarios = None, []
+                self._linea("250 2.0.0 OK")
+            else:
+                self._linea("502 5.5.1 Unrecognized command")
+
+
+class ServidorSmtpLocal(socketserver.ThreadingTCPServer):
+    """SMTP en claro que autentica contra las cuentas del servidor IMAP local."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cuentas: Dict[str, CuentaLocal], direccion: Tuple[str, int] = ("127.0.0.1", 0), latencia: float = 0.0) -> None:
+        super().__init__(direccion, _ManejadorSmtp)
+        self.cuentas = cuentas
+        self.metricas = MetricasServidor()
+        self.latencia = latencia
+        self.lock = threading.Lock()
+        self.enviados: List[Dict[str, Any]] = []
+        # Destinatarios a los que se responde 550 (para probar rebotes).
+        self.rechazados: set[str] = set()
+
+    @property
+    def puerto(self) -> int:
+        return self.server_address[1]
+
+    def iniciar(self) -> "ServidorSmtpLocal":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+# ============================================
+# BUZONES SINTÉTICOS
+# ============================================
+
+_REMITENTES = ["cliente", "proveedor", "ventas", "soporte", "facturacion", "rrhh", "boletin", "banco"]
+_DOMINIOS = ["empresa.com", "proveedor.co", "correo.es", "tienda.mx", "noticias.net"]
+_ASUNTOS = [
+    "Cotización de {n} unidades", "Factura pendiente #{n}", "Consulta sobre el pedido {n}",
+    "Reunión del proyecto {n}", "Boletín semanal {n}", "Reclamo por envío {n}", "Confirmación de pago {n}",
+]
+
+
+def _mensaje_sintetico(i: int, azar: random.Random, fecha: datetime, en_respuesta_a: str | None, adjunto: int, imagen: bool, html: bool) -> bytes:
+    remitente = f"{azar.choice(_REMITENTES)}{azar.randint(1, 500)}@{azar.choice(_DOMINIOS)}"
+    asunto = azar.choice(_ASUNTOS).format(n=i)
+    if en_respuesta_a:
+        asunto = "Re: " + asunto
+    cabeceras = [
+        f"From: Remitente {i} <{remitente}>",
+        "To: yo@local",
+        f"Subject: {asunto}",
+        f"Message-ID: <sint{i}@kyber.local>",
+        f"Date: {email.utils.format_datetime(fecha)}",
+        "MIME-Version: 1.0",
+    ]
+    if en_respuesta_a:
+        cabeceras += [f"In-Reply-To: {en_respuesta_a}", f"References: {en_respuesta_a}"]
+    texto = f"Hola, este es el mensaje {i}.\r\n" + "Línea de contenido con algo de texto para la IA. " * azar.randint(2, 30)
+    cuerpo_texto = (
+        f"Content-Type: text/html; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n<p>{texto}</p>"
+        if html else
+        f"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n{texto}"
+    )
+    if not adjunto and not imagen:
+        return ("\r\n".join(cabeceras) + "\r\n" + cuerpo_texto + "\r\n").encode("utf-8")
+    frontera = f"=_kyber_{i}"
+    partes = [cuerpo_texto]
+    if imagen:
+        datos = base64.encodebytes(b"\x89PNG\r\n\x1a\n" + azar.randbytes(2048)).decode()
+        partes.append(f"Content-Type: image/png\r\nContent-Transfer-Encoding: base64\r\nContent-Disposition: inline; filename=\"foto{i}.png\"\r\n\r\n{datos}")
+    if adjunto:
+        datos = base64.encodebytes(b"%PDF-1.4\n" + b"0" * adjunto).decode()
+        partes.append(f"Content-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\nContent-Disposition: attachment; filename=\"factura{i}.pdf\"\r\n\r\n{datos}")
+    cuerpo = "".join(f"--{frontera}\r\n{parte}\r\n" for parte in partes) + f"--{frontera}--\r\n"
+    cabeceras.append(f'Content-Type: multipart/mixed; boundary="{frontera}"')
+    return ("\r\n".join(cabeceras) + "\r\n\r\n" + cuerpo).encode("utf-8")
+
+
+def generar_buzon(
+    cuenta: CuentaLocal,
+    cantidad: int,
+    semilla: int = 0,
+    proporcion_respuestas: float = 0.3,
+    proporcion_adjuntos: float = 0.05,
+    proporcion_imagenes: float = 0.05,
+    proporcion_leidos: float = 0.0,
+    bytes_adjunto: int = 200 * 1024,
+    fecha: datetime | None = None,
+) -> None:
+    """Carga ``cantidad`` mensajes sintéticos (reproducibles con ``semilla``).
+
+    Una parte son respuestas a mensajes anteriores (comparten X-GM-THRID),
+    algunos traen imagen o un PDF adjunto y todos llevan fecha del mismo día
+    que ``fecha`` (por defecto hoy), que es lo que mira el escaneo.
+    """
+    azar = random.Random(semilla)
+    base = fecha or datetime.now(timezone.utc)
+    inicio_dia = base.replace(hour=0, minute=0, second=0, microsecond=0)
+    anteriores: List[str] = []
+    for i in range(cantidad):
+        momento = max(inicio_dia, base - timedelta(seconds=cantidad - i))
+        en_respuesta_a = azar.choice(anteriores) if anteriores and azar.random() < proporcion_respuestas else None
+        raw = _mensaje_sintetico(
+            i, azar, momento, en_respuesta_a,
+            adjunto=bytes_adjunto if azar.random() < proporcion_adjuntos else 0,
+            imagen=azar.random() < proporcion_imagenes,
+            html=azar.random() < 0.2,
+        )
+        flags = {"\\Seen"} if azar.random() < proporcion_leidos else set()
+        cuenta.agregar(raw, flags=flags, fecha=momento)
+        anteriores.append(f"<sint{i}@kyber.local>")
+        if len(anteriores) > 200:
+            anteriores.pop(0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Servidor IMAP/SMTP local que imita a Gmail")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--imap-puerto", type=int, default=1143)
+    parser.add_argument("--smtp-puerto", type=int, default=1025)
+    parser.add_argument("--usuario", default="yo@local")
+    parser.add_argument("--clave", default="clave")
+    parser.add_argument("--mensajes", type=int, default=100, help="mensajes sintéticos en INBOX")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--latencia", type=float, default=0.0, help="segundos de espera por comando")
+    parser.add_argument("--multiappend", action="store_true")
+    args = parser.parse_args()
+
+    imap = ServidorImapLocal((args.host, args.imap_puerto), multiappend=args.multiappend, latencia=args.latencia)
+    smtp = ServidorSmtpLocal(imap.cuentas, (args.host, args.smtp_puerto), latencia=args.latencia)
+    generar_buzon(imap.crear_cuenta(args.usuario, args.clave), args.mensajes, semilla=args.semilla)
+    smtp.iniciar()
+    print(f"📮 IMAP en {args.host}:{imap.puerto}, SMTP en {args.host}:{smtp.puerto} ({args.mensajes} mensajes para {args.usuario})")
+    try:
+        imap.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        smtp.detener()
+        imap.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,9 @@ from .settings import cargar_env
 
 cargar_env()
 
-from .ai import procesar_correo_con_ia
+from .ai import clasificar_correos_con_ia
+from .ai import invalidar_contexto
+from .ai import estadisticas_cache_prompt
 from .ai import sugerir_clave_prioridad
 from .ai import traducir_texto
 from .ai import sugerir_etiquetas
@@ -61,22 +63,46 @@ from .db import (
     obtener_reglas_organizacion,
     toggle_regla_organizacion,
     eliminar_regla_organizacion,
+    guardar_checkpoint_sync,
+    obtener_checkpoint_sync,
+    obtener_mensajes_procesados,
+    registrar_mensaje_procesado,
+    purgar_mensajes_procesados,
+    diferir_correos,
+    obtener_correos_diferidos,
+    eliminar_correos_diferidos,
+)
+from .agente import (
+    bloqueo_scan,
+    detener_agente,
+    estado_agente,
+    iniciar_agente,
+    sincronizar_vigilantes,
 )
 from .gmail_client import (
-    crear_borrador,
-    enviar_correo,
+    EscritorBorradores,
+    encolar_correo,
     obtener_ids_no_leidos,
     obtener_correos_por_ids,
     marcar_como_leido,
     marcar_como_no_leido,
     obtener_historial_por_thread,
+    obtener_historiales_por_threads,
     existe_borrador_para_message_id,
     existe_borrador_para_thread_id,
+    construir_indice_borradores,
+    obtener_uidvalidity,
+    obtener_claves_mensajes,
+    descartar_atendidos,
     # Nuevas funciones
     detectar_link_unsubscribe,
     eliminar_correos_por_ids,
     obtener_correos_antiguos,
+    cerrar_conexiones_imap,
+    cerrar_colas_envio,
 )
+from .almacen import estadisticas as estadisticas_almacen
+from .metricas_imap import exportar as exportar_metricas_imap, medir_escaneo
 
 
 app = FastAPI()
@@ -87,6 +113,8 @@ app.add_middleware(
 )
 templates = Jinja2Templates(directory="templates")
 AGENTE_ACTIVO = False
+# Días que se recuerda la decisión tomada por cada correo (0 = sin límite)
+PROCESADOS_MAX_DIAS = int(os.environ.get("KYBER_PROCESADOS_MAX_DIAS", "90"))
 
 
 def _hash_password(raw: str) -> str:
@@ -125,6 +153,7 @@ def _user_info(usuario):
         contexto_negocio = extra_fields[6] if len(extra_fields) > 6 else ""
         filtro_fecha_especifica = extra_fields[7] if len(extra_fields) > 7 else 0
         fecha_filtro = extra_fields[8] if len(extra_fields) > 8 else ""
+        workers = extra_fields[9] if len(extra_fields) > 9 and extra_fields[9] else 1
         username = email.split("@")[0] if "@" in email else email
         username = username.strip() or email
         initial = username[0].upper()
@@ -139,6 +168,7 @@ def _user_info(usuario):
             "gmail_password": gmail_pwd,
             "scan_batch": batch,
             "scan_max": max_scan,
+            "scan_workers": workers,
             "agente_activo": bool(activo),
             "contexto_negocio": contexto_negocio,
             "filtro_fecha_especifica": filtro_fecha_especifica,
@@ -155,6 +185,17 @@ def _user_info(usuario):
 def startup() -> None:
     print("DEBUG: Evento startup disparado.")
     crear_base_de_datos()
+    # Vigilancia IDLE en el servidor; desactivar con KYBER_AGENTE_SERVIDOR=0
+    # (p. ej. si se despliegan varios workers que compartirían los usuarios).
+    if os.environ.get("KYBER_AGENTE_SERVIDOR", "1") == "1":
+        iniciar_agente(_escanear_en_segundo_plano)
+
+
+@app.on_event("shutdown")
+def shutdown() -> None:
+    detener_agente()
+    cerrar_conexiones_imap()
+    cerrar_colas_envio()
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -396,6 +437,7 @@ def learn(
         )
         destino = f"/?view=rules&toast=regla_creada"
 
+    invalidar_contexto()
     return RedirectResponse(url=destino, status_code=303)
 
 
@@ -461,20 +503,23 @@ def crear_actualizar_respuesta(
     else:
         insertar_respuesta(titulo, contenido, usuario_id=user_info["id"])
         destino = "/?view=respuestas&toast=respuesta_creada"
+    invalidar_contexto()
     return RedirectResponse(url=destino, status_code=303)
 
 @app.post("/respuestas/{respuesta_id}/delete")
 def eliminar_respuesta_endpoint(respuesta_id: int = Path(...)) -> RedirectResponse:
     eliminar_respuesta(respuesta_id)
+    invalidar_contexto()
     return RedirectResponse(url="/?view=respuestas&toast=respuesta_eliminada", status_code=303)
 
 @app.post("/rules/{regla_id}/delete")
 def delete_rule(regla_id: int = Path(...)) -> RedirectResponse:
     eliminar_regla(regla_id)
+    invalidar_contexto()
     return RedirectResponse(url="/?view=rules&toast=regla_eliminada", status_code=303)
 
 
-def _ejecutar_scan(user_info: dict) -> int:
+def _ejecutar_scan(user_info: dict, reprocesar: bool = False) -> int:
     ahora_dt = datetime.utcnow()
     ahora = ahora_dt.isoformat()
     
@@ -493,6 +538,7 @@ def _ejecutar_scan(user_info: dict) -> int:
 
     batch = user_info.get("scan_batch", 10)
     max_total = user_info.get("scan_max", 100)
+    workers = user_info.get("scan_workers", 1)
     api_key = user_info.get("gemini_api_key")
     gmail_user = user_info.get("gmail_user")
     gmail_pwd = user_info.get("gmail_password")
@@ -509,26 +555,151 @@ def _ejecutar_scan(user_info: dict) -> int:
         print(f"DEBUG: Faltan credenciales. API Key: {bool(api_key)}, User: {bool(gmail_user)}, Pwd: {bool(gmail_pwd)}")
         return 0
 
+    # El escaneo por fecha específica es histórico: no lee ni avanza el checkpoint de UIDs
+    usar_checkpoint = not (user_info.get("filtro_fecha_especifica") == 1 and user_info.get("fecha_filtro"))
+
     print(f"DEBUG: Iniciando escaneo para {gmail_user} desde {desde_fecha_imap}")
     try:
-        ids = obtener_ids_no_leidos(max_total, usuario=gmail_user, clave_app=gmail_pwd, desde_fecha=desde_fecha_imap, usuario_id=user_info["id"])
+        # Reprocesar busca en toda la ventana de fechas, también detrás del checkpoint
+        ids = obtener_ids_no_leidos(max_total, usuario=gmail_user, clave_app=gmail_pwd, desde_fecha=desde_fecha_imap, usuario_id=user_info["id"], incremental=usar_checkpoint and not reprocesar)
         print(f"DEBUG: IDs encontrados: {len(ids)}")
     except Exception as e:
         print(f"DEBUG: Error en obtener_ids_no_leidos: {e}")
         raise e
 
+    # Los correos que quedaron sin clasificar por cuota en un escaneo anterior van primero
+    diferidos: list[str] = []
+    en_diferidos: set[str] = set()
+    uidvalidity_diferidos = 0
+    if usar_checkpoint:
+        checkpoint = obtener_checkpoint_sync(user_info["id"], "INBOX")
+        if checkpoint:
+            uidvalidity_diferidos = checkpoint[0]
+            diferidos = obtener_correos_diferidos(user_info["id"], uidvalidity_diferidos)
+    if diferidos:
+        print(f"DEBUG: {len(diferidos)} correos diferidos por cuota se retoman primero")
+        en_diferidos = set(diferidos)
+        nuevos = [x for x in ids if x not in en_diferidos]
+        ids = diferidos + (nuevos[: max(0, max_total - len(diferidos))] if max_total else nuevos)
+
+    # Registro de decisiones: los correos ya decididos (p. ej. dejados como no leídos)
+    # se omiten antes de descargar el cuerpo o llamar a la IA, salvo con `reprocesar`.
+    ids_escaneados = list(ids)
+    claves: dict[str, str] = {}
+    purgar_mensajes_procesados(user_info["id"], PROCESADOS_MAX_DIAS)
+    if ids:
+        claves = obtener_claves_mensajes(ids, usuario=gmail_user, clave_app=gmail_pwd)
+        if not reprocesar:
+            ya_procesados = obtener_mensajes_procesados(user_info["id"], list(claves.values()))
+            if ya_procesados:
+                ids = [x for x in ids if claves.get(x) not in ya_procesados]
+                print(f"DEBUG: {len(ids_escaneados) - len(ids)} correos ya procesados, omitidos")
+    if diferidos:
+        restantes = set(ids)
+        eliminar_correos_diferidos(user_info["id"], uidvalidity_diferidos, [x for x in diferidos if x not in restantes])
+
+    def _registrar_decision(correo: dict, accion: str, categoria: str = "") -> None:
+        # Solo con X-GM-MSGID: sin él el correo se vuelve a evaluar en el próximo escaneo
+        registrar_mensaje_procesado(user_info["id"], claves.get(correo["id"], ""), accion, categoria)
+
+    def _registrar_log(correo: dict, resultado: dict, categoria: str) -> None:
+        insertar_log(
+            fecha=ahora,
+            remitente=correo["remitente"],
+            asunto=correo["asunto"],
+            resumen=resultado["resumen_es"],
+            accion=resultado["accion"],
+            idioma=resultado["idioma"],
+            categoria=categoria,
+            usuario_id=user_info["id"]
+        )
+        _registrar_decision(correo, resultado["accion"], categoria)
+
+    def _resolver_envios(envios: list[tuple], ids_para_marcar: list[str]) -> int:
+        """Espera la entrega de los auto-envíos encolados y registra cada resultado."""
+        for correo, resultado, categoria, es_cotizacion, envio in envios:
+            if envio.esperar():
+                resultado["accion"] = "ENVIADO_AUTO"
+                ids_para_marcar.append(correo["id"])
+            else:
+                # Si no se pudo entregar, queda como borrador para revisión humana
+                print(f"DEBUG: Auto-envío a {correo.get('from_email')} falló ({envio.error}); se guarda como borrador")
+                _crear_borrador_de(correo, resultado)
+                if not es_cotizacion:
+                    ids_para_marcar.append(correo["id"])
+            _registrar_log(correo, resultado, categoria)
+        return len(envios)
+
+    # Los borradores de cada chunk se escriben juntos en una sola sesión IMAP
+    borradores = EscritorBorradores(gmail_user, gmail_pwd)
+
+    def _crear_borrador_de(correo: dict, resultado: dict) -> None:
+        borradores.agregar(
+            responder_a=correo.get("from_email") or correo["remitente"],
+            asunto=f"Re: {correo['asunto']}",
+            cuerpo=resultado["borrador"],
+            in_reply_to=correo.get("message_id"),
+            references=correo.get("message_id"),
+            firma_personalizada=firma_usuario,
+            thread_id=correo.get("thread_id") or "",
+        )
+
+    uidvalidity = None
+    if ids_escaneados and usar_checkpoint:
+        uidvalidity = obtener_uidvalidity(usuario=gmail_user, clave_app=gmail_pwd)
+
+    # Primer UID nuevo que no se pudo descargar: el checkpoint no lo pasa, así se relee
+    tope_checkpoint: int | None = None
+
+    def _avanzar_checkpoint(uids: list[str]) -> None:
+        # Al reprocesar, ``max_total`` toma los más nuevos de la ventana y podría
+        # saltarse UIDs nuevos más antiguos: el checkpoint queda donde estaba
+        if reprocesar:
+            return
+        # Solo cuentan los UIDs nuevos: los diferidos ya están detrás del checkpoint
+        nuevos = [int(x) for x in uids if x not in en_diferidos]
+        if tope_checkpoint is not None:
+            nuevos = [x for x in nuevos if x < tope_checkpoint]
+        if uidvalidity is not None and nuevos:
+            guardar_checkpoint_sync(user_info["id"], "INBOX", uidvalidity, max(nuevos))
+    if ids:
+        # Un solo recorrido de la carpeta de borradores por escaneo
+        construir_indice_borradores(usuario=gmail_user, clave_app=gmail_pwd)
+
     total = 0
     for i in range(0, len(ids), batch):
         chunk = ids[i : i + batch]
         try:
-            correos = obtener_correos_por_ids(chunk, usuario=gmail_user, clave_app=gmail_pwd)
+            # Refresco barato (CONDSTORE) de lo que una persona leyó o respondió mientras tanto
+            pendientes = descartar_atendidos(chunk, user_info["id"], usuario=gmail_user, clave_app=gmail_pwd)
+            correos = obtener_correos_por_ids(pendientes, usuario=gmail_user, clave_app=gmail_pwd, workers=workers)
             print(f"DEBUG: Correos obtenidos en chunk: {len(correos)}")
         except Exception as e:
             print(f"DEBUG: Error en obtener_correos_por_ids: {e}")
             raise e
+        descargados = {c["id"] for c in correos}
+        fallidos = [x for x in pendientes if x not in descargados]
+        if fallidos:
+            print(f"DEBUG: {len(fallidos)} correos no se pudieron descargar; se reintentan en el próximo escaneo")
+            for x in fallidos:
+                if x not in en_diferidos and (tope_checkpoint is None or int(x) < tope_checkpoint):
+                    tope_checkpoint = int(x)
+
+        # Historial de todos los hilos del chunk en una sola pasada
+        try:
+            historiales = obtener_historiales_por_threads(
+                [c.get("thread_id") for c in correos], limite=5, usuario=gmail_user, clave_app=gmail_pwd
+            )
+        except Exception as e:
+            print(f"DEBUG: Error precargando historiales: {e}")
+            historiales = {}
 
         ids_para_marcar: list[str] = []
         ids_para_no_leer: list[str] = []
+        # Auto-envíos encolados en la sesión SMTP de la cuenta; se resuelven al final del chunk
+        envios: list[tuple] = []
+        # Correos que pasan los filtros y necesitan a la IA, con su historial
+        candidatos: list[tuple[dict, str]] = []
 
         for correo in correos:
             # Registrar remitente
@@ -543,12 +714,14 @@ def _ejecutar_scan(user_info: dict) -> int:
                     print(f"DEBUG: Correo de {from_email} eliminado (bloqueado)")
                 except Exception:
                     pass
+                _registrar_decision(correo, "BLOQUEADO")
                 continue
             
             if esta_silenciado(from_email, user_info["id"]):
                 # Marcar como leído y archivar
                 ids_para_marcar.append(correo["id"])
                 print(f"DEBUG: Correo de {from_email} silenciado")
+                _registrar_decision(correo, "SILENCIADO")
                 continue
             
             # Detectar suscripciones con IA y link de cancelación
@@ -557,7 +730,6 @@ def _ejecutar_scan(user_info: dict) -> int:
             cuerpo_lower = (correo["cuerpo"] or "").lower()
             if "unsubscribe" in cuerpo_lower or "cancelar suscripción" in cuerpo_lower or "darse de baja" in cuerpo_lower:
                 # Extraer URL del cuerpo
-                import re
                 patrones = [
                     r'(https?://[^\s<>"]+(?:unsubscribe|opt-out|remove|cancelar|baja)[^\s<>"]*)',
                 ]
@@ -581,14 +753,18 @@ def _ejecutar_scan(user_info: dict) -> int:
             if thr and existe_borrador_para_thread_id(thr, usuario=gmail_user, clave_app=gmail_pwd):
                 # Omitir silenciosamente sin guardar log
                 ids_para_no_leer.append(correo["id"])
+                _registrar_decision(correo, "BORRADOR_EXISTENTE")
                 continue
             if mensaje_id and existe_borrador_para_message_id(mensaje_id, usuario=gmail_user, clave_app=gmail_pwd):
                 # Omitir silenciosamente sin guardar log
                 ids_para_no_leer.append(correo["id"])
+                _registrar_decision(correo, "BORRADOR_EXISTENTE")
                 continue
             ultimo_de_mi_usuario = False
             if thr:
-                hist = obtener_historial_por_thread(thr, limite=5, usuario=gmail_user, clave_app=gmail_pwd)
+                hist = historiales.get(thr)
+                if hist is None:
+                    hist = obtener_historial_por_thread(thr, limite=5, usuario=gmail_user, clave_app=gmail_pwd)
                 if hist:
                     my_email = (gmail_user or "").lower()
                     try:
@@ -604,27 +780,36 @@ def _ejecutar_scan(user_info: dict) -> int:
                     historial_texto = "\n".join(partes)
             if ultimo_de_mi_usuario:
                 ids_para_no_leer.append(correo["id"])
+                _registrar_decision(correo, "RESPONDIDO")
                 continue
             
-            try:
-                resultado = procesar_correo_con_ia(
-                    remitente=correo["remitente"],
-                    asunto=correo["asunto"],
-                    cuerpo=correo["cuerpo"],
-                    imagen_mime=correo.get("imagen_mime"),
-                    imagen_datos=correo.get("imagen_datos"),
-                    historial_texto=historial_texto,
-                    api_key=api_key,
-                    contexto_negocio=contexto_negocio
-                )
-            except Exception as e:
-                error_str = str(e).lower()
-                if "429" in error_str or "quota" in error_str or "exhausted" in error_str:
-                    print(f"DEBUG: Cuota de IA agotada o límite de velocidad alcanzado. Deteniendo escaneo. Error: {e}")
-                    # Si se agota la cuota, devolvemos lo que llevamos procesado hasta ahora
-                    return total
+            candidatos.append((correo, historial_texto))
+
+        # Clasificación: los candidatos del chunk van a la IA en lotes
+        resultados: dict[int, dict] = {}
+        cuota_agotada: Exception | None = None
+        try:
+            for indice, resultado in clasificar_correos_con_ia(
+                [{**correo, "historial_texto": historial_texto} for correo, historial_texto in candidatos],
+                api_key=api_key,
+                contexto_negocio=contexto_negocio,
+            ):
+                resultados[indice] = resultado
+        except Exception as e:
+            error_str = str(e).lower()
+            if "429" in error_str or "quota" in error_str or "exhausted" in error_str:
+                print(f"DEBUG: Cuota de IA agotada o límite de velocidad alcanzado. Deteniendo escaneo. Error: {e}")
+                cuota_agotada = e
+            else:
                 raise e
 
+        # Aplicación en el orden del chunk: borradores, auto-envíos, marcas y logs
+        for indice, (correo, historial_texto) in enumerate(candidatos):
+            if indice not in resultados:
+                continue
+            resultado = resultados[indice]
+            thr = correo.get("thread_id")
+
             asunto_min = (correo["asunto"] or "").lower()
             cuerpo_min = (correo["cuerpo"] or "").lower()
             tiene_imagen = bool(correo.get("imagen_mime") and correo.get("imagen_datos"))
@@ -643,6 +828,7 @@ def _ejecutar_scan(user_info: dict) -> int:
                 print(f"DEBUG: ANUNCIO detectado. Marcando como leído y saltando. Asunto: {correo.get('asunto')}")
                 if correo["id"] not in ids_para_marcar:
                     ids_para_marcar.append(correo["id"])
+                _registrar_decision(correo, "NADA", categoria)
                 continue # ¡SALTAR AL SIGUIENTE CORREO!
 
             # Si llegamos aquí, NO ES ANUNCIO. Procedemos a guardar en logs.
@@ -708,13 +894,15 @@ def _ejecutar_scan(user_info: dict) -> int:
 
 
             if resultado["accion"] == "BORRADOR":
-                if thr and existe_borrador_para_thread_id(thr, usuario=gmail_user, clave_app=gmail_pwd):
+                if thr and (existe_borrador_para_thread_id(thr, usuario=gmail_user, clave_app=gmail_pwd) or borradores.tiene_pendiente(thread_id=thr)):
                     # Omitir silenciosamente sin guardar log
                     resultado["accion"] = "NADA"
+                    _registrar_decision(correo, "BORRADOR_EXISTENTE", categoria)
                     continue # Saltar log
-                elif existe_borrador_para_message_id(correo.get("message_id") or "", usuario=gmail_user, clave_app=gmail_pwd):
+                elif existe_borrador_para_message_id(correo.get("message_id") or "", usuario=gmail_user, clave_app=gmail_pwd) or borradores.tiene_pendiente(message_id=correo.get("message_id") or ""):
                     # Omitir silenciosamente sin guardar log
                     resultado["accion"] = "NADA"
+                    _registrar_decision(correo, "BORRADOR_EXISTENTE", categoria)
                     continue # Saltar log
                 else:
                     def _sanear_borrador(texto: str) -> str:
@@ -740,10 +928,9 @@ def _ejecutar_scan(user_info: dict) -> int:
                     else:
                         resultado["borrador"] = _sanear_borrador(resultado["borrador"])
                     
-                    # Lógica de Auto-Envío
-                    enviado_auto = False
+                    # Lógica de Auto-Envío: se encola y el log espera al resultado de la entrega
                     if resultado.get("auto_enviar") is True:
-                        enviado_auto = enviar_correo(
+                        envio = encolar_correo(
                             destinatario=correo.get("from_email") or correo["remitente"],
                             asunto=f"Re: {correo['asunto']}",
                             cuerpo=resultado["borrador"],
@@ -753,52 +940,74 @@ def _ejecutar_scan(user_info: dict) -> int:
                             clave_app=gmail_pwd,
                             firma_personalizada=firma_usuario
                         )
-                        if enviado_auto:
-                            resultado["accion"] = "ENVIADO_AUTO"
-                    
-                    if not enviado_auto:
-                        crear_borrador(
-                            responder_a=correo.get("from_email") or correo["remitente"],
-                            asunto=f"Re: {correo['asunto']}",
-                            cuerpo=resultado["borrador"],
-                            in_reply_to=correo.get("message_id"),
-                            references=correo.get("message_id"),
-                            usuario=gmail_user,
-                            clave_app=gmail_pwd,
-                            firma_personalizada=firma_usuario
-                        )
-                    
-                    if not es_cotizacion or enviado_auto:
+                        envios.append((correo, resultado, categoria, es_cotizacion, envio))
+                        continue
+
+                    _crear_borrador_de(correo, resultado)
+                    if not es_cotizacion:
                         ids_para_marcar.append(correo["id"])
 
-            insertar_log(
-                fecha=ahora,
-                remitente=correo["remitente"],
-                asunto=correo["asunto"],
-                resumen=resultado["resumen_es"],
-                accion=resultado["accion"],
-                idioma=resultado["idioma"],
-                categoria=categoria,
-                usuario_id=user_info["id"]
-            )
+            _registrar_log(correo, resultado, categoria)
             total += 1
 
+        total += _resolver_envios(envios, ids_para_marcar)
+        borradores.escribir()
+
         if ids_para_marcar:
             marcar_como_leido(ids_para_marcar, usuario=gmail_user, clave_app=gmail_pwd)
         if ids_para_no_leer:
             marcar_como_no_leido(ids_para_no_leer, usuario=gmail_user, clave_app=gmail_pwd)
 
+        # Lo que quedó sin clasificar por cuota se aparca y se retoma primero en el próximo escaneo
+        aparcar: list[str] = []
+        if cuota_agotada and uidvalidity is not None:
+            sin_clasificar = [c["id"] for indice, (c, _) in enumerate(candidatos) if indice not in resultados]
+            aparcar = sin_clasificar + ids[i + batch :]
+            reintentar_en = getattr(cuota_agotada, "reintentar_en", 0)
+            reintentar_desde = (datetime.utcnow() + timedelta(seconds=reintentar_en)).isoformat()
+            diferir_correos(
+                user_info["id"], uidvalidity, [(x, claves.get(x, "")) for x in aparcar], str(cuota_agotada)[:300], reintentar_desde
+            )
+            print(f"DEBUG: {len(aparcar)} correos diferidos hasta {reintentar_desde}")
+        if diferidos:
+            # Los diferidos que no se pudieron descargar siguen en la cola
+            conservar = set(aparcar) | set(fallidos)
+            eliminar_correos_diferidos(user_info["id"], uidvalidity_diferidos, [x for x in chunk if x not in conservar])
+
+        if cuota_agotada:
+            # Sin UIDVALIDITY (escaneo histórico) no se aparca nada: lo no clasificado se relee la próxima vez
+            _avanzar_checkpoint(ids_escaneados)
+            return total
+
+        _avanzar_checkpoint(chunk)
+
+    # Los omitidos por el registro también quedan detrás del checkpoint
+    _avanzar_checkpoint(ids_escaneados)
+
     return total
 
 
+def _escanear_en_segundo_plano(usuario_id: int) -> int:
+    """Escaneo disparado por el agente del servidor (IDLE o sondeo)."""
+    usuario = obtener_usuario_por_id(usuario_id)
+    if not usuario:
+        return 0
+    user_info = _user_info(usuario)
+    if not user_info["agente_activo"]:
+        return 0
+    with bloqueo_scan(usuario_id), medir_escaneo(user_info.get("gmail_user")):
+        return _ejecutar_scan(user_info)
+
+
 @app.post("/scan")
-def scan(request: Request) -> RedirectResponse:
+def scan(request: Request, reprocesar: str = Form(default="")) -> RedirectResponse:
     usuario = _get_current_user(request)
     if not usuario:
         return RedirectResponse(url="/auth/login", status_code=303)
     user_info = _user_info(usuario)
     try:
-        procesados = _ejecutar_scan(user_info)
+        with bloqueo_scan(user_info["id"]), medir_escaneo(user_info.get("gmail_user")):
+            procesados = _ejecutar_scan(user_info, reprocesar=reprocesar == "1")
         if procesados == 0:
             return RedirectResponse(url="/?toast=scan_empty", status_code=303)
         return RedirectResponse(url=f"/?toast=scan_ok&count={procesados}", status_code=303)
@@ -816,7 +1025,20 @@ def agent_status(request: Request) -> dict:
     if not usuario:
         return {"running": False}
     user_info = _user_info(usuario)
-    return {"running": user_info["agente_activo"]}
+    return {"running": user_info["agente_activo"], **estado_agente(user_info["id"])}
+
+
+@app.get("/metrics")
+def metrics(request: Request) -> dict:
+    usuario = _get_current_user(request)
+    if not usuario:
+        return {}
+    user_info = _user_info(usuario)
+    return {
+        "almacen": estadisticas_almacen(),
+        "imap": exportar_metricas_imap(user_info.get("gmail_user") or ""),
+        "cache_prompt": estadisticas_cache_prompt(),
+    }
 
 
 @app.post("/agent/toggle")
@@ -835,6 +1057,7 @@ def agent_toggle(request: Request) -> RedirectResponse:
 
     from .db import actualizar_configuracion_usuario
     actualizar_configuracion_usuario(user_info["id"], agente_activo=int(nuevo_estado_bool))
+    sincronizar_vigilantes()
     
     toast = "agent_on" if nuevo_estado_bool else "agent_off"
     return RedirectResponse(url=f"/?toast={toast}", status_code=303)
@@ -848,7 +1071,11 @@ def scan_json(request: Request) -> dict:
     user_info = _user_info(usuario)
     if not user_info["agente_activo"]:
         return {"processed": 0, "running": False}
-    procesados = _ejecutar_scan(user_info)
+    if estado_agente(user_info["id"])["vigilado"]:
+        # El agente del servidor ya escanea al llegar correo
+        return {"processed": 0, "running": True}
+    with bloqueo_scan(user_info["id"]), medir_escaneo(user_info.get("gmail_user")):
+        procesados = _ejecutar_scan(user_info)
     return {"processed": procesados, "running": True}
 
 
@@ -860,6 +1087,7 @@ def settings_update(
     gmail_password: str | None = Form(default=None),
     scan_batch: int = Form(default=10),
     scan_max: int = Form(default=100),
+    scan_workers: int = Form(default=1),
     contexto_negocio: str | None = Form(default=None),
     filtro_fecha_especifica: str = Form(default=""),
     fecha_filtro: str | None = Form(default=None),
@@ -891,11 +1119,13 @@ def settings_update(
         gmail_password=gmail_password,
         scan_batch=scan_batch,
         scan_max=scan_max,
+        scan_workers=max(1, scan_workers),
         contexto_negocio=contexto_negocio,
         filtro_fecha_especifica=filtro_fecha_especifica_val,
         fecha_filtro=fecha_filtro if fecha_filtro and fecha_filtro.strip() else None,
     )
     print("DEBUG: [WEB] Configuración guardada exitosamente")
+    sincronizar_vigilantes()
     return RedirectResponse(url="/?view=settings&toast=config_actualizada", status_code=303)
 
 
@@ -0,0 +1,57 @@
+"""Fixtures comunes: base SQLite y almacén en una carpeta temporal, y el servidor IMAP local."""
+import os
+import sys
+from datetime import datetime, timezone
+from email.message import EmailMessage
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kyber import almacen, db, gmail_async, gmail_client  # noqa: E402
+from kyber.servidor_local import ServidorImapLocal  # noqa: E402
+
+
+USUARIO = "yo@local"
+CLAVE = "clave"
+
+
+def mensaje(i: int, de: str = "cliente@x.com", cuerpo: str = "hola", referencias: str | None = None) -> bytes:
+    """Correo de prueba con Message-ID ``<m<i>@x.com>``."""
+    m = EmailMessage()
+    m["From"] = de
+    m["To"] = USUARIO
+    m["Subject"] = f"Asunto {i}"
+    m["Message-ID"] = f"<m{i}@x.com>"
+    m["Date"] = datetime.now(timezone.utc).strftime("%a, %d %b %Y %H:%M:%S +0000")
+    if referencias:
+        m["In-Reply-To"] = referencias
+        m["References"] = referencias
+    m.set_content(f"{cuerpo} {i}")
+    return m.as_bytes()
+
+
+@pytest.fixture
+def entorno(tmp_path, monkeypatch):
+    """kyber.db y el almacén de mensajes dentro de ``tmp_path``."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    monkeypatch.setattr(almacen, "ALMACEN_DIR", str(tmp_path / "cache_mensajes"))
+    db.crear_base_de_datos()
+    return tmp_path
+
+
+@pytest.fixture
+def servidor(entorno, monkeypatch):
+    """Servidor IMAP local con la cuenta USUARIO, y ambos clientes apuntando a él."""
+    srv = ServidorImapLocal().iniciar()
+    srv.crear_cuenta(USUARIO, CLAVE)
+    for modulo in (gmail_client, gmail_async):
+        monkeypatch.setattr(modulo, "IMAP_HOST", "127.0.0.1")
+        monkeypatch.setattr(modulo, "IMAP_PUERTO", srv.puerto)
+        monkeypatch.setattr(modulo, "IMAP_SSL", False)
+    monkeypatch.setattr(gmail_client, "_INDICES_BORRADORES", {})
+    monkeypatch.setattr(gmail_async, "_INDICES_BORRADORES", gmail_client._INDICES_BORRADORES)
+    yield srv
+    gmail_client.cerrar_conexiones_imap()
+    srv.detener()
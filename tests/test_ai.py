@@ -0,0 +1,221 @@
+import threading
+import time
+
+import pytest
+
+from kyber import ai, db
+
+
+@pytest.fixture
+def cache_prompt(monkeypatch):
+    """Caché de contexto activa y vacía, con el proveedor stub."""
+    monkeypatch.setattr(ai, "IA_PROVEEDOR", "stub")
+    monkeypatch.setattr(ai, "CACHE_PROMPT_ACTIVO", True)
+    monkeypatch.setattr(ai, "CACHE_PROMPT_MIN_CARACTERES", 10)
+    monkeypatch.setattr(ai, "_CACHES_PROMPT", {})
+    monkeypatch.setattr(ai, "_LOCKS_CACHE_PROMPT", {})
+    monkeypatch.setattr(ai, "_CONTADORES_CACHE", {"creadas": 0, "renovadas": 0, "aciertos": 0, "fallos": 0})
+
+
+def test_cache_prompt_se_reutiliza(cache_prompt):
+    primera = ai._cache_para_prefijo("prefijo largo " * 5, None)
+    segunda = ai._cache_para_prefijo("prefijo largo " * 5, None)
+    assert primera is segunda
+    assert ai.estadisticas_cache_prompt()["creadas"] == 1
+    assert ai.estadisticas_cache_prompt()["aciertos"] == 1
+
+
+def test_creacion_lenta_no_bloquea_otros_prefijos(cache_prompt, monkeypatch):
+    lento, rapido = "prefijo lento " * 5, "prefijo rapido " * 5
+    ai._cache_para_prefijo(rapido, None)
+    entro, seguir = threading.Event(), threading.Event()
+    crear = ai._crear_cache_prompt
+
+    def crear_lento(prefijo, clave, api_key=None):
+        if prefijo == lento:
+            entro.set()
+            seguir.wait(5)
+        return crear(prefijo, clave, api_key)
+
+    monkeypatch.setattr(ai, "_crear_cache_prompt", crear_lento)
+    hilo = threading.Thread(target=ai._cache_para_prefijo, args=(lento, None))
+    hilo.start()
+    assert entro.wait(5)
+    inicio = time.monotonic()
+    assert ai._cache_para_prefijo(rapido, None) is not None
+    assert time.monotonic() - inicio < 1
+    seguir.set()
+    hilo.join(5)
+    assert ai.estadisticas_cache_prompt()["creadas"] == 2
+
+
+def test_modelo_stub_anota_por_instancia():
+    uno, otro = ai.ModeloStub(), ai.ModeloStub()
+    uno.generate_content("hola")
+    assert uno.enviados == ["hola"]
+    assert otro.enviados == []
+
+
+def test_con_cache_solo_viaja_el_sufijo(cache_prompt, monkeypatch):
+    modelos = []
+    desde_cache = ai._modelo_desde_cache
+
+    def anotar(cache, api_key=None):
+        modelos.append(desde_cache(cache, api_key))
+        return modelos[-1]
+
+    monkeypatch.setattr(ai, "_modelo_desde_cache", anotar)
+    monkeypatch.setattr(ai, "IA_RPM", 0)
+    monkeypatch.setattr(ai, "IA_TPM", 0)
+    monkeypatch.setattr(ai, "_LIMITADORES", {})
+    ai._generar_con_prefijo("ROL Y CONTEXTO " * 5, "\n- Asunto: hola")
+    assert modelos[0].enviados == ["\n- Asunto: hola"]
+
+
+def test_cada_key_usa_su_propio_cliente(monkeypatch):
+    monkeypatch.setattr(ai, "IA_PROVEEDOR", "gemini")
+    monkeypatch.setattr(ai, "_CLIENTES", {})
+    monkeypatch.setattr(ai.genai, "configure", lambda **_: pytest.fail("configuración global"))
+    uno, otro = ai._configurar_modelo("key-uno"), ai._configurar_modelo("key-otro")
+    assert uno._client is not otro._client
+    assert ai._configurar_modelo("key-uno")._client is uno._client
+    assert ai._clientes("key-uno").client_config["client_options"].api_key == "key-uno"
+    assert ai._clientes("key-otro").client_config["client_options"].api_key == "key-otro"
+
+
+def test_contexto_incluye_todas_las_reglas_y_se_invalida(entorno, monkeypatch):
+    monkeypatch.setattr(ai, "_CONTEXTO", None)
+    db.insertar_regla("Precios", "Responder con la lista de precios", usuario_id=1)
+    assert "lista de precios" in ai.compilar_contexto()["reglas"]
+    db.insertar_regla("Garantia", "Pedir el número de serie", usuario_id=2)
+    assert "número de serie" not in ai.compilar_contexto()["reglas"]
+    ai.invalidar_contexto()
+    reglas = ai.compilar_contexto()["reglas"]
+    assert "lista de precios" in reglas and "número de serie" in reglas
+
+
+def test_contexto_leido_antes_de_invalidar_no_se_guarda(entorno, monkeypatch):
+    monkeypatch.setattr(ai, "_CONTEXTO", None)
+    leer = ai.obtener_reglas
+
+    def leer_e_invalidar():
+        reglas = leer()
+        # Llega /learn entre la lectura y el guardado
+        db.insertar_regla("Precios", "Responder con la lista de precios", usuario_id=1)
+        ai.invalidar_contexto()
+        return reglas
+
+    monkeypatch.setattr(ai, "obtener_reglas", leer_e_invalidar)
+    assert "lista de precios" not in ai.compilar_contexto()["reglas"]
+    monkeypatch.setattr(ai, "obtener_reglas", leer)
+    assert "lista de precios" in ai.compilar_contexto()["reglas"]
+
+
+class RelojFalso:
+    """Sustituye a ``time`` en ai: ``sleep`` avanza el reloj sin esperar."""
+
+    def __init__(self) -> None:
+        self.ahora = 1000.0
+
+    def monotonic(self) -> float:
+        return self.ahora
+
+    def time(self) -> float:
+        return self.ahora
+
+    def sleep(self, segundos: float) -> None:
+        # Como un sleep real, nunca avanza menos de un instante
+        self.ahora += max(segundos, 1e-6)
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = RelojFalso()
+    monkeypatch.setattr(ai, "time", reloj)
+    return reloj
+
+
+def test_limitador_sin_limite_no_espera(reloj):
+    limitador = ai.LimitadorCuota(0, 0)
+    assert all(limitador.adquirir(10_000) == 0 for _ in range(100))
+
+
+def test_limitador_respeta_peticiones_por_minuto(reloj):
+    limitador = ai.LimitadorCuota(rpm=6, tpm=0)
+    assert [limitador.adquirir(1) for _ in range(6)] == [0] * 6
+    # La séptima espera a que se recargue una petición: 60 / 6 = 10 s
+    assert limitador.adquirir(1) == pytest.approx(10, abs=1e-3)
+
+
+def test_limitador_respeta_tokens_por_minuto(reloj):
+    limitador = ai.LimitadorCuota(rpm=0, tpm=600)
+    assert limitador.adquirir(600) == 0
+    assert limitador.adquirir(300) == pytest.approx(30, abs=1e-3)
+    # Una petición mayor que la cubeta solo espera a que se llene
+    assert limitador.adquirir(5_000) == pytest.approx(60, abs=1e-3)
+
+
+def test_limitador_pausa_tras_429(reloj):
+    limitador = ai.LimitadorCuota(0, 0)
+    limitador.pausar(5)
+    assert limitador.adquirir(1) == pytest.approx(5, abs=1e-3)
+
+
+def test_429_se_reintenta_con_la_espera_sugerida(reloj, monkeypatch):
+    monkeypatch.setattr(ai, "_LIMITADORES", {})
+    monkeypatch.setattr(ai.random, "uniform", lambda a, b: 1.0)
+    llamadas = []
+
+    def llamada():
+        llamadas.append(reloj.ahora)
+        if len(llamadas) == 1:
+            raise RuntimeError("429 Resource exhausted. Please retry in 7s")
+        return "ok"
+
+    assert ai._llamar_con_cuota("key-test", 1, llamada) == "ok"
+    assert llamadas[1] - llamadas[0] == pytest.approx(7, abs=1e-3)
+
+
+def test_cuota_diaria_no_se_reintenta(reloj, monkeypatch):
+    monkeypatch.setattr(ai, "_LIMITADORES", {})
+
+    def llamada():
+        raise RuntimeError("429 quota exceeded: GenerateRequestsPerDayPerProjectPerModel")
+
+    with pytest.raises(ai.CuotaAgotada) as error:
+        ai._llamar_con_cuota("key-test", 1, llamada)
+    assert error.value.reintentar_en >= 3600
+
+
+def test_resultados_de_lote_por_indice():
+    texto = 'Aquí va:\n```json\n[{"indice": 2, "accion": "borrador", "borrador": "Hola"}, {"indice": 1, "accion": "NADA"}]\n```'
+    resultados = ai._resultados_de_lote(texto, 2)
+    assert sorted(resultados) == [0, 1]
+    assert resultados[1]["accion"] == "BORRADOR" and resultados[1]["borrador"] == "Hola"
+    assert resultados[0]["accion"] == "NADA"
+
+
+def test_resultados_de_lote_descarta_lo_invalido():
+    texto = '{"resultados": [{"accion": "NADA"}, "basura", {"indice": 9, "accion": "NADA"}, {"indice": 1, "accion": "BORRADOR"}, {"indice": 3}]}'
+    # Sin índice vale la posición; fuera de rango, repetido o sin acción se ignora
+    assert list(ai._resultados_de_lote(texto, 3)) == [0]
+    assert ai._resultados_de_lote("no es json", 3) == {}
+
+
+def test_armar_lotes_por_cantidad_y_tokens():
+    bloques = ["x" * 40] * 5
+    assert ai._armar_lotes(bloques, max_lote=2, max_tokens=10_000) == [[0, 1], [2, 3], [4]]
+    # Cada bloque estima 11 tokens: caben dos por lote de 25
+    assert ai._armar_lotes(bloques, max_lote=8, max_tokens=25) == [[0, 1], [2, 3], [4]]
+
+
+def test_clasificar_en_lote_devuelve_todos_los_indices(monkeypatch, entorno):
+    monkeypatch.setattr(ai, "IA_PROVEEDOR", "stub")
+    monkeypatch.setattr(ai, "IA_RPM", 0)
+    monkeypatch.setattr(ai, "IA_TPM", 0)
+    monkeypatch.setattr(ai, "_LIMITADORES", {})
+    monkeypatch.setattr(ai, "_CONTEXTO", None)
+    correos = [{"remitente": "a@x.com", "asunto": f"Asunto {i}", "cuerpo": "hola"} for i in range(7)]
+    resultados = dict(ai.clasificar_correos_con_ia(correos, api_key="key-test", max_lote=3, concurrencia=2))
+    assert sorted(resultados) == list(range(7))
+    assert all(r["accion"] in ("NADA", "BORRADOR") for r in resultados.values())
@@ -0,0 +1,63 @@
+import asyncio
+
+from kyber import almacen, gmail_async, gmail_client
+
+from conftest import CLAVE, USUARIO, mensaje
+
+
+def test_indice_borradores_async_igual_al_sync(servidor):
+    cuenta = servidor.cuentas[USUARIO]
+    original = cuenta.agregar(mensaje(1))
+    cuenta.agregar(mensaje(2, referencias="<m1@x.com>"), etiquetas=("\\Draft",))
+    thread_id = str(original.thrid)
+
+    async def consultar():
+        await gmail_async.construir_indice_borradores(USUARIO, CLAVE)
+        resultado = (
+            await gmail_async.existe_borrador_para_message_id("m1@x.com", USUARIO, CLAVE),
+            await gmail_async.existe_borrador_para_message_id("<m9@x.com>", USUARIO, CLAVE),
+            await gmail_async.existe_borrador_para_thread_id(thread_id, USUARIO, CLAVE),
+        )
+        await gmail_async.cerrar_conexiones_imap()
+        return resultado
+
+    assert asyncio.run(consultar()) == (True, False, True)
+    assert gmail_client.existe_borrador_para_message_id("<m1@x.com>", USUARIO, CLAVE)
+    assert gmail_client.existe_borrador_para_thread_id(thread_id, USUARIO, CLAVE)
+
+
+def test_borrador_creado_entra_en_el_indice(servidor):
+    servidor.cuentas[USUARIO].agregar(mensaje(3))
+
+    async def crear():
+        await gmail_async.construir_indice_borradores(USUARIO, CLAVE)
+        antes = await gmail_async.existe_borrador_para_message_id("<m3@x.com>", USUARIO, CLAVE)
+        await gmail_async.crear_borrador("cliente@x.com", "Re: Asunto 3", "hola", "<m3@x.com>", "<m3@x.com>", USUARIO, CLAVE)
+        despues = await gmail_async.existe_borrador_para_message_id("<m3@x.com>", USUARIO, CLAVE)
+        await gmail_async.cerrar_conexiones_imap()
+        return antes, despues
+
+    assert asyncio.run(crear()) == (False, True)
+
+
+def test_descarga_async_usa_el_almacen_de_la_cuenta(servidor, monkeypatch):
+    monkeypatch.setattr(gmail_async, "FETCH_PARCIAL", False)
+    cuenta = servidor.cuentas[USUARIO]
+    for i in range(5):
+        cuenta.agregar(mensaje(i))
+    ids = [str(u) for u in cuenta.uids_de("INBOX")]
+
+    async def descargar():
+        primera = await gmail_async.obtener_correos_por_ids(ids, USUARIO, CLAVE)
+        servidor.metricas.reiniciar()
+        segunda = await gmail_async.obtener_correos_por_ids(ids, USUARIO, CLAVE)
+        await gmail_async.cerrar_conexiones_imap()
+        return primera, segunda
+
+    primera, segunda = asyncio.run(descargar())
+    assert [c["id"] for c in primera] == ids
+    assert segunda == primera
+    assert servidor.metricas.resumen()["comandos"].get("UID FETCH") == 1
+    gm_msgid = str(cuenta.mensajes[int(ids[0])].msgid)
+    assert almacen.leer(USUARIO, almacen.clave_mensaje(gm_msgid)) is not None
+    assert almacen.leer("otra@local", almacen.clave_mensaje(gm_msgid)) is None
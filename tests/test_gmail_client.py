@@ -0,0 +1,110 @@
+from kyber import gmail_client
+
+from conftest import CLAVE, USUARIO, mensaje
+
+
+def test_conjunto_imap_compacta_tramos():
+    assert gmail_client._conjunto_imap(["3", "4", "5", "6", "7", "9", "12", "13"]) == "3:7,9,12:13"
+
+
+def test_conjunto_imap_ordena_y_quita_repetidos():
+    assert gmail_client._conjunto_imap(["10", "2", "3", "2", "1"]) == "1:3,10"
+    assert gmail_client._conjunto_imap(["42"]) == "42"
+    assert gmail_client._conjunto_imap([]) == ""
+
+
+def test_indice_borradores_por_referencias_e_hilo():
+    indice = gmail_client._IndiceBorradores()
+    indice.registrar("7", "<a@x.com> <b@x.com>", "555")
+    indice.registrar("8", "", "")
+    assert indice.por_message_id == {"<a@x.com>": "7", "<b@x.com>": "7"}
+    assert indice.por_thread_id == {"555": "7"}
+
+
+def test_indice_borradores_se_lee_una_vez_por_escaneo(servidor):
+    cuenta = servidor.cuentas[USUARIO]
+    original = cuenta.agregar(mensaje(1))
+    cuenta.agregar(mensaje(2, referencias="<m1@x.com>"), etiquetas=("\\Draft",))
+    gmail_client.construir_indice_borradores(USUARIO, CLAVE)
+    servidor.metricas.reiniciar()
+    assert gmail_client.existe_borrador_para_message_id("m1@x.com", USUARIO, CLAVE)
+    assert gmail_client.existe_borrador_para_thread_id(str(original.thrid), USUARIO, CLAVE)
+    assert not gmail_client.existe_borrador_para_message_id("<m9@x.com>", USUARIO, CLAVE)
+    assert not gmail_client.existe_borrador_para_thread_id("1", USUARIO, CLAVE)
+    # Las consultas se responden desde memoria
+    assert servidor.metricas.resumen()["comandos"] == {}
+
+
+def test_borrador_creado_se_registra_en_el_indice(servidor):
+    servidor.cuentas[USUARIO].agregar(mensaje(3))
+    gmail_client.construir_indice_borradores(USUARIO, CLAVE)
+    assert not gmail_client.existe_borrador_para_message_id("<m3@x.com>", USUARIO, CLAVE)
+    gmail_client.crear_borrador("cliente@x.com", "Re: Asunto 3", "hola", "<m3@x.com>", "<m3@x.com>", USUARIO, CLAVE)
+    assert gmail_client.existe_borrador_para_message_id("<m3@x.com>", USUARIO, CLAVE)
+
+
+BODYSTRUCTURE_MIXTO = (
+    '((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL)'
+    '("TEXT" "HTML" ("CHARSET" "iso-8859-1") NIL NIL "BASE64" 300 5 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "b1") NIL NIL)'
+    '("IMAGE" "PNG" ("NAME" "a.png") NIL NIL "BASE64" 2048 NIL ("ATTACHMENT" ("FILENAME" "a.png")) NIL) "MIXED" ("BOUNDARY" "b0") NIL NIL)'
+)
+
+
+def test_claves_solo_con_x_gm_msgid():
+    datos = [
+        (b"1 (UID 5 X-GM-MSGID 1700 BODY[HEADER.FIELDS (MESSAGE-ID)] {25}", b"Message-ID: <a@x.com>\r\n\r\n"),
+        b")",
+        # Sin X-GM-MSGID no hay clave: el Message-ID lo elige el remitente
+        (b"2 (UID 6 BODY[HEADER.FIELDS (MESSAGE-ID)] {25}", b"Message-ID: <a@x.com>\r\n\r\n"),
+        b")",
+    ]
+    assert gmail_client._claves_desde_fetch(datos) == {"5": "1700"}
+
+
+def test_parsear_sexp_listas_cadenas_y_nil():
+    texto = '(A "b c" NIL ("d\\"e" 12)) resto'
+    valor, fin = gmail_client._parsear_sexp(texto)
+    assert valor == ["A", "b c", None, ['d"e', "12"]]
+    assert texto[fin:] == " resto"
+
+
+def test_partes_bodystructure_multiparte():
+    estructura, _ = gmail_client._parsear_sexp(BODYSTRUCTURE_MIXTO)
+    partes = gmail_client._partes_bodystructure(estructura)
+    assert [(p["numero"], p["tipo"], p["charset"], p["codificacion"], p["tamano"], p["adjunto"]) for p in partes] == [
+        ("1.1", "text/plain", "utf-8", "quoted-printable", 120, False),
+        ("1.2", "text/html", "iso-8859-1", "base64", 300, False),
+        ("2", "image/png", None, "base64", 2048, True),
+    ]
+
+
+def test_partes_bodystructure_parte_unica():
+    estructura, _ = gmail_client._parsear_sexp('("TEXT" "PLAIN" NIL NIL NIL "7BIT" 10 1 NIL NIL NIL)')
+    assert gmail_client._partes_bodystructure(estructura) == [
+        {"numero": "1", "tipo": "text/plain", "charset": None, "codificacion": "7bit", "tamano": 10, "adjunto": False}
+    ]
+
+
+def test_descarga_parcial_igual_a_la_completa(servidor, monkeypatch):
+    cuenta = servidor.cuentas[USUARIO]
+    for i in range(6):
+        cuenta.agregar(mensaje(i, cuerpo="línea con acentos " * 20))
+    ids = [str(u) for u in cuenta.uids_de("INBOX")]
+    monkeypatch.setattr(gmail_client.almacen, "ALMACEN_ACTIVO", False)
+    monkeypatch.setattr(gmail_client, "FETCH_PARCIAL", False)
+    completos = gmail_client.obtener_correos_por_ids(ids, USUARIO, CLAVE)
+    monkeypatch.setattr(gmail_client, "FETCH_PARCIAL", True)
+    parciales = gmail_client.obtener_correos_por_ids(ids, USUARIO, CLAVE)
+    campos = ("id", "remitente", "asunto", "message_id", "thread_id")
+    assert [{k: c[k] for k in campos} for c in parciales] == [{k: c[k] for k in campos} for c in completos]
+    assert [c["cuerpo"].strip() for c in parciales] == [c["cuerpo"].strip() for c in completos]
+
+
+def test_sesion_prestada_no_arrastra_respuestas_sueltas(servidor):
+    servidor.cuentas[USUARIO].agregar(mensaje(1))
+    with gmail_client._sesion_imap(USUARIO, CLAVE, "INBOX") as sesion:
+        # Como un FETCH no pedido que llega con el NOOP de keepalive
+        sesion.conexion.untagged_responses["FETCH"] = [b"1 (FLAGS (\\Seen))"]
+    with gmail_client._sesion_imap(USUARIO, CLAVE, "INBOX") as otra:
+        assert otra is sesion
+        assert "FETCH" not in otra.conexion.untagged_responses
@@ -0,0 +1,141 @@
+import re
+import sqlite3
+
+import pytest
+
+from kyber import ai, db, web
+from kyber.gmail_client import _decodificar_cabecera
+from kyber.servidor_local import generar_buzon
+
+from conftest import CLAVE, USUARIO
+
+
+USER_INFO = {
+    "id": 1,
+    "gemini_api_key": "key-test",
+    "gmail_user": USUARIO,
+    "gmail_password": CLAVE,
+    "scan_batch": 10,
+    "scan_max": 100,
+    "scan_workers": 1,
+    "contexto_negocio": "",
+}
+
+
+@pytest.fixture
+def escaneo(servidor, monkeypatch):
+    """Buzón sintético de 30 correos sin leer y la IA en modo stub, sin límite local."""
+    monkeypatch.setattr(ai, "IA_PROVEEDOR", "stub")
+    monkeypatch.setattr(ai, "IA_RPM", 0)
+    monkeypatch.setattr(ai, "IA_TPM", 0)
+    monkeypatch.setattr(ai, "_LIMITADORES", {})
+    monkeypatch.setattr(ai, "_CONTEXTO", None)
+    generar_buzon(servidor.cuentas[USUARIO], 30, semilla=1, proporcion_imagenes=0, proporcion_adjuntos=0)
+    return servidor.cuentas[USUARIO]
+
+
+def _diferidos() -> list[str]:
+    filas = sqlite3.connect("kyber.db").execute("SELECT uid FROM correos_diferidos").fetchall()
+    return sorted((f[0] for f in filas), key=int)
+
+
+def test_checkpoint_nunca_retrocede(entorno):
+    db.guardar_checkpoint_sync(1, "INBOX", 7, 100)
+    db.guardar_checkpoint_sync(1, "INBOX", 7, 40)
+    assert db.obtener_checkpoint_sync(1, "INBOX")[1] == 100
+    db.guardar_checkpoint_sync(1, "INBOX", 7, 120)
+    assert db.obtener_checkpoint_sync(1, "INBOX")[1] == 120
+    # Otra UIDVALIDITY invalida los UIDs anteriores
+    db.guardar_checkpoint_sync(1, "INBOX", 8, 5)
+    assert db.obtener_checkpoint_sync(1, "INBOX")[:2] == (8, 5)
+
+
+def test_decisiones_viejas_se_purgan(entorno):
+    db.registrar_mensaje_procesado(1, "100", "NADA")
+    db.registrar_mensaje_procesado(1, "200", "NADA")
+    db.registrar_mensaje_procesado(2, "100", "NADA")
+    conexion = sqlite3.connect("kyber.db")
+    conexion.execute("UPDATE mensajes_procesados SET procesado_en = '2000-01-01' WHERE clave = '100'")
+    conexion.commit()
+    conexion.close()
+    assert db.purgar_mensajes_procesados(1, 90) == 1
+    assert db.obtener_mensajes_procesados(1, ["100", "200"]) == {"200"}
+    assert db.obtener_mensajes_procesados(2, ["100"]) == {"100"}
+    assert db.purgar_mensajes_procesados(2, 0) == 0
+
+
+def test_cuota_agotada_difiere_y_el_siguiente_escaneo_los_retoma(escaneo, monkeypatch):
+    generar = ai.ModeloStub.generate_content
+    llamadas = {"n": 0, "limite": 2}
+
+    def con_cuota(self, contenido):
+        llamadas["n"] += 1
+        if llamadas["n"] > llamadas["limite"]:
+            raise RuntimeError("429 Resource has been exhausted. retry_delay { seconds: 120 }")
+        return generar(self, contenido)
+
+    monkeypatch.setattr(ai.ModeloStub, "generate_content", con_cuota)
+    web._ejecutar_scan(USER_INFO)
+    diferidos = _diferidos()
+    assert diferidos
+    # Lo diferido queda detrás del checkpoint, que llega hasta el último UID leído
+    uids = escaneo.uids_de("INBOX")
+    assert db.obtener_checkpoint_sync(1, "INBOX")[1] == max(uids)
+
+    # Mientras no venza la espera sugerida no se retoman
+    llamadas["limite"] = 10**6
+    web._ejecutar_scan(USER_INFO)
+    assert _diferidos() == diferidos
+
+    conexion = sqlite3.connect("kyber.db")
+    conexion.execute("UPDATE correos_diferidos SET reintentar_desde = '2000-01-01'")
+    conexion.commit()
+    conexion.close()
+    web._ejecutar_scan(USER_INFO)
+    assert _diferidos() == []
+    claves = web.obtener_claves_mensajes([str(u) for u in uids], usuario=USUARIO, clave_app=CLAVE)
+    assert set(claves.values()) <= db.obtener_mensajes_procesados(1, list(claves.values()))
+
+
+def test_checkpoint_no_pasa_descargas_fallidas(escaneo, monkeypatch):
+    uids = [str(u) for u in escaneo.uids_de("INBOX")]
+    fallido = uids[4]
+    descargar = web.obtener_correos_por_ids
+
+    def sin_uno(ids, **kwargs):
+        return [c for c in descargar(ids, **kwargs) if c["id"] != fallido]
+
+    monkeypatch.setattr(web, "obtener_correos_por_ids", sin_uno)
+    web._ejecutar_scan(USER_INFO)
+    assert db.obtener_checkpoint_sync(1, "INBOX")[1] == int(fallido) - 1
+
+    monkeypatch.setattr(web, "obtener_correos_por_ids", descargar)
+    web._ejecutar_scan(USER_INFO)
+    assert db.obtener_checkpoint_sync(1, "INBOX")[1] == int(uids[-1])
+    clave = web.obtener_claves_mensajes([fallido], usuario=USUARIO, clave_app=CLAVE)[fallido]
+    assert db.obtener_mensajes_procesados(1, [clave]) == {clave}
+
+
+def test_reprocesar_vuelve_a_clasificar_los_no_leidos(escaneo, monkeypatch):
+    generar = ai.ModeloStub.generate_content
+    enviados: list[str] = []
+
+    def anotar(self, contenido):
+        enviados.append(contenido if isinstance(contenido, str) else "".join(p for p in contenido if isinstance(p, str)))
+        return generar(self, contenido)
+
+    monkeypatch.setattr(ai.ModeloStub, "generate_content", anotar)
+    web._ejecutar_scan(USER_INFO)
+    checkpoint = db.obtener_checkpoint_sync(1, "INBOX")
+    no_leidos = {_decodificar_cabecera(m.mensaje["Subject"]) for m in escaneo.mensajes.values() if "\\Seen" not in m.flags}
+    assert no_leidos
+
+    # Sin reprocesar, lo que quedó detrás del checkpoint no se vuelve a buscar
+    enviados.clear()
+    assert web._ejecutar_scan(USER_INFO) == 0
+    assert enviados == []
+
+    assert web._ejecutar_scan(USER_INFO, reprocesar=True) > 0
+    asuntos = {a.strip() for texto in enviados for a in re.findall(r"- Asunto: (.*)", texto)}
+    assert asuntos and asuntos <= no_leidos
+    assert db.obtener_checkpoint_sync(1, "INBOX")[:2] == checkpoint[:2]